@@ -23,7 +23,7 @@ __all__ = [
 
 
 from mailman.app import (
-    domain, membership, moderator, registrar, subscriptions)
+    domain, membership, moderator, recipients, registrar, subscriptions)
 from mailman.core import i18n, switchboard
 from mailman.languages import manager as language_manager
 from mailman.styles import manager as style_manager
@@ -41,6 +41,13 @@ def initialize():
         membership.handle_SubscriptionEvent,
         moderator.handle_ListDeletingEvent,
         passwords.handle_ConfigurationUpdatedEvent,
+        recipients.handle_AddressDeletingEvent,
+        recipients.handle_AddressLinkChangeEvent,
+        recipients.handle_AddressVerificationEvent,
+        recipients.handle_MembershipChangeEvent,
+        recipients.handle_PreferencesChangeEvent,
+        recipients.handle_PreferredAddressChangeEvent,
+        recipients.handle_UserDeletingEvent,
         registrar.handle_ConfirmationNeededEvent,
         style_manager.handle_ConfigurationUpdatedEvent,
         subscriptions.handle_ListDeletingEvent,
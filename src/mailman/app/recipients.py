@@ -0,0 +1,202 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Caching the regular delivery recipients of mailing lists.
+
+Working out the recipients of a big mailing list is expensive, but its members
+change much less often than messages are posted to it.  The recipients are
+cached along with the mailing list's member generation, which changes whenever
+the members, their addresses or their delivery preferences do.  Since the
+generation is stored with the mailing list, every runner sees it change, and
+checking it costs nothing more than loading the mailing list.
+"""
+
+__all__ = [
+    'get_regular_recipients',
+    'handle_AddressDeletingEvent',
+    'handle_AddressLinkChangeEvent',
+    'handle_AddressVerificationEvent',
+    'handle_MembershipChangeEvent',
+    'handle_PreferencesChangeEvent',
+    'handle_PreferredAddressChangeEvent',
+    'handle_UserDeletingEvent',
+    ]
+
+
+import os
+import uuid
+import pickle
+
+from lazr.config import as_boolean
+from mailman.config import config
+from mailman.database.transaction import dbconnection
+from mailman.interfaces.address import AddressVerificationEvent
+from mailman.interfaces.member import MembershipChangeEvent
+from mailman.interfaces.preferences import PreferencesChangeEvent
+from mailman.interfaces.user import (
+    AddressLinkChangeEvent, PreferredAddressChangeEvent)
+from mailman.interfaces.usermanager import (
+    AddressDeletingEvent, UserDeletingEvent)
+from mailman.model.address import Address
+from mailman.model.mailinglist import MailingList
+from mailman.model.member import Member
+from sqlalchemy import or_
+
+
+SNAPSHOT_FILE = 'recipients.pck'
+
+# The preferences which decide who the recipients are.
+DELIVERY_PREFERENCES = ('delivery_mode', 'delivery_status')
+
+# The cached recipients, as 2-tuples of the member generation and the frozen
+# set of email addresses, keyed by list id.
+_cache = {}
+
+
+
+def _read_snapshot(mlist, generation):
+    path = os.path.join(mlist.data_path, SNAPSHOT_FILE)
+    try:
+        with open(path, 'rb') as fp:
+            snapshot_generation, recipients = pickle.load(fp)
+    except FileNotFoundError:
+        return None
+    return (recipients if snapshot_generation == generation else None)
+
+
+def _write_snapshot(mlist, generation, recipients):
+    path = os.path.join(mlist.data_path, SNAPSHOT_FILE)
+    # Other runners only ever see a complete snapshot.
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as fp:
+        pickle.dump((generation, recipients), fp, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_path, path)
+
+
+def get_regular_recipients(mlist):
+    """Return the regular delivery recipients of a mailing list.
+
+    The recipients are worked out once per member generation, and then
+    served from the cache.  When `[mailman]recipient_snapshots` is set, they
+    are shared with the other runners through a snapshot file in the mailing
+    list's data directory.
+
+    :param mlist: The mailing list.
+    :type mlist: `IMailingList`
+    :return: The email addresses of the regular delivery members whose
+        delivery is enabled.  The set is the caller's to change.
+    :rtype: set
+    """
+    generation = mlist.member_generation
+    cached = _cache.get(mlist.list_id)
+    if cached is None or cached[0] != generation:
+        snapshots = as_boolean(config.mailman.recipient_snapshots)
+        recipients = (_read_snapshot(mlist, generation)
+                      if snapshots else None)
+        if recipients is None:
+            recipients = frozenset(mlist.regular_members.recipients)
+            if snapshots:
+                _write_snapshot(mlist, generation, recipients)
+        cached = (generation, recipients)
+        _cache[mlist.list_id] = cached
+    return set(cached[1])
+
+
+
+def _new_generation(mlist):
+    mlist.member_generation = uuid.uuid4()
+
+
+@dbconnection
+def _new_generations(store, address=None, user=None):
+    # Find the mailing lists which the address or the user is subscribed to,
+    # either directly or through the other.  Addresses and users which
+    # haven't been flushed yet can't be subscribed to anything, except
+    # through new members, whose subscription events already took care of
+    # their mailing lists.
+    clauses = []
+    if address is not None:
+        if address.id is not None:
+            clauses.append(Member.address_id == address.id)
+        if user is None:
+            user = address.user
+    if user is not None and user.id is not None:
+        clauses.append(Member.user_id == user.id)
+        clauses.append(Member.address_id.in_(
+            store.query(Address.id).filter(Address.user_id == user.id)))
+    if len(clauses) == 0:
+        return
+    list_ids = set(list_id for (list_id,) in store.query(
+        Member.list_id).filter(or_(*clauses)))
+    if len(list_ids) == 0:
+        return
+    for mlist in store.query(MailingList).filter(
+            MailingList._list_id.in_(list_ids)):
+        _new_generation(mlist)
+
+
+
+def handle_MembershipChangeEvent(event):
+    """Change the member generation of the mailing list."""
+    if isinstance(event, MembershipChangeEvent):
+        _new_generation(event.mlist)
+
+
+def handle_AddressVerificationEvent(event):
+    """Change the member generation of the address's mailing lists."""
+    if isinstance(event, AddressVerificationEvent):
+        _new_generations(address=event.address)
+
+
+def handle_AddressDeletingEvent(event):
+    """Change the member generation of the address's mailing lists."""
+    if isinstance(event, AddressDeletingEvent):
+        _new_generations(address=event.address)
+
+
+def handle_AddressLinkChangeEvent(event):
+    """Change the member generation of the address's mailing lists."""
+    if isinstance(event, AddressLinkChangeEvent):
+        # After unlinking, the user's memberships can still use the address.
+        _new_generations(address=event.address, user=event.user)
+
+
+def handle_PreferredAddressChangeEvent(event):
+    """Change the member generation of the user's mailing lists."""
+    if isinstance(event, PreferredAddressChangeEvent):
+        _new_generations(user=event.user)
+
+
+def handle_UserDeletingEvent(event):
+    """Change the member generation of the user's mailing lists."""
+    if isinstance(event, UserDeletingEvent):
+        _new_generations(user=event.user)
+
+
+def handle_PreferencesChangeEvent(event):
+    """Change the member generation of the mailing lists affected."""
+    if not isinstance(event, PreferencesChangeEvent):
+        return
+    if event.name not in DELIVERY_PREFERENCES:
+        return
+    preferences = event.preferences
+    if preferences.member is not None:
+        _new_generation(preferences.member.mailing_list)
+    elif preferences.address is not None:
+        _new_generations(address=preferences.address)
+    elif preferences.user is not None:
+        _new_generations(user=preferences.user)
@@ -0,0 +1,184 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the cached recipients of mailing lists."""
+
+__all__ = [
+    'TestRecipientCache',
+    ]
+
+
+import os
+import unittest
+
+from mailman.app import recipients
+from mailman.app.lifecycle import create_list
+from mailman.app.recipients import SNAPSHOT_FILE, get_regular_recipients
+from mailman.interfaces.member import DeliveryMode, DeliveryStatus
+from mailman.interfaces.usermanager import IUserManager
+from mailman.testing.helpers import configuration
+from mailman.testing.layers import ConfigLayer
+from mailman.utilities.datetime import now
+from zope.component import getUtility
+
+
+
+class TestRecipientCache(unittest.TestCase):
+    """Test the cached recipients of mailing lists."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._mlist = create_list('test@example.com')
+        self._user_manager = getUtility(IUserManager)
+        self._anne = self._user_manager.create_address('anne@example.com')
+        self._bart = self._user_manager.create_address('bart@example.com')
+        self._member = self._mlist.subscribe(self._anne)
+
+    def _recipients(self):
+        return sorted(get_regular_recipients(self._mlist))
+
+    def test_cached(self):
+        # The recipients are only worked out again when the generation
+        # changes.
+        generation = self._mlist.member_generation
+        self.assertEqual(self._recipients(), ['anne@example.com'])
+        # Changes which bypass the model aren't seen.
+        self._member.preferences.delivery_mode = DeliveryMode.mime_digests
+        self._mlist.member_generation = generation
+        self.assertEqual(self._recipients(), ['anne@example.com'])
+
+    def test_caller_owns_the_set(self):
+        addresses = get_regular_recipients(self._mlist)
+        addresses.discard('anne@example.com')
+        self.assertEqual(self._recipients(), ['anne@example.com'])
+
+    def test_subscription(self):
+        self.assertEqual(self._recipients(), ['anne@example.com'])
+        self._mlist.subscribe(self._bart)
+        self.assertEqual(self._recipients(),
+                         ['anne@example.com', 'bart@example.com'])
+        self._member.unsubscribe()
+        self.assertEqual(self._recipients(), ['bart@example.com'])
+
+    def test_member_preferences(self):
+        self.assertEqual(self._recipients(), ['anne@example.com'])
+        self._member.preferences.delivery_status = DeliveryStatus.by_user
+        self.assertEqual(self._recipients(), [])
+
+    def test_address_preferences(self):
+        self.assertEqual(self._recipients(), ['anne@example.com'])
+        self._anne.preferences.delivery_mode = DeliveryMode.plaintext_digests
+        self.assertEqual(self._recipients(), [])
+
+    def test_user_preferences(self):
+        user = self._user_manager.make_user('cris@example.com')
+        address = list(user.addresses)[0]
+        address.verified_on = now()
+        user.preferred_address = address
+        self._mlist.subscribe(user)
+        self.assertEqual(self._recipients(),
+                         ['anne@example.com', 'cris@example.com'])
+        user.preferences.delivery_status = DeliveryStatus.by_bounces
+        self.assertEqual(self._recipients(), ['anne@example.com'])
+
+    def test_preferred_address(self):
+        # Members subscribed as a user receive at their preferred address.
+        user = self._user_manager.make_user('cris@example.com')
+        address = list(user.addresses)[0]
+        address.verified_on = now()
+        user.preferred_address = address
+        self._mlist.subscribe(user)
+        self.assertEqual(self._recipients(),
+                         ['anne@example.com', 'cris@example.com'])
+        other = user.register('cris@example.org')
+        other.verified_on = now()
+        user.preferred_address = other
+        self.assertEqual(self._recipients(),
+                         ['anne@example.com', 'cris@example.org'])
+
+    def test_link_address(self):
+        # Members subscribed with an address get the preferences of the
+        # user it is linked to.
+        user = self._user_manager.create_user()
+        user.preferences.delivery_status = DeliveryStatus.by_user
+        self.assertEqual(self._recipients(), ['anne@example.com'])
+        user.link(self._anne)
+        self.assertEqual(self._recipients(), [])
+        user.unlink(self._anne)
+        self.assertEqual(self._recipients(), ['anne@example.com'])
+
+    def test_register_address(self):
+        user = self._user_manager.create_user()
+        user.preferences.delivery_status = DeliveryStatus.by_user
+        self.assertEqual(self._recipients(), ['anne@example.com'])
+        user.register('anne@example.com')
+        self.assertEqual(self._recipients(), [])
+
+    def test_delete_user(self):
+        user = self._user_manager.create_user()
+        user.link(self._anne)
+        user.preferences.delivery_mode = DeliveryMode.mime_digests
+        self.assertEqual(self._recipients(), [])
+        self._user_manager.delete_user(user)
+        self.assertEqual(self._recipients(), ['anne@example.com'])
+
+    def test_delete_address(self):
+        # The memberships of a deleted address no longer get messages.
+        self.assertEqual(self._recipients(), ['anne@example.com'])
+        self._user_manager.delete_address(self._anne)
+        self.assertEqual(self._recipients(), [])
+
+    def test_member_address(self):
+        user = self._user_manager.create_user()
+        self._anne.verified_on = now()
+        user.link(self._anne)
+        other = user.register('anne@example.org')
+        other.verified_on = now()
+        self.assertEqual(self._recipients(), ['anne@example.com'])
+        self._member.address = other
+        self.assertEqual(self._recipients(), ['anne@example.org'])
+
+    def test_address_verification(self):
+        generation = self._mlist.member_generation
+        self._anne.verified_on = now()
+        self.assertNotEqual(self._mlist.member_generation, generation)
+
+    def test_other_preferences(self):
+        # Preferences which don't decide the recipients leave the generation
+        # alone.
+        generation = self._mlist.member_generation
+        self._member.preferences.receive_own_postings = False
+        self.assertEqual(self._mlist.member_generation, generation)
+
+    def test_snapshot(self):
+        path = os.path.join(self._mlist.data_path, SNAPSHOT_FILE)
+        with configuration('mailman', recipient_snapshots='yes'):
+            self.assertEqual(self._recipients(), ['anne@example.com'])
+            self.assertTrue(os.path.exists(path))
+            # Another runner picks up the snapshot for the same generation.
+            recipients._cache.clear()
+            generation = self._mlist.member_generation
+            self._mlist.subscribe(self._bart)
+            self._mlist.member_generation = generation
+            self.assertEqual(self._recipients(), ['anne@example.com'])
+            # But not for another generation.
+            recipients._cache.clear()
+            self._mlist.subscribe(self._user_manager.create_address(
+                'cris@example.com'))
+            self.assertEqual(self._recipients(), [
+                'anne@example.com', 'bart@example.com', 'cris@example.com'])
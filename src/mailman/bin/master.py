@@ -37,6 +37,7 @@ from lazr.config import as_boolean
 from mailman.config import config
 from mailman.core.i18n import _
 from mailman.core.logging import reopen
+from mailman.core.switchboard import get_slice_count, set_slice_count
 from mailman.utilities.options import Options
 
 
@@ -77,7 +78,11 @@ The master also responds to SIGINT, SIGTERM, SIGUSR1 and SIGHUP, which it
 simply passes on to the runners.  Note that the master will close and reopen
 its own log files on receipt of a SIGHUP.  The master also leaves its own
 process id in the file `data/master.pid` but you normally don't need to use
-this pid directly.""")
+this pid directly.
+
+On receipt of a SIGUSR2, the master starts or stops queue runner instances to
+match the number of slices recorded in each queue directory.  Use `mailman
+scale` to change that number.""")
 
     def add_options(self):
         """See `Options`."""
@@ -275,6 +280,18 @@ class PIDWatcher:
         """
         return self._pids.pop(pid)
 
+    def get(self, pid):
+        """Return existing process information.
+
+        :param pid: The process id.
+        :type pid: int
+        :return: The process information, or None if the process id is not
+            being tracked.
+        :rtype: 4-tuple consisting of
+            (runner-name, slice-number, slice-count, restart-count)
+        """
+        return self._pids.get(pid)
+
     def drop(self, pid):
         """Remove and return existing process information.
 
@@ -300,6 +317,9 @@ class Loop:
         self._restartable = restartable
         self._config_file = config_file
         self._kids = PIDWatcher()
+        # The process ids of runners which have been stopped because their
+        # queue was scaled down.
+        self._retiring = set()
 
     def install_signal_handlers(self):
         """Install various signals handlers for control from the master."""
@@ -338,6 +358,11 @@ class Loop:
                 os.kill(pid, signal.SIGINT)
             log.info('Master watcher caught SIGINT.  Restarting.')
         signal.signal(signal.SIGINT, sigint_handler)
+        # SIGUSR2 is used by 'mailman scale'.
+        def sigusr2_handler(signum, frame):
+            log.info('Master watcher caught SIGUSR2.  Rescaling.')
+            self.rescale()
+        signal.signal(signal.SIGUSR2, sigusr2_handler)
 
     def _start_runner(self, spec):
         """Start a runner.
@@ -413,11 +438,12 @@ class Loop:
             runner_config = getattr(config, section_name)
             if not as_boolean(runner_config.start):
                 continue
-            # Find out how many runners to instantiate.  This must be a power
-            # of 2.
+            # Find out how many runners to instantiate.  The configuration
+            # overrides any slice count left over from a previous run.
             count = int(runner_config.instances)
-            assert (count & (count - 1)) == 0, (
-                'Runner "{0}", not a power of 2: {1}'.format(name, count))
+            switchboard = config.switchboards.get(name)
+            if switchboard is not None:
+                set_slice_count(switchboard.queue_directory, count)
             for slice_number in range(count):
                 # runner name, slice #, # of slices, restart count
                 info = (name, slice_number, count, 0)
@@ -427,6 +453,48 @@ class Loop:
                 log.debug('[{0:d}] {1}'.format(pid, spec))
                 self._kids.add(pid, info)
 
+    def rescale(self):
+        """Start or stop queue runners to match their queue's slice count.
+
+        The runners that keep running pick up the new slice count from their
+        queue directory.  Entries which were being worked on by a stopped
+        runner stay locked until it exits, after which the runner that now
+        owns them recovers them.
+        """
+        log = logging.getLogger('mailman.runner')
+        # runner name -> (slice count, {slice number: pid})
+        running = {}
+        for pid in self._kids:
+            if pid in self._retiring:
+                continue
+            rname, slice_number, count, restarts = self._kids.get(pid)
+            running.setdefault(rname, (count, {}))[1][slice_number] = pid
+        for rname, (count, pids) in running.items():
+            switchboard = config.switchboards.get(rname)
+            if switchboard is None:
+                # This runner does not manage a queue.
+                continue
+            new_count = get_slice_count(switchboard.queue_directory, count)
+            if new_count == count:
+                continue
+            log.info('Scaling runner %s from %d to %d instances',
+                     rname, count, new_count)
+            for slice_number, pid in pids.items():
+                if slice_number < new_count:
+                    restarts = self._kids.pop(pid)[3]
+                    self._kids.add(
+                        pid, (rname, slice_number, new_count, restarts))
+                else:
+                    self._retiring.add(pid)
+                    os.kill(pid, signal.SIGTERM)
+            for slice_number in range(new_count):
+                if slice_number not in pids:
+                    spec = '{0}:{1:d}:{2:d}'.format(
+                        rname, slice_number, new_count)
+                    pid = self._start_runner(spec)
+                    log.debug('[{0:d}] {1}'.format(pid, spec))
+                    self._kids.add(pid, (rname, slice_number, new_count, 0))
+
     def _pause(self):
         """Sleep until a signal is received."""
         # Sleep until a signal is received.  This prevents the master from
@@ -472,6 +540,10 @@ class Loop:
             restart = False
             if why == signal.SIGUSR1 and self._restartable:
                 restart = True
+            # Runners stopped by scaling down their queue stay stopped.
+            if pid in self._retiring:
+                self._retiring.discard(pid)
+                restart = False
             # Have we hit the maximum number of restarts?
             restarts += 1
             max_restarts = int(getattr(config, config_name).max_restarts)
@@ -19,16 +19,23 @@
 
 __all__ = [
     'TestMasterLock',
+    'TestRescale',
     ]
 
 
 import os
 import errno
+import signal
 import tempfile
 import unittest
 
 from flufl.lock import Lock
 from mailman.bin import master
+from mailman.config import config
+from mailman.core.switchboard import get_slice_count, set_slice_count
+from mailman.testing.helpers import configuration
+from mailman.testing.layers import ConfigLayer
+from unittest.mock import patch
 
 
 
@@ -68,3 +75,61 @@ class TestMasterLock(unittest.TestCase):
             my_lock.unlock()
         self.assertEqual(state, master.WatcherState.conflict)
         # XXX test stale_lock and host_mismatch states.
+
+
+
+class FakeLoop(master.Loop):
+    """A master loop which doesn't really start runners."""
+
+    def __init__(self):
+        super(FakeLoop, self).__init__()
+        self.started = []
+
+    def _start_runner(self, spec):
+        self.started.append(spec)
+        return 1000 + len(self.started)
+
+
+
+class TestRescale(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._loop = FakeLoop()
+        self._queue_directory = config.switchboards['out'].queue_directory
+
+    def _kids(self):
+        return sorted(self._loop._kids.get(pid) for pid in self._loop._kids
+                      if pid not in self._loop._retiring)
+
+    @configuration('runner.out', instances=4)
+    def test_scale_up(self):
+        self._loop.start_runners(['out'])
+        self.assertEqual(get_slice_count(self._queue_directory, 0), 4)
+        set_slice_count(self._queue_directory, 6)
+        with patch('mailman.bin.master.os.kill') as kill:
+            self._loop.rescale()
+        self.assertFalse(kill.called)
+        self.assertEqual(self._loop.started[4:], ['out:4:6', 'out:5:6'])
+        self.assertEqual(self._kids(),
+                         [('out', slice_number, 6, 0)
+                          for slice_number in range(6)])
+
+    @configuration('runner.out', instances=6)
+    def test_scale_down(self):
+        self._loop.start_runners(['out'])
+        set_slice_count(self._queue_directory, 4)
+        with patch('mailman.bin.master.os.kill') as kill:
+            self._loop.rescale()
+        # The runners for the two surplus slices are stopped.
+        self.assertEqual(sorted(call[0] for call in kill.call_args_list),
+                         [(1005, signal.SIGTERM), (1006, signal.SIGTERM)])
+        self.assertEqual(self._loop.started[6:], [])
+        self.assertEqual(self._kids(),
+                         [('out', slice_number, 4, 0)
+                          for slice_number in range(4)])
+        # Rescaling again does nothing.
+        with patch('mailman.bin.master.os.kill') as kill:
+            self._loop.rescale()
+        self.assertFalse(kill.called)
+        self.assertEqual(self._loop.started[6:], [])
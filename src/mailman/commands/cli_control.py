@@ -20,6 +20,7 @@
 __all__ = [
     'Reopen',
     'Restart',
+    'Scale',
     'Start',
     'Stop',
     ]
@@ -34,6 +35,7 @@ import logging
 from mailman.bin.master import WatcherState, master_state
 from mailman.config import config
 from mailman.core.i18n import _
+from mailman.core.switchboard import set_slice_count
 from mailman.interfaces.command import ICLISubCommand
 from zope.interface import implementer
 
@@ -219,3 +221,44 @@ class Restart(SignalCommand):
     name = 'restart'
     message = _('Restarting the Mailman runners')
     signal = signal.SIGUSR1
+
+
+
+@implementer(ICLISubCommand)
+class Scale:
+    """Change the number of runners for a queue."""
+
+    name = 'scale'
+
+    def add(self, parser, command_parser):
+        """See `ICLISubCommand`."""
+        self.parser = parser
+        command_parser.add_argument(
+            'queue', metavar='QUEUE', nargs=1,
+            help=_('The queue whose runners to scale.'))
+        command_parser.add_argument(
+            'instances', metavar='INSTANCES', nargs=1, type=int,
+            help=_("""\
+            The number of runners to split the queue between.  This overrides
+            the configured number of instances until Mailman is
+            restarted."""))
+        command_parser.add_argument(
+            '-q', '--quiet',
+            default=False, action='store_true',
+            help=_("""\
+            Don't print status messages.  Error messages are still printed to
+            standard error."""))
+
+    def process(self, args):
+        """See `ICLISubCommand`."""
+        queue = args.queue[0]
+        instances = args.instances[0]
+        switchboard = config.switchboards.get(queue)
+        if switchboard is None:
+            self.parser.error(_('No such queue: $queue'))
+        if instances < 1:
+            self.parser.error(_('Bad number of instances: $instances'))
+        set_slice_count(switchboard.queue_directory, instances)
+        if not args.quiet:
+            print(_('Scaling the $queue runners to $instances instances'))
+        kill_watcher(signal.SIGUSR2)
@@ -36,6 +36,8 @@ from mailman.interfaces.domain import (
     BadDomainSpecificationError, IDomainManager)
 from mailman.interfaces.languages import ILanguageManager
 from mailman.interfaces.listmanager import IListManager, ListAlreadyExistsError
+from mailman.interfaces.member import MemberRole
+from mailman.interfaces.roster import IRosterStatistics
 from mailman.utilities.i18n import make
 from zope.component import getUtility
 from zope.interface import implementer
@@ -66,6 +68,10 @@ class Lists:
             '-d', '--descriptions',
             default=False, action='store_true',
             help=_('Show also the list descriptions'))
+        command_parser.add_argument(
+            '-m', '--members',
+            default=False, action='store_true',
+            help=_('Show also the number of members of the lists'))
         command_parser.add_argument(
             '-q', '--quiet',
             default=False, action='store_true',
@@ -98,6 +104,11 @@ class Lists:
         count = len(mailing_lists)
         if not args.quiet:
             print(_('$count matching mailing lists found:'))
+        # Count the members of all the mailing lists at once.
+        show_members = getattr(args, 'members', False)
+        if show_members:
+            counts = getUtility(IRosterStatistics).get_counts(
+                mlist.list_id for mlist in mailing_lists)
         # Calculate the longest identifier.
         longest = 0
         output = []
@@ -107,6 +118,10 @@ class Lists:
                     mlist.fqdn_listname, mlist.display_name)
             else:
                 identifier = mlist.fqdn_listname
+            if show_members:
+                members = counts.get(mlist.list_id, {}).get(
+                    MemberRole.member, 0)
+                identifier = _('$identifier ($members members)')
             longest = max(len(identifier), longest)
             output.append((identifier, mlist.description))
         # Print it out.
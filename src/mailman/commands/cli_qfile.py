@@ -24,6 +24,7 @@ __all__ = [
 
 import pickle
 
+from mailman.core import qfile
 from mailman.core.i18n import _
 from mailman.interfaces.command import ICLISubCommand
 from mailman.utilities.interact import interact
@@ -69,11 +70,16 @@ class QFile:
         printer = PrettyPrinter(indent=4)
         assert len(args.qfile) == 1, 'Wrong number of positional arguments'
         with open(args.qfile[0], 'rb') as fp:
-            while True:
-                try:
-                    m.append(pickle.load(fp))
-                except EOFError:
-                    break
+            if fp.read(len(qfile.MAGIC)) == qfile.MAGIC:
+                fp.seek(0)
+                m.extend(qfile.loads(fp.read()))
+            else:
+                fp.seek(0)
+                while True:
+                    try:
+                        m.append(pickle.load(fp))
+                    except EOFError:
+                        break
         if args.doprint:
             print(_('[----- start pickle -----]'))
             for i, obj in enumerate(m):
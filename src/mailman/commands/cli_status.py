@@ -24,9 +24,11 @@ __all__ = [
 
 import socket
 
+from datetime import datetime
 from mailman.bin.master import WatcherState, master_state
 from mailman.core.i18n import _
 from mailman.interfaces.command import ICLISubCommand
+from mailman.mta.breaker import BreakerState, get_circuit_breaker
 from zope.interface import implementer
 
 
@@ -60,4 +62,17 @@ class Status:
             message = _('GNU Mailman is in an unexpected state '
                         '($hostname != $fqdn_name)')
         print(message)
+        breaker = get_circuit_breaker()
+        if breaker is not None:
+            breaker_status = breaker.status()
+            failures = breaker_status['failures']
+            error = breaker_status['error']
+            if breaker_status['state'] is BreakerState.open:
+                probe_at = datetime.utcfromtimestamp(
+                    int(breaker_status['probe_at']))
+                print(_('Outgoing deliveries are paused until $probe_at UTC, '
+                        'after $failures connection failures: $error'))
+            elif breaker_status['state'] is BreakerState.half_open:
+                print(_('Outgoing deliveries are about to be retried, '
+                        'after $failures connection failures: $error'))
         return status.value
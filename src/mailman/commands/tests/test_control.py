@@ -18,6 +18,7 @@
 """Test some additional corner cases for starting/stopping."""
 
 __all__ = [
+    'TestScale',
     'TestStart',
     'find_master',
     'make_config',
@@ -34,9 +35,11 @@ import socket
 import unittest
 
 from datetime import timedelta, datetime
-from mailman.commands.cli_control import Start, kill_watcher
+from mailman.commands.cli_control import Scale, Start, kill_watcher
 from mailman.config import config
+from mailman.core.switchboard import get_slice_count
 from mailman.testing.layers import ConfigLayer
+from unittest.mock import patch
 
 
 SEP = '|'
@@ -159,3 +162,39 @@ class TestStart(unittest.TestCase):
         self.command.process(self.args)
         pid = find_master()
         self.assertNotEqual(pid, None)
+
+
+
+class TestScale(unittest.TestCase):
+    """Test scaling a queue's runners."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        self.command = Scale()
+        self.command.parser = FakeParser()
+        self.args = FakeArgs()
+
+    def test_scale(self):
+        self.args.queue = ['out']
+        self.args.instances = [6]
+        with patch('mailman.commands.cli_control.kill_watcher') as kill:
+            self.command.process(self.args)
+        kill.assert_called_once_with(signal.SIGUSR2)
+        queue_directory = config.switchboards['out'].queue_directory
+        self.assertEqual(get_slice_count(queue_directory, 1), 6)
+
+    def test_no_such_queue(self):
+        self.args.queue = ['bogus']
+        self.args.instances = [6]
+        with self.assertRaises(SystemExit):
+            self.command.process(self.args)
+        self.assertEqual(self.command.parser.message, 'No such queue: bogus')
+
+    def test_bad_instances(self):
+        self.args.queue = ['out']
+        self.args.instances = [0]
+        with self.assertRaises(SystemExit):
+            self.command.process(self.args)
+        self.assertEqual(self.command.parser.message,
+                         'Bad number of instances: 0')
@@ -0,0 +1,259 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Parking queue entries until they are due.
+
+Messages which can't be delivered yet, either because their `deliver_after`
+time hasn't come or because they are waiting to be retried, are parked in the
+delay queue.  Each entry is written once, to a file named after the time it is
+due, and stays put until it is released into another queue.  The file names
+make up the heap of the entries, which the releaser keeps in memory and only
+rebuilds when the directory changes, or when the rescan interval has passed.
+"""
+
+__all__ = [
+    'DelayQueue',
+    'get_delay_queue',
+    ]
+
+
+import os
+import time
+import heapq
+import pickle
+import hashlib
+import logging
+
+from datetime import datetime
+from lazr.config import as_timedelta
+from mailman.config import config
+from mailman.utilities.datetime import now as right_now, utc
+from mailman.utilities.filesystem import makedirs
+
+
+log = logging.getLogger('mailman.runner')
+
+# The number of seconds between full listings of the directory.
+DEFAULT_RESCAN_INTERVAL = 300
+# How coarse directory modification times can be, in seconds.  An entry
+# parked within this long of a listing may leave the time unchanged.
+MTIME_RESOLUTION = 2
+
+
+
+def _timestamp(when):
+    # Mailman's datetimes are naive, but in UTC.
+    return when.replace(tzinfo=utc).timestamp()
+
+
+def _due(filebase):
+    return float(filebase.split('+', 1)[0])
+
+
+
+class DelayQueue:
+    """Entries parked until they are due."""
+
+    def __init__(self, directory, wakeup_directory=None,
+                 rescan_interval=DEFAULT_RESCAN_INTERVAL):
+        """Create a delay queue.
+
+        :param directory: The directory holding the parked entries.
+        :type directory: string
+        :param wakeup_directory: The directory watched by the releaser, which
+            is touched whenever an entry is parked.
+        :type wakeup_directory: string
+        :param rescan_interval: The number of seconds after which the
+            directory is listed again, even if it doesn't seem to have
+            changed.
+        :type rescan_interval: float
+        """
+        self.directory = directory
+        self._wakeup_directory = wakeup_directory
+        self._rescan_interval = rescan_interval
+        if config.create_paths:
+            makedirs(self.directory, 0o770)
+        # The heap of (due, filebase) and its file bases, as of the last time
+        # the directory was seen to change.
+        self._heap = []
+        self._indexed = set()
+        self._mtime = None
+        self._rescan_at = 0
+
+    def park(self, msg, msgdata, due):
+        """Park an entry until it is due.
+
+        :param msg: The message.
+        :type msg: `Message`
+        :param msgdata: The message metadata.
+        :type msgdata: dict
+        :param due: When the entry is to be released.
+        :type due: `datetime`
+        :return: The entry's file base.
+        :rtype: string
+        """
+        payload = (pickle.dumps(msg, pickle.HIGHEST_PROTOCOL) +
+                   pickle.dumps(msgdata, pickle.HIGHEST_PROTOCOL))
+        hashfood = payload + repr(time.time()).encode('utf-8')
+        filebase = '{0:.6f}+{1}'.format(
+            _timestamp(due), hashlib.sha1(hashfood).hexdigest())
+        filename = os.path.join(self.directory, filebase + '.pck')
+        with open(filename + '.tmp', 'wb') as fp:
+            fp.write(payload)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(filename + '.tmp', filename)
+        if self._wakeup_directory is not None:
+            os.utime(self._wakeup_directory)
+        return filebase
+
+    def _refresh(self):
+        """Pick up the entries parked since the directory was last listed."""
+        mtime = os.stat(self.directory).st_mtime_ns
+        now = time.time()
+        if mtime == self._mtime and now < self._rescan_at:
+            return
+        self._mtime = mtime
+        # Anything parked after the listing changes the time again, unless
+        # it happens within the same tick of a coarse clock.  In that case,
+        # the listing is only good until the next refresh.
+        if now - mtime / 1e9 > MTIME_RESOLUTION:
+            self._rescan_at = now + self._rescan_interval
+        else:
+            self._rescan_at = now
+        filebases = set(filename[:-4]
+                        for filename in os.listdir(self.directory)
+                        if filename.endswith('.pck'))
+        for filebase in filebases - self._indexed:
+            heapq.heappush(self._heap, (_due(filebase), filebase))
+        # Entries released by someone else are dropped when they come up.
+        self._indexed = filebases
+
+    @property
+    def files(self):
+        """The file bases of the parked entries, in the order they are due."""
+        self._refresh()
+        return [filebase for due, filebase in sorted(self._heap)
+                if filebase in self._indexed]
+
+    def get(self, filebase):
+        """Read a parked entry.
+
+        :param filebase: The entry's file base.
+        :type filebase: string
+        :return: 3-tuple of when the entry is due, the message and the
+            metadata.
+        """
+        filename = os.path.join(self.directory, filebase + '.pck')
+        with open(filename, 'rb') as fp:
+            msg = pickle.load(fp)
+            msgdata = pickle.load(fp)
+        return datetime.utcfromtimestamp(_due(filebase)), msg, msgdata
+
+    def next_due(self):
+        """Return when the next entry is due.
+
+        :return: When the earliest parked entry is due, or None if there are
+            no parked entries.
+        :rtype: `datetime`
+        """
+        self._refresh()
+        while len(self._heap) > 0:
+            due, filebase = self._heap[0]
+            if filebase in self._indexed:
+                return datetime.utcfromtimestamp(due)
+            heapq.heappop(self._heap)
+        return None
+
+    def release(self, switchboard, now=None):
+        """Move the entries which are due into a queue.
+
+        :param switchboard: The queue to move the entries to.
+        :type switchboard: `ISwitchboard`
+        :param now: The current time, for testing.
+        :type now: `datetime`
+        :return: The number of entries released.
+        :rtype: integer
+        """
+        if now is None:
+            now = right_now()
+        self._refresh()
+        timestamp = _timestamp(now)
+        released = 0
+        while len(self._heap) > 0 and self._heap[0][0] <= timestamp:
+            due, filebase = heapq.heappop(self._heap)
+            if filebase not in self._indexed:
+                continue
+            self._indexed.discard(filebase)
+            filename = os.path.join(self.directory, filebase + '.pck')
+            backfile = os.path.join(self.directory, filebase + '.bak')
+            # Claim the entry, so that it is only released once.  If we crash
+            # before it has been enqueued, the backup file is recovered.
+            try:
+                os.rename(filename, backfile)
+            except FileNotFoundError:
+                continue
+            try:
+                with open(backfile, 'rb') as fp:
+                    msg = pickle.load(fp)
+                    msgdata = pickle.load(fp)
+            except Exception:
+                # Preserve the entry for analysis, as the runners do with the
+                # entries they can't dequeue.  Left as a backup file, it would
+                # be recovered and fail again on every restart.
+                log.exception('Cannot release parked entry: %s', filebase)
+                self._preserve(filebase)
+                continue
+            switchboard.enqueue(msg, msgdata)
+            os.remove(backfile)
+            released += 1
+        return released
+
+    def _preserve(self, filebase):
+        """Move an unreadable entry's backup file to the bad queue."""
+        backfile = os.path.join(self.directory, filebase + '.bak')
+        bad_dir = config.switchboards['bad'].queue_directory
+        psvfile = os.path.join(bad_dir, filebase + '.psv')
+        try:
+            os.rename(backfile, psvfile)
+        except EnvironmentError:
+            log.exception('Failed to preserve parked entry: %s', backfile)
+        else:
+            log.error('Skipping and preserving unreadable parked entry: %s',
+                      psvfile)
+
+    def recover_backup_files(self):
+        """Put back the entries which were being released during a crash."""
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.bak'):
+                path = os.path.join(self.directory, filename)
+                os.rename(path, path[:-4] + '.pck')
+
+
+
+def get_delay_queue():
+    """Return the delay queue.
+
+    The parked entries live with the retry queue, whose runner releases them.
+
+    :rtype: `DelayQueue`
+    """
+    retry_directory = config.switchboards['retry'].queue_directory
+    section = getattr(config, 'runner.retry')
+    return DelayQueue(os.path.join(retry_directory, '.delayed'),
+                      retry_directory,
+                      as_timedelta(section.reconcile_interval).total_seconds())
@@ -0,0 +1,381 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Queuing and dequeuing through segmented, memory-mapped log files.
+
+Instead of writing one file per message, this switchboard appends each
+message/metadata pair to the newest of a series of fixed size segment files in
+the queue directory.  Every segment starts with a small header recording how
+many of its bytes have been committed, and every entry starts with a state
+byte recording whether it is committed, claimed (i.e. the equivalent of a
+.bak file) or finished.  Together these form the queue's index, so dequeuing
+and finishing an entry only flips a byte in the memory-mapped segment.  Once
+all the entries in a segment have been finished, and the segment is no longer
+the one being appended to, its file is removed.
+"""
+
+__all__ = [
+    'LogSwitchboard',
+    ]
+
+
+import io
+import os
+import mmap
+import errno
+import fcntl
+import struct
+import logging
+
+from contextlib import contextmanager
+from mailman.config import config
+from mailman.core.switchboard import MAX_BAK_COUNT, Switchboard, _try_lock
+
+
+# The segment header holds a magic number and the committed length of the
+# segment, i.e. the offset at which the next entry will be appended.
+SEGMENT_HEADER = struct.Struct('!4sQ4x')
+SEGMENT_MAGIC = b'MQL1'
+SEGMENT_SUFFIX = '.seg'
+# Each entry header holds the entry's state, the number of times the entry
+# has been recovered from the claimed state, the length of the file base and
+# the length of the serialized message and metadata.
+ENTRY_HEADER = struct.Struct('!BBHI')
+COMMITTED = 1
+CLAIMED = 2
+FINISHED = 3
+# Used when the queue has no runner section to take the segment size from.
+DEFAULT_SEGMENT_SIZE = 8388608
+LOCK_FILE = '.lock'
+
+elog = logging.getLogger('mailman.error')
+
+
+
+class _Segment:
+    """A single memory-mapped segment file."""
+
+    def __init__(self, path, sequence):
+        self.path = path
+        self.sequence = sequence
+        # (offset, filebase) for every entry scanned so far, in append order.
+        self.entries = []
+        self._scanned = SEGMENT_HEADER.size
+        # The file stays open because claimed entries are locked through it.
+        self._fp = open(path, 'r+b')
+        self._map = mmap.mmap(self._fp.fileno(), 0)
+
+    @classmethod
+    def create(cls, path, sequence, size):
+        """Create a new, empty segment file of the given size."""
+        # Create the segment under a temporary name so that other processes
+        # never see a segment without a valid header.
+        tmpfile = path + '.tmp'
+        with open(tmpfile, 'wb') as fp:
+            fp.truncate(size)
+            fp.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, SEGMENT_HEADER.size))
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(tmpfile, path)
+        return cls(path, sequence)
+
+    @property
+    def committed(self):
+        magic, committed = SEGMENT_HEADER.unpack_from(self._map, 0)
+        assert magic == SEGMENT_MAGIC, 'Bad segment file: {}'.format(
+            self.path)
+        return committed
+
+    @property
+    def free(self):
+        return len(self._map) - self.committed
+
+    def append(self, entry, sync=True):
+        """Append an entry, committing it and optionally syncing to disk."""
+        offset = self.committed
+        self._map[offset:offset + len(entry)] = entry
+        # The entry isn't visible to readers until the header says so.
+        SEGMENT_HEADER.pack_into(
+            self._map, 0, SEGMENT_MAGIC, offset + len(entry))
+        if sync:
+            self._map.flush()
+        return offset
+
+    def flush(self):
+        """Sync the segment to disk."""
+        # The segment may have been reclaimed since it was written to.
+        if not self._map.closed:
+            self._map.flush()
+
+    def scan(self):
+        """Pick up any entries committed since the last scan."""
+        committed = self.committed
+        while self._scanned < committed:
+            offset = self._scanned
+            state, bak_count, filebase_size, payload_size = (
+                ENTRY_HEADER.unpack_from(self._map, offset))
+            start = offset + ENTRY_HEADER.size
+            filebase = self._map[start:start + filebase_size].decode('ascii')
+            self.entries.append((offset, filebase))
+            self._scanned = start + filebase_size + payload_size
+            yield offset, filebase
+
+    @property
+    def done(self):
+        """True when every committed entry has been finished."""
+        # Make sure we've seen everything before answering.
+        for entry in self.scan():
+            pass
+        return all(self.get_state(offset) == FINISHED
+                   for offset, filebase in self.entries)
+
+    def get_state(self, offset):
+        return self._map[offset]
+
+    def set_state(self, offset, state):
+        self._map[offset] = state
+
+    def get_bak_count(self, offset):
+        return self._map[offset + 1]
+
+    def set_bak_count(self, offset, count):
+        self._map[offset + 1] = min(count, 255)
+
+    def lock(self, offset):
+        """Try to lock an entry, returning whether we got the lock."""
+        return _try_lock(self._fp, 1, offset)
+
+    def unlock(self, offset):
+        fcntl.lockf(self._fp.fileno(), fcntl.LOCK_UN, 1, offset)
+
+    def payload(self, offset):
+        state, bak_count, filebase_size, payload_size = (
+            ENTRY_HEADER.unpack_from(self._map, offset))
+        start = offset + ENTRY_HEADER.size + filebase_size
+        return self._map[start:start + payload_size]
+
+    def close(self):
+        self._map.close()
+        self._fp.close()
+
+
+
+class LogSwitchboard(Switchboard):
+    """See `ISwitchboard`.
+
+    Queue entries live in segmented, memory-mapped log files rather than in
+    individual .pck files.  The file bases handed out are the same as for the
+    file based switchboard so slicing and FIFO ordering work identically.
+    """
+
+    def __init__(self, name, queue_directory,
+                 slice=None, numslices=1, recover=False):
+        """See `Switchboard`."""
+        # sequence number -> _Segment
+        self._segments = {}
+        # filebase -> (sequence number, offset)
+        self._locations = {}
+        self._newest = None
+        self._lock_file = None
+        try:
+            section = getattr(config, 'runner.' + name)
+        except AttributeError:
+            self._segment_size = DEFAULT_SEGMENT_SIZE
+        else:
+            self._segment_size = int(section.segment_size)
+        super(LogSwitchboard, self).__init__(
+            name, queue_directory, slice, numslices, recover)
+
+    @contextmanager
+    def _locked(self):
+        """Serialize appends and state changes across processes."""
+        if self._lock_file is None:
+            self._lock_file = open(
+                os.path.join(self.queue_directory, LOCK_FILE), 'ab')
+        fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _segment_path(self, sequence):
+        return os.path.join(
+            self.queue_directory, '{:010d}{}'.format(sequence, SEGMENT_SUFFIX))
+
+    def _forget(self, sequence):
+        segment = self._segments.pop(sequence)
+        for offset, filebase in segment.entries:
+            self._locations.pop(filebase, None)
+        segment.close()
+
+    def _refresh(self):
+        """Bring our view of the segments up to date with the disk."""
+        sequences = set()
+        for filename in os.listdir(self.queue_directory):
+            base, ext = os.path.splitext(filename)
+            if ext == SEGMENT_SUFFIX:
+                sequences.add(int(base))
+        # Other processes may have reclaimed some segments.
+        for sequence in set(self._segments) - sequences:
+            self._forget(sequence)
+        for sequence in sorted(sequences):
+            segment = self._segments.get(sequence)
+            if segment is None:
+                try:
+                    segment = _Segment(self._segment_path(sequence), sequence)
+                except FileNotFoundError:
+                    # It was reclaimed out from under us.
+                    continue
+                self._segments[sequence] = segment
+            for offset, filebase in segment.scan():
+                self._locations[filebase] = (sequence, offset)
+        if len(sequences) > 0:
+            self._newest = max(sequences)
+
+    def _locate(self, filebase):
+        location = self._locations.get(filebase)
+        if location is None:
+            self._refresh()
+            location = self._locations.get(filebase)
+            if location is None:
+                raise FileNotFoundError(
+                    errno.ENOENT, 'No such queue entry', filebase)
+        sequence, offset = location
+        return self._segments[sequence], offset
+
+    def _reclaim(self):
+        """Remove all fully finished segments but the newest."""
+        for sequence in sorted(self._segments):
+            if sequence >= self._newest:
+                break
+            segment = self._segments[sequence]
+            if segment.done:
+                os.unlink(segment.path)
+                self._forget(sequence)
+
+    def _write(self, filebase, payload):
+        """See `Switchboard`."""
+        encoded = filebase.encode('ascii')
+        entry = ENTRY_HEADER.pack(
+            COMMITTED, 0, len(encoded), len(payload)) + encoded + payload
+        with self._locked():
+            self._refresh()
+            segment = (None if self._newest is None
+                       else self._segments.get(self._newest))
+            if segment is None or segment.free < len(entry):
+                sequence = (0 if self._newest is None else self._newest + 1)
+                size = max(self._segment_size,
+                           SEGMENT_HEADER.size + len(entry))
+                segment = _Segment.create(
+                    self._segment_path(sequence), sequence, size)
+                self._segments[sequence] = segment
+                self._newest = sequence
+                # The previous segments will never be appended to again.
+                self._reclaim()
+            # Unlike .pck files, entries are visible as soon as they are
+            # appended, so a group commit can only defer syncing them.
+            group = self._group_commit()
+            offset = segment.append(
+                entry, sync=(self._durability != 'buffered' and group is None))
+            if group is not None:
+                group.sync(segment.path, segment.flush)
+        self._locations[filebase] = (segment.sequence, offset)
+        # No file is moved into the queue directory, so touch the directory
+        # to wake up any runners watching it.
+        os.utime(self.queue_directory)
+
+    def dequeue(self, filebase):
+        """See `ISwitchboard`."""
+        with self._locked():
+            segment, offset = self._locate(filebase)
+            if segment.get_state(offset) != COMMITTED:
+                raise FileNotFoundError(
+                    errno.ENOENT, 'Queue entry is not committed', filebase)
+            # This is the equivalent of renaming the .pck file to .bak.  The
+            # lock tells other processes that we're still working on it.
+            segment.set_state(offset, CLAIMED)
+            segment.lock(offset)
+            bak_count = segment.get_bak_count(offset)
+            payload = segment.payload(offset)
+        msg, data = self._deserialize(io.BytesIO(payload))
+        if bak_count > 0:
+            data['_bak_count'] = bak_count
+        return msg, data
+
+    def _finish(self, filebase, preserve):
+        # The lock must be held.
+        segment, offset = self._locate(filebase)
+        if preserve:
+            bad_dir = config.switchboards['bad'].queue_directory
+            psvfile = os.path.join(bad_dir, filebase + '.psv')
+            with open(psvfile, 'wb') as fp:
+                fp.write(segment.payload(offset))
+        segment.set_state(offset, FINISHED)
+        segment.unlock(offset)
+        if segment.sequence != self._newest and segment.done:
+            os.unlink(segment.path)
+            self._forget(segment.sequence)
+
+    def _finish_entry(self, filebase, preserve):
+        """See `Switchboard`."""
+        try:
+            with self._locked():
+                self._finish(filebase, preserve)
+        except EnvironmentError:
+            elog.exception(
+                'Failed to finish/preserve queue entry: %s', filebase)
+
+    def get_files(self, extension='.pck'):
+        """See `ISwitchboard`.
+
+        Committed entries are reported as the .pck files, and claimed entries
+        are reported as the .bak files.  Entries are returned in the order
+        they were appended, which is FIFO order.
+        """
+        wanted = {'.pck': COMMITTED, '.bak': CLAIMED}.get(extension)
+        if wanted is None:
+            return []
+        self._refresh()
+        files = []
+        for sequence in sorted(self._segments):
+            segment = self._segments[sequence]
+            for offset, filebase in segment.entries:
+                if (segment.get_state(offset) == wanted and
+                        self._in_slice(filebase)):
+                    files.append(filebase)
+        return files
+
+    def recover_backup_files(self):
+        """See `ISwitchboard`."""
+        # Move all claimed entries in our slice back to the committed state,
+        # counting the number of times we do this.  When the count reaches
+        # MAX_BAK_COUNT, the entry is preserved in the bad queue instead.
+        with self._locked():
+            for filebase in self.get_files('.bak'):
+                segment, offset = self._locate(filebase)
+                if not segment.lock(offset):
+                    # Another runner is still working on this entry.
+                    continue
+                bak_count = segment.get_bak_count(offset) + 1
+                segment.set_bak_count(offset, bak_count)
+                if bak_count >= MAX_BAK_COUNT:
+                    elog.error('.bak file max count, preserving file: %s',
+                               filebase)
+                    self._finish(filebase, preserve=True)
+                else:
+                    segment.set_state(offset, COMMITTED)
+                    segment.unlock(offset)
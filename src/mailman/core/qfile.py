@@ -0,0 +1,288 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The raw queue file format.
+
+Pickling a parsed message ties the queue files to the layout of the email
+package's classes, and every runner pays for unpickling the whole MIME tree,
+even if all it does is pass the message on.  Instead, this format stores the
+message exactly as bytes, along with a compact JSON record of the metadata.
+The message is only parsed when a runner first looks inside it.
+
+A queue file in this format starts with `MAGIC`, followed by a version byte
+and the length of the JSON record, the record itself, and then the message
+bytes.  JSON has no types for things like dates and sets, so these are
+stored as tagged objects.  Anything else which can't be represented raises a
+TypeError, in which case the caller should fall back to pickling.
+"""
+
+__all__ = [
+    'MAGIC',
+    'dumps',
+    'load_metadata',
+    'loads',
+    'replace_metadata',
+    ]
+
+
+import json
+import uuid
+import email
+import base64
+import struct
+import datetime
+
+from mailman.email.message import Message
+from mailman.utilities.modules import find_name
+
+
+# Pickles never start with a NUL byte, so this tells the two formats apart.
+MAGIC = b'\0MQF'
+VERSION = 1
+# The version byte and the length of the JSON record.
+HEADER = struct.Struct('>BI')
+# The key marking a tagged object in the JSON record.
+TAG = '!'
+
+# The attributes making up the state of a parsed message.  Any other
+# instance attributes are stored in the JSON record.
+_STATE = frozenset(Message().__dict__)
+
+
+
+def _encode_datetime(value):
+    if value.tzinfo is None:
+        offset = None
+    elif type(value.tzinfo) is datetime.timezone:
+        offset = value.utcoffset().total_seconds()
+    else:
+        raise TypeError('Unsupported time zone: {!r}'.format(value.tzinfo))
+    return [value.year, value.month, value.day, value.hour, value.minute,
+            value.second, value.microsecond, offset]
+
+
+def _decode_datetime(value):
+    offset = value.pop()
+    tzinfo = (None if offset is None
+              else datetime.timezone(datetime.timedelta(seconds=offset)))
+    return datetime.datetime(*value, tzinfo=tzinfo)
+
+
+_ENCODERS = {
+    tuple: ('tuple', lambda value: [_encode(item) for item in value]),
+    set: ('set', lambda value: [_encode(item) for item in value]),
+    frozenset: ('frozenset', lambda value: [_encode(item) for item in value]),
+    bytes: ('bytes', lambda value: base64.b64encode(value).decode('ascii')),
+    datetime.datetime: ('datetime', _encode_datetime),
+    datetime.date: ('date', lambda value: value.toordinal()),
+    datetime.timedelta: ('timedelta', lambda value: [
+        value.days, value.seconds, value.microseconds]),
+    uuid.UUID: ('uuid', lambda value: value.hex),
+    }
+
+_DECODERS = {
+    'dict': lambda value: dict(value),
+    'tuple': tuple,
+    'set': set,
+    'frozenset': frozenset,
+    'bytes': lambda value: base64.b64decode(value.encode('ascii')),
+    'datetime': _decode_datetime,
+    'date': datetime.date.fromordinal,
+    'timedelta': lambda value: datetime.timedelta(*value),
+    'uuid': lambda value: uuid.UUID(hex=value),
+    }
+
+
+def _encode(value):
+    # Subclasses, such as enums, are deliberately not matched here, since
+    # they would not come back as the same type.
+    kind = type(value)
+    if value is None or kind in (bool, int, float, str):
+        return value
+    if kind is list:
+        return [_encode(item) for item in value]
+    if kind is dict:
+        if TAG not in value and all(type(key) is str for key in value):
+            return {key: _encode(item) for key, item in value.items()}
+        return {TAG: 'dict',
+                'value': [[_encode(key), _encode(item)]
+                          for key, item in value.items()]}
+    if kind not in _ENCODERS:
+        raise TypeError('Cannot store {!r} in a queue file'.format(kind))
+    tag, encoder = _ENCODERS[kind]
+    return {TAG: tag, 'value': encoder(value)}
+
+
+def _decode(record):
+    # This is called for every JSON object, innermost first.
+    if TAG in record:
+        return _DECODERS[record[TAG]](record['value'])
+    return record
+
+
+
+class _Unparsed:
+    """Mix-in for messages which haven't been parsed yet.
+
+    The message bytes are kept in the `_qfile_raw` attribute.  The first time
+    any of the parsed message's state is needed, the bytes are parsed and the
+    message becomes an ordinary instance of its class.
+    """
+
+    def __getattr__(self, name):
+        if name not in _STATE:
+            raise AttributeError(name)
+        self._parse()
+        return getattr(self, name)
+
+    def __reduce_ex__(self, protocol):
+        # Pickle and copy the parsed message.
+        self._parse()
+        return self.__reduce_ex__(protocol)
+
+    def _parse(self):
+        raw = self.__dict__.pop('_qfile_raw')
+        parsed = email.message_from_bytes(raw, Message)
+        self.__dict__.update(parsed.__dict__)
+        self.__class__ = self._qfile_class
+
+
+_unparsed_classes = {}
+
+def _unparsed(message_class):
+    """Return the unparsed variant of a message class."""
+    unparsed_class = _unparsed_classes.get(message_class)
+    if unparsed_class is None:
+        unparsed_class = type(message_class.__name__,
+                              (_Unparsed, message_class),
+                              dict(_qfile_class=message_class))
+        _unparsed_classes[message_class] = unparsed_class
+    return unparsed_class
+
+
+
+def dumps(msg, msgdata, text=False):
+    """Serialize a message and its metadata.
+
+    :param msg: The message.
+    :type msg: `Message`
+    :param msgdata: The message metadata.
+    :type msgdata: dict
+    :param text: Whether the message should be stored as text, and parsed
+        again as soon as it's loaded.
+    :type text: bool
+    :return: 2-tuple of the message bytes, and the serialized entry.
+    :raises TypeError: when the message or metadata can't be stored in this
+        format.
+    :raises UnicodeError: when the message can't be turned into bytes.
+    """
+    if not isinstance(msg, Message):
+        raise TypeError('Not a Message: {!r}'.format(type(msg)))
+    if isinstance(msg, _Unparsed):
+        message_class = msg._qfile_class
+        raw = msg._qfile_raw
+    else:
+        message_class = type(msg)
+        if text:
+            raw = str(msg).encode('utf-8', 'surrogateescape')
+        else:
+            raw = msg.as_bytes()
+    attributes = {key: value for key, value in msg.__dict__.items()
+                  if key not in _STATE and key != '_qfile_raw'}
+    record = dict(
+        data=_encode(msgdata),
+        attributes=_encode(attributes),
+        )
+    if message_class is not Message:
+        if message_class.__qualname__ != message_class.__name__:
+            raise TypeError('Cannot store {!r} in a queue file'.format(
+                message_class))
+        record['class'] = '{}.{}'.format(
+            message_class.__module__, message_class.__qualname__)
+    if text:
+        record['text'] = True
+    record = json.dumps(record, separators=(',', ':')).encode('utf-8')
+    header = MAGIC + HEADER.pack(VERSION, len(record))
+    return raw, header + record + raw
+
+
+def _split(entry):
+    if not entry.startswith(MAGIC):
+        raise ValueError('Not a queue file')
+    start = len(MAGIC) + HEADER.size
+    version, length = HEADER.unpack(entry[len(MAGIC):start])
+    if version != VERSION:
+        raise ValueError('Unknown queue file version: {}'.format(version))
+    record = json.loads(entry[start:start + length].decode('utf-8'),
+                        object_hook=_decode)
+    return record, entry[start + length:]
+
+
+def loads(entry):
+    """Load a message and its metadata.
+
+    Unless it was stored as text, the message isn't parsed until it is used.
+
+    :param entry: The serialized entry.
+    :type entry: bytes
+    :return: 2-tuple of the message and metadata.
+    """
+    record, raw = _split(entry)
+    data = record['data']
+    if record.get('text'):
+        # As with pickled text, calculate the original size now so that we
+        # won't have to generate the message later for size checks.
+        text = raw.decode('utf-8', 'surrogateescape')
+        msg = email.message_from_string(text, Message)
+        msg.original_size = data['original_size'] = len(text)
+        msg.__dict__.update(record['attributes'])
+        return msg, data
+    message_class = find_name(record.get(
+        'class', 'mailman.email.message.Message'))
+    msg = _unparsed(message_class).__new__(_unparsed(message_class))
+    msg.__dict__.update(record['attributes'])
+    msg._qfile_raw = raw
+    return msg, data
+
+
+def load_metadata(entry):
+    """Load just the metadata of a serialized entry.
+
+    :param entry: The serialized entry.
+    :type entry: bytes
+    :return: The message metadata.
+    :rtype: dict
+    """
+    record, raw = _split(entry)
+    return record['data']
+
+
+def replace_metadata(entry, msgdata):
+    """Replace the metadata of a serialized entry.
+
+    :param entry: The serialized entry.
+    :type entry: bytes
+    :param msgdata: The new message metadata.
+    :type msgdata: dict
+    :return: The new serialized entry.
+    :rtype: bytes
+    """
+    record, raw = _split(entry)
+    record['data'] = _encode(msgdata)
+    record['attributes'] = _encode(record['attributes'])
+    record = json.dumps(record, separators=(',', ':')).encode('utf-8')
+    return MAGIC + HEADER.pack(VERSION, len(record)) + record + raw
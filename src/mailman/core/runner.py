@@ -27,15 +27,19 @@ import signal
 import logging
 import traceback
 
+from contextlib import ExitStack
 from io import StringIO
+from itertools import islice
 from lazr.config import as_boolean, as_timedelta
 from mailman.config import config
 from mailman.core.i18n import _
 from mailman.core.logging import reopen
-from mailman.core.switchboard import Switchboard
+from mailman.core.switchboard import group_commit, handoff
+from mailman.core.watcher import make_watcher
 from mailman.interfaces.languages import ILanguageManager
 from mailman.interfaces.listmanager import IListManager
 from mailman.interfaces.runner import IRunner, RunnerCrashEvent
+from mailman.utilities.modules import find_name
 from mailman.utilities.string import expand
 from zope.component import getUtility
 from zope.event import notify
@@ -70,7 +74,8 @@ class Runner:
         # should not have queue_directory or switchboard instance.
         if self.is_queue_runner:
             self.queue_directory = expand(section.path, substitutions)
-            self.switchboard = Switchboard(
+            switchboard_class = find_name(section.switchboard)
+            self.switchboard = switchboard_class(
                 name, self.queue_directory, slice, numslices, True)
         else:
             self.queue_directory = None
@@ -80,6 +85,14 @@ class Runner:
         self.sleep_float = (86400 * self.sleep_time.days +
                             self.sleep_time.seconds +
                             self.sleep_time.microseconds / 1.0e6)
+        self.wakeup = section.wakeup
+        self.poll_interval = as_timedelta(
+            section.poll_interval).total_seconds()
+        self._watcher = None
+        self._catch_up_at = 0
+        self.batch_size = int(section.batch_size)
+        self.colocate = section.colocate.split()
+        self._taking_over = False
         self.max_restarts = int(section.max_restarts)
         self.start = as_boolean(section.start)
         self._stop = False
@@ -115,6 +128,20 @@ class Runner:
 
     def run(self):
         """See `IRunner`."""
+        # Make sure anything enqueued since we last ran is picked up.  The
+        # watcher is started first, so that the entries enqueued while we
+        # work through a backlog are noticed too.
+        if self.is_queue_runner:
+            self._watcher = make_watcher(
+                self.queue_directory, self.wakeup, self.poll_interval)
+            self.switchboard.notify(None)
+        # The entries we enqueue to colocated queues are processed right here
+        # by their own runner classes, instead of going through the disk.
+        handoffs = ExitStack()
+        for name in self.colocate:
+            section = getattr(config, 'runner.' + name)
+            runner = find_name(section['class'])(name, None)
+            handoffs.enter_context(handoff(name, runner._take_over))
         # Start the main loop for this runner.
         try:
             while True:
@@ -133,77 +160,184 @@ class Runner:
         except KeyboardInterrupt:
             pass
         finally:
+            handoffs.close()
+            if self._watcher is not None:
+                self._watcher.close()
+                self._watcher = None
             self._clean_up()
 
     def _one_iteration(self):
         """See `IRunner`."""
         me = self.__class__.__name__
         dlog.debug('[%s] starting oneloop', me)
-        # List all the files in our queue directory.  The switchboard is
-        # guaranteed to hand us the files in FIFO order.
-        files = self.switchboard.files
-        for filebase in files:
-            dlog.debug('[%s] processing filebase: %s', me, filebase)
+        # Get the files in our queue from the switchboard's index.  The
+        # switchboard is guaranteed to hand us the files in FIFO order.
+        filecnt = 0
+        files = self.switchboard.next_files()
+        while True:
+            if filecnt > 0:
+                self._catch_up()
+            batch = list(islice(files, self.batch_size))
+            if len(batch) == 0:
+                break
+            filecnt += len(batch)
+            if self.batch_size == 1:
+                self._process_entry(batch[0])
+                # Other work we want to do each time through the loop.
+                dlog.debug('[%s] doing periodic', me)
+                self._do_periodic()
+                dlog.debug('[%s] committing transaction', me)
+                config.db.commit()
+            else:
+                # Process the whole batch in one database transaction, with a
+                # savepoint per message so that a failing message can be
+                # rolled back on its own.  The queue entries written while
+                # processing the batch are synced together.
+                with group_commit():
+                    for filebase in batch:
+                        savepoint = config.db.store.begin_nested()
+                        self._process_entry(filebase, savepoint)
+                        if savepoint.is_active:
+                            savepoint.commit()
+                    dlog.debug('[%s] doing periodic', me)
+                    self._do_periodic()
+                    dlog.debug('[%s] committing batch of %s', me, len(batch))
+                    config.db.commit()
+            dlog.debug('[%s] checking short circuit', me)
+            if self._short_circuit():
+                dlog.debug('[%s] short circuiting', me)
+                break
+        dlog.debug('[%s] ending oneloop: %s', me, filecnt)
+        return filecnt
+
+    def _catch_up(self):
+        """Index the entries enqueued since the iteration started.
+
+        Otherwise, entries in higher priority lanes, or from other mailing
+        lists, would wait until the whole backlog has been worked through.
+        The watcher is checked at most once every poll interval.
+        """
+        if self._watcher is None:
+            return
+        now = time.time()
+        if now < self._catch_up_at:
+            return
+        self._catch_up_at = now + self.poll_interval
+        self.switchboard.notify(self._watcher.wait(0))
+
+    def _process_entry(self, filebase, savepoint=None):
+        """Dequeue, process and finish a single queue entry.
+
+        :param filebase: The file base of the queue entry.
+        :type filebase: str
+        :param savepoint: The savepoint to roll back to if processing fails,
+            or None to roll back the whole transaction.
+        """
+        me = self.__class__.__name__
+        dlog.debug('[%s] processing filebase: %s', me, filebase)
+        try:
+            # Ask the switchboard for the message and metadata objects
+            # associated with this queue file.
+            msg, msgdata = self.switchboard.dequeue(filebase)
+        except FileNotFoundError:
+            # The index was out of date; the entry is already gone.
+            dlog.debug('[%s] skipping missing filebase: %s', me, filebase)
+            return
+        except Exception as error:
+            # This used to just catch email.Errors.MessageParseError, but
+            # other problems can occur in message parsing, e.g. ValueError,
+            # and exceptions can occur in unpickling too.  We don't want the
+            # runner to die, so we just log and skip this entry, but preserve
+            # it for analysis.
+            self._log(error)
+            elog.error('Skipping and preserving unparseable message: %s',
+                       filebase)
+            self.switchboard.finish(filebase, preserve=True)
+            self._abort(savepoint)
+            return
+        try:
+            dlog.debug('[%s] processing onefile', me)
+            self._process_one_file(msg, msgdata)
+            dlog.debug('[%s] finishing filebase: %s', me, filebase)
+            self.switchboard.finish(filebase)
+        except Exception as error:
+            # All runners that implement _dispose() must guarantee that
+            # exceptions are caught and dealt with properly.  Still, there may
+            # be a bug in the infrastructure, and we do not want those to
+            # cause messages to be lost.  Any uncaught exceptions will cause
+            # the message to be stored in the shunt queue for human
+            # intervention.
+            self._log(error)
+            # Put a marker in the metadata for unshunting.
+            msgdata['whichq'] = self.switchboard.name
+            # It is possible that shunting can throw an exception, e.g. a
+            # permissions problem or a MemoryError due to a really large
+            # message.  Try to be graceful.
             try:
-                # Ask the switchboard for the message and metadata objects
-                # associated with this queue file.
-                msg, msgdata = self.switchboard.dequeue(filebase)
+                shunt = config.switchboards['shunt']
+                new_filebase = shunt.enqueue(msg, msgdata)
+                elog.error('SHUNTING: %s', new_filebase)
+                self.switchboard.finish(filebase)
             except Exception as error:
-                # This used to just catch email.Errors.MessageParseError, but
-                # other problems can occur in message parsing, e.g.
-                # ValueError, and exceptions can occur in unpickling too.  We
-                # don't want the runner to die, so we just log and skip this
-                # entry, but preserve it for analysis.
+                # The message wasn't successfully shunted.  Log the exception
+                # and try to preserve the original queue entry for possible
+                # analysis.
                 self._log(error)
-                elog.error('Skipping and preserving unparseable message: %s',
-                           filebase)
+                elog.error(
+                    'SHUNTING FAILED, preserving original entry: %s',
+                    filebase)
                 self.switchboard.finish(filebase, preserve=True)
-                config.db.abort()
-                continue
+            self._abort(savepoint)
+
+    def _take_over(self, msg, msgdata):
+        """Process an entry enqueued by a runner we're colocated with.
+
+        If our queue has a backlog, the entry is written to it, behind the
+        backlog.  Our queue's index is checked for this, so the directory is
+        only scanned when the index is missing or due to be rebuilt.
+
+        :return: True if the entry was dealt with, or False if it should be
+            written to our queue after all.
+        """
+        if self._taking_over:
+            # We're keeping the entry we're working on queued.
+            return False
+        # If our queue already has a backlog, this entry has to wait its turn
+        # like everything else in it.  It's written to the queue here, so
+        # that our index knows about it.
+        if not self.switchboard.is_empty():
+            self._taking_over = True
             try:
-                dlog.debug('[%s] processing onefile', me)
-                self._process_one_file(msg, msgdata)
-                dlog.debug('[%s] finishing filebase: %s', me, filebase)
-                self.switchboard.finish(filebase)
-            except Exception as error:
-                # All runners that implement _dispose() must guarantee that
-                # exceptions are caught and dealt with properly.  Still, there
-                # may be a bug in the infrastructure, and we do not want those
-                # to cause messages to be lost.  Any uncaught exceptions will
-                # cause the message to be stored in the shunt queue for human
-                # intervention.
-                self._log(error)
-                # Put a marker in the metadata for unshunting.
-                msgdata['whichq'] = self.switchboard.name
-                # It is possible that shunting can throw an exception, e.g. a
-                # permissions problem or a MemoryError due to a really large
-                # message.  Try to be graceful.
-                try:
-                    shunt = config.switchboards['shunt']
-                    new_filebase = shunt.enqueue(msg, msgdata)
-                    elog.error('SHUNTING: %s', new_filebase)
-                    self.switchboard.finish(filebase)
-                except Exception as error:
-                    # The message wasn't successfully shunted.  Log the
-                    # exception and try to preserve the original queue entry
-                    # for possible analysis.
-                    self._log(error)
-                    elog.error(
-                        'SHUNTING FAILED, preserving original entry: %s',
-                        filebase)
-                    self.switchboard.finish(filebase, preserve=True)
-                config.db.abort()
-            # Other work we want to do each time through the loop.
-            dlog.debug('[%s] doing periodic', me)
-            self._do_periodic()
-            dlog.debug('[%s] committing transaction', me)
-            config.db.commit()
-            dlog.debug('[%s] checking short circuit', me)
-            if self._short_circuit():
-                dlog.debug('[%s] short circuiting', me)
-                break
-        dlog.debug('[%s] ending oneloop: %s', me, len(files))
-        return len(files)
+                filebase = self.switchboard.enqueue(msg, msgdata)
+            finally:
+                self._taking_over = False
+            self.switchboard.notify([filebase + '.pck'])
+            return True
+        dlog.debug('[%s] taking over: %s', self.__class__.__name__,
+                   msg.get('message-id', 'n/a'))
+        savepoint = config.db.store.begin_nested()
+        self._taking_over = True
+        try:
+            self._process_one_file(msg, msgdata)
+        except Exception as error:
+            # Deal with it exactly as if we had dequeued the entry.
+            self._log(error)
+            self._abort(savepoint)
+            msgdata['whichq'] = self.switchboard.name
+            new_filebase = config.switchboards['shunt'].enqueue(msg, msgdata)
+            elog.error('SHUNTING: %s', new_filebase)
+        else:
+            savepoint.commit()
+        finally:
+            self._taking_over = False
+        return True
+
+    def _abort(self, savepoint):
+        """Roll back the changes made while processing an entry."""
+        if savepoint is None:
+            config.db.abort()
+        elif savepoint.is_active:
+            savepoint.rollback()
 
     def _process_one_file(self, msg, msgdata):
         """See `IRunner`."""
@@ -283,9 +417,32 @@ class Runner:
 
     def _snooze(self, filecnt):
         """See `IRunner`."""
-        if filecnt or self.sleep_float <= 0:
+        if self.is_queue_runner and self._watcher is None:
+            # Without a watcher, the only way to find the files enqueued
+            # while we were busy or asleep is to rescan the queue directory.
+            # This also covers files enqueued before the watcher was created.
+            self.switchboard.notify(None)
+        sleep_float = self._snooze_time()
+        if filecnt or sleep_float <= 0:
             return
-        time.sleep(self.sleep_float)
+        if self.is_queue_runner and self._watcher is None:
+            self._watcher = make_watcher(
+                self.queue_directory, self.wakeup, self.poll_interval)
+        if self._watcher is None:
+            time.sleep(sleep_float)
+            if self.is_queue_runner:
+                self.switchboard.notify(None)
+        else:
+            # Wake up as soon as something is enqueued, but no later than the
+            # sleep time so that periodic work still gets done.
+            self.switchboard.notify(self._watcher.wait(sleep_float))
+
+    def _snooze_time(self):
+        """Return the maximum number of seconds to snooze for.
+
+        Subclasses can override this to wake up earlier than the sleep time.
+        """
+        return self.sleep_float
 
     def _short_circuit(self):
         """See `IRunner`."""
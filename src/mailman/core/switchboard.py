@@ -22,33 +22,55 @@ subclass).  Metadata is represented as a Python dictionary.  For every
 message/metadata pair in a queue, a single file containing two pickles is
 written.  First, the message is written to the pickle, then the metadata
 dictionary is written.
+
+Queues can instead be configured to use the raw format in `mailman.core.qfile`,
+which stores the message bytes and a JSON metadata record.  Entries which
+can't be stored that way are still pickled, and both kinds of files can be
+read whatever the queue is configured to write.
 """
 
 __all__ = [
     'Switchboard',
+    'get_slice_count',
+    'group_commit',
     'handle_ConfigurationUpdatedEvent',
+    'handoff',
+    'set_slice_count',
     ]
 
 
 import os
 import time
 import email
+import errno
+import fcntl
+import heapq
 import pickle
+import bisect
 import hashlib
 import logging
 
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from lazr.config import as_boolean, as_timedelta
 from mailman.config import config
+from mailman.core import qfile
 from mailman.email.message import Message
 from mailman.interfaces.configuration import ConfigurationUpdatedEvent
 from mailman.interfaces.switchboard import ISwitchboard
 from mailman.utilities.filesystem import makedirs
+from mailman.utilities.modules import find_name
 from mailman.utilities.string import expand
 from zope.interface import implementer
 
 
-# 20 bytes of all bits set, maximum hashlib.sha.digest() value.  We do it this
-# way for Python 2/3 compatibility.
-shamax = int('0xffffffffffffffffffffffffffffffffffffffff', 16)
+# The number of points each slice gets on the hash ring.  More points spread
+# the queue entries more evenly between the slices.
+RING_POINTS = 100
+# The file in a queue directory which holds the current number of slices the
+# queue is split into, if it has been changed since the runners started.
+SLICES_FILE = '.slices'
 # Small increment to add to time in case two entries have the same time.  This
 # prevents skipping one of two entries with the same time until the next pass.
 DELTA = .0001
@@ -56,9 +78,214 @@ DELTA = .0001
 # In order to prevent loops and a message flood, when the count reaches this
 # value, we move the file to the bad queue as a .psv.
 MAX_BAK_COUNT = 3
+# The priority lanes entries are served from, highest first.  The lane is the
+# last part of the file base; entries without one are in the normal lane.
+HIGH_LANE = 0
+NORMAL_LANE = 1
+BULK_LANE = 2
+LANES = dict(high=HIGH_LANE, normal=NORMAL_LANE, bulk=BULK_LANE)
+# Metadata keys marking entries, such as notifications to the list owners
+# and moderators, which should jump ahead of ordinary traffic.
+HIGH_LANE_KEYS = ('_fasttrack', 'tomoderators', 'toowner', 'to_owner')
+# Used when the queue has no runner section to take the reconciliation
+# interval and so on from.
+DEFAULT_RECONCILE_INTERVAL = 300
+DEFAULT_DURABILITY = 'fsync'
+DEFAULT_QFILE_FORMAT = 'pickle'
+DEFAULT_BULK_RECIPIENTS = 1000
+DEFAULT_STARVATION_LIMIT = 10
+DEFAULT_FAIR_QUANTUM = 100
 
 elog = logging.getLogger('mailman.error')
 
+# The group commit in progress, if any.
+_group = None
+# Queue name -> function taking over the entries enqueued to that queue in
+# this process.  See handoff().
+_handoffs = {}
+
+
+
+class _GroupCommit:
+    """Queue operations deferred until the end of a group commit."""
+
+    def __init__(self):
+        # Callables which make the written entries durable, keyed so that
+        # each one is only called once.
+        self._syncs = {}
+        # (temporary file, final file) pairs to rename.
+        self._renames = []
+        # Callables to call once everything else is done.
+        self._finishes = []
+
+    def sync(self, key, function):
+        self._syncs.setdefault(key, function)
+
+    def rename(self, tmpfile, filename):
+        self._renames.append((tmpfile, filename))
+
+    def finish(self, function, *args):
+        self._finishes.append((function, args))
+
+    def commit(self):
+        for function in self._syncs.values():
+            function()
+        for tmpfile, filename in self._renames:
+            os.rename(tmpfile, filename)
+        for function, args in self._finishes:
+            function(*args)
+
+    def discard(self):
+        for tmpfile, filename in self._renames:
+            try:
+                os.remove(tmpfile)
+            except FileNotFoundError:
+                pass
+
+
+
+@contextmanager
+def group_commit():
+    """Group the queue operations of a batch of messages.
+
+    Inside the context, entries enqueued into queues with `group` durability
+    are written but not synced to disk, and finishing an entry is deferred.
+    When the context exits normally, all the new entries are synced and made
+    visible, and only then are the finished entries removed.  If the context
+    exits with an exception, the new entries are thrown away and the entries
+    which would have been finished are left as backup files, to be recovered
+    when the runner restarts.
+    """
+    global _group
+    assert _group is None, 'Group commits cannot be nested'
+    group = _group = _GroupCommit()
+    try:
+        yield
+    except:
+        group.discard()
+        raise
+    finally:
+        _group = None
+    group.commit()
+
+
+@contextmanager
+def handoff(name, function):
+    """Hand the entries enqueued to a queue over to a function.
+
+    Inside the context, enqueuing an entry to the named queue in this process
+    first calls `function` with the message and the metadata, as the entry
+    would have been read back from the queue.  If it returns True, the entry
+    has been dealt with and nothing is written to the queue.
+
+    :param name: The queue name.
+    :type name: str
+    :param function: The function to hand entries over to.
+    :type function: callable taking the message and metadata, and returning
+        a boolean.
+    """
+    assert name not in _handoffs, 'Queue already handed off: {}'.format(name)
+    _handoffs[name] = function
+    try:
+        yield
+    finally:
+        del _handoffs[name]
+
+
+
+class _Lane:
+    """The entries waiting in one priority lane of a switchboard's index.
+
+    Entries are grouped into flows, one per mailing list, and the flows are
+    served by deficit round robin.  Each time round, a flow is credited with
+    its quantum, multiplied by its weight, and it is then served entries until
+    their costs, which are their recipient counts, use up its credit.
+    Within a flow, entries are served in FIFO order.  When the queue doesn't
+    share itself fairly between lists, everything is in a single flow.
+    """
+
+    def __init__(self, quantum, weights):
+        self._quantum = quantum
+        self._weights = weights
+        # flow -> heap of (received time, file base, cost) tuples.
+        self._flows = {}
+        self._deficits = {}
+        # The flows with waiting entries, the one whose turn it is first.
+        self._active = deque()
+        # Whether the current turn has started, i.e. the first flow has been
+        # credited with its quantum.
+        self._started = False
+        # The number of flows passed over since one was last served.
+        self._skipped = 0
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def push(self, when, filebase, flow, cost):
+        heap = self._flows.get(flow)
+        if heap is None:
+            heap = self._flows[flow] = []
+            self._deficits[flow] = 0
+            self._active.append(flow)
+        heapq.heappush(heap, (when, filebase, cost))
+        self._length += 1
+
+    def oldest(self):
+        """Return the received time of the longest waiting entry."""
+        return min(heap[0][0] for heap in self._flows.values())
+
+    def pop(self, oldest=False):
+        """Remove and return the file base of the next entry to serve.
+
+        :param oldest: If True, serve the longest waiting entry instead.
+        """
+        if oldest:
+            flow = min(self._flows, key=lambda flow: self._flows[flow][0])
+        else:
+            while True:
+                flow = self._active[0]
+                if not self._started:
+                    # This flow's turn begins.
+                    self._deficits[flow] += self._share(flow)
+                    self._started = True
+                if self._deficits[flow] >= self._flows[flow][0][2]:
+                    break
+                # This flow's turn is over.
+                self._active.rotate(-1)
+                self._started = False
+                self._skipped += 1
+                if self._skipped == len(self._active):
+                    self._catch_up()
+        heap = self._flows[flow]
+        when, filebase, cost = heapq.heappop(heap)
+        self._deficits[flow] = max(0, self._deficits[flow] - cost)
+        self._skipped = 0
+        self._length -= 1
+        if len(heap) == 0:
+            # Idle flows don't get to save up credit.
+            if self._active[0] == flow:
+                self._started = False
+            self._active.remove(flow)
+            del self._flows[flow]
+            del self._deficits[flow]
+        return filebase
+
+    def _catch_up(self):
+        # A whole round went by without any flow being able to afford its
+        # next entry.  Rather than going round again and again, credit every
+        # flow with the rounds it takes until one of them can.
+        rounds = min(
+            -(-(self._flows[flow][0][2] - self._deficits[flow]) //
+              self._share(flow))
+            for flow in self._active) - 1
+        for flow in self._active:
+            self._deficits[flow] += rounds * self._share(flow)
+        self._skipped = 0
+
+    def _share(self, flow):
+        return max(1, int(self._quantum * self._weights.get(flow, 1)))
+
 
 
 @implementer(ISwitchboard)
@@ -77,30 +304,97 @@ class Switchboard:
             None, it must be [0..`numslices`).
         :type slice: int or None
         :param numslices: The total number of slices to split this queue
-            directory into.  It must be a power of 2.
+            directory into.  This is overridden by the slice count recorded
+            in the queue directory, if there is one.
         :type numslices: int
         :param recover: True if backup files should be recovered.
         :type recover: bool
         """
-        assert (numslices & (numslices - 1)) == 0, (
-            'Not a power of 2: {0}'.format(numslices))
         self.name = name
         self.queue_directory = queue_directory
         # If configured to, create the directory if it doesn't yet exist.
         if config.create_paths:
             makedirs(self.queue_directory, 0o770)
-        # Fast track for no slices
-        self._lower = None
-        self._upper = None
-        # BAW: test performance and end-cases of this algorithm
-        if numslices != 1:
-            self._lower = ((shamax + 1) * slice) / numslices
-            self._upper = (((shamax + 1) * (slice + 1)) / numslices) - 1
+        # Entries are assigned to slices by consistent hashing, so that
+        # changing the number of slices only moves a few entries between
+        # them.  A slice of None means we own the whole queue.
+        self._slice = slice
+        self._numslices = numslices
+        self._slices_mtime = None
+        if slice is not None:
+            self._update_slices()
+        # file base -> open file, for the entries we've dequeued but not yet
+        # finished.  The files are locked, so that other processes know the
+        # entries are still being worked on.
+        self._claims = {}
+        # The index of queued file bases in our slice.  This is a _Lane for
+        # each priority lane, plus the set of file bases in the lanes.  It is
+        # built lazily by a full scan of the queue, and kept up to date with
+        # the notifications passed to .notify().  Every so often it is rebuilt
+        # from scratch to pick up anything we weren't told about.
+        self._lanes = None
+        self._indexed = set()
+        self._reconcile_at = 0
+        # The number of entries served from a higher lane in a row, while a
+        # lower lane was waiting.
+        self._passed_over = 0
+        try:
+            section = getattr(config, 'runner.' + name)
+        except AttributeError:
+            self._reconcile_interval = DEFAULT_RECONCILE_INTERVAL
+            self._durability = DEFAULT_DURABILITY
+            self._qfile_format = DEFAULT_QFILE_FORMAT
+            self._bulk_recipients = DEFAULT_BULK_RECIPIENTS
+            self._starvation_limit = DEFAULT_STARVATION_LIMIT
+            self._fair_share = False
+            self._fair_quantum = DEFAULT_FAIR_QUANTUM
+            self._list_weights = {}
+        else:
+            self._reconcile_interval = as_timedelta(
+                section.reconcile_interval).total_seconds()
+            self._durability = section.durability
+            self._qfile_format = section.qfile_format
+            self._bulk_recipients = int(section.bulk_recipients)
+            self._starvation_limit = int(section.starvation_limit)
+            self._fair_share = as_boolean(section.fair_share)
+            self._fair_quantum = int(section.fair_quantum)
+            self._list_weights = {}
+            for item in section.list_weights.split():
+                list_id, weight = item.rsplit(':', 1)
+                self._list_weights[_flow(list_id)] = float(weight)
+        assert self._qfile_format in ('raw', 'pickle'), (
+            'Unknown queue file format: {}'.format(self._qfile_format))
+        assert self._durability in ('fsync', 'group', 'buffered'), (
+            'Unknown durability: {}'.format(self._durability))
         if recover:
             self.recover_backup_files()
 
     def enqueue(self, _msg, _metadata=None, **_kws):
         """See `ISwitchboard`."""
+        function = _handoffs.get(self.name)
+        if function is not None:
+            data = {} if _metadata is None else _metadata.copy()
+            data.update(_kws)
+            # Messages to be stored as text are parsed from scratch when
+            # they are dequeued, so they can't be handed over as they are.
+            if not data.get('_plaintext'):
+                data['version'] = config.QFILE_SCHEMA_VERSION
+                for key in list(data):
+                    if key.startswith('_'):
+                        del data[key]
+                if function(_msg, data):
+                    return None
+        filebase, payload = self._serialize(_msg, _metadata, _kws)
+        self._write(filebase, payload)
+        return filebase
+
+    def _serialize(self, _msg, _metadata, _kws):
+        """Calculate the file base and serialized bytes of a queue entry.
+
+        :return: 2-tuple of the file base and the bytes containing either the
+            raw queue file, or the message pickle followed by the metadata
+            pickle.
+        """
         if _metadata is None:
             _metadata = {}
         # Calculate the SHA hexdigest of the message to get a unique base
@@ -109,24 +403,11 @@ class Switchboard:
         data = _metadata.copy()
         data.update(_kws)
         list_id = data.get('listid', '--nolist--')
+        plaintext = bool(data.get('_plaintext'))
+        target_slice = data.get('_slice')
+        lane = self._lane(data)
         # Get some data for the input to the sha hash.
         now = repr(time.time())
-        if data.get('_plaintext'):
-            protocol = 0
-            msgsave = pickle.dumps(str(_msg), protocol)
-        else:
-            protocol = pickle.HIGHEST_PROTOCOL
-            msgsave = pickle.dumps(_msg, protocol)
-        # The list-id field is a string but the input to the hash function must
-        # be bytes.
-        hashfood = msgsave + list_id.encode('utf-8') + now.encode('utf-8')
-        # Encode the current time into the file name for FIFO sorting.  The
-        # file name consists of two parts separated by a '+': the received
-        # time for this message (i.e. when it first showed up on this system)
-        # and the sha hex digest.
-        filebase = now + '+' + hashlib.sha1(hashfood).hexdigest()
-        filename = os.path.join(self.queue_directory, filebase + '.pck')
-        tmpfile = filename + '.tmp'
         # Always add the metadata schema version number
         data['version'] = config.QFILE_SCHEMA_VERSION
         # Filter out volatile entries.  Use .keys() so that we can mutate the
@@ -134,17 +415,103 @@ class Switchboard:
         for k in list(data):
             if k.startswith('_'):
                 del data[k]
-        # We have to tell the dequeue() method whether to parse the message
-        # object or not.
-        data['_parsemsg'] = (protocol == 0)
+        payload = None
+        if self._qfile_format == 'raw':
+            try:
+                msgsave, payload = qfile.dumps(_msg, data, plaintext)
+            except (TypeError, UnicodeError):
+                # Entries which can't be stored raw are pickled instead.
+                pass
+        if payload is None:
+            if plaintext:
+                protocol = 0
+                msgsave = pickle.dumps(str(_msg), protocol)
+            else:
+                protocol = pickle.HIGHEST_PROTOCOL
+                msgsave = pickle.dumps(_msg, protocol)
+            # We have to tell the dequeue() method whether to parse the
+            # message object or not.
+            data['_parsemsg'] = (protocol == 0)
+            payload = msgsave + pickle.dumps(data, protocol)
+        # The list-id field is a string but the input to the hash function must
+        # be bytes.
+        hashfood = msgsave + list_id.encode('utf-8') + now.encode('utf-8')
+        digest = hashlib.sha1(hashfood)
+        if target_slice is not None:
+            digest = self._digest_for_slice(digest, target_slice)
+        # Encode the current time into the file name for FIFO sorting.  The
+        # file name consists of five parts separated by a '+': the received
+        # time for this message (i.e. when it first showed up on this system),
+        # the sha hex digest, the priority lane, the flow of the mailing list
+        # for fair scheduling, and the entry's cost, i.e. its number of
+        # recipients.
+        cost = max(1, len(data.get('recipients') or ()))
+        filebase = '{0}+{1}+{2}+{3}+{4}'.format(
+            now, digest.hexdigest(), lane, _flow(list_id), cost)
+        return filebase, payload
+
+    def _digest_for_slice(self, digest, target_slice):
+        """Salt the file base digest until the target slice owns it.
+
+        :param digest: The unsalted SHA1 hash object.
+        :param target_slice: The slice which is to own the entry.
+        :type target_slice: int
+        :return: The salted SHA1 hash object.
+        """
+        numslices = get_slice_count(self.queue_directory, self._numslices)
+        if numslices == 1:
+            return digest
+        target_slice %= numslices
+        salt = 0
+        while True:
+            salted = digest.copy()
+            salted.update(str(salt).encode('ascii'))
+            if _owner(numslices, salted.hexdigest()) == target_slice:
+                return salted
+            salt += 1
+
+    def _lane(self, data):
+        """Return the priority lane for an entry's metadata."""
+        priority = data.get('priority')
+        if priority is not None:
+            try:
+                return LANES[priority]
+            except (KeyError, TypeError):
+                # Don't lose the entry over it.
+                elog.error('Ignoring bad priority in %s queue: %r',
+                           self.name, priority)
+        if any(data.get(key) for key in HIGH_LANE_KEYS):
+            return HIGH_LANE
+        if len(data.get('recipients') or ()) >= self._bulk_recipients:
+            return BULK_LANE
+        return NORMAL_LANE
+
+    def _write(self, filebase, payload):
+        """Write the serialized queue entry to its .pck file.
+
+        How durable the write is depends on the queue's durability setting,
+        and whether there is a group commit in progress.
+        """
+        filename = os.path.join(self.queue_directory, filebase + '.pck')
+        tmpfile = filename + '.tmp'
+        group = self._group_commit()
         # Write to the pickle file the message object and metadata.
         with open(tmpfile, 'wb') as fp:
-            fp.write(msgsave)
-            pickle.dump(data, fp, protocol)
-            fp.flush()
-            os.fsync(fp.fileno())
-        os.rename(tmpfile, filename)
-        return filebase
+            fp.write(payload)
+            if self._durability != 'buffered' and group is None:
+                fp.flush()
+                os.fsync(fp.fileno())
+        if group is None:
+            os.rename(tmpfile, filename)
+        else:
+            group.sync(tmpfile, partial(_fsync, tmpfile))
+            group.rename(tmpfile, filename)
+
+    def _group_commit(self):
+        """Return the group commit to defer syncing to, if any."""
+        if self._durability == 'group':
+            return _group
+        return None
 
     def dequeue(self, filebase):
         """See `ISwitchboard`."""
@@ -152,13 +519,39 @@ class Switchboard:
         filename = os.path.join(self.queue_directory, filebase + '.pck')
         backfile = os.path.join(self.queue_directory, filebase + '.bak')
         # Read the message object and metadata.
-        with open(filename, 'rb') as fp:
+        fp = open(filename, 'rb+')
+        try:
+            # Lock the file for as long as we're working on it.  If this
+            # process crashes, the lock goes away, and the backup file can be
+            # recovered.  If someone else already has the lock, they are
+            # dequeuing the same entry.
+            if not _try_lock(fp):
+                raise FileNotFoundError(
+                    errno.ENOENT, 'Queue entry is claimed', filebase)
             # Move the file to the backup file name for processing.  If this
             # process crashes uncleanly the .bak file will be used to
             # re-instate the .pck file in order to try again.
             os.rename(filename, backfile)
-            msg = pickle.load(fp)
-            data = pickle.load(fp)
+            msg, data = self._deserialize(fp)
+        except:
+            fp.close()
+            raise
+        self._claims[filebase] = fp
+        return msg, data
+
+    def _deserialize(self, fp):
+        """Read the message and metadata from a serialized queue entry.
+
+        :param fp: A binary file-like object positioned at the start of the
+            entry.
+        :return: 2-tuple of the message and metadata.
+        """
+        magic = fp.read(len(qfile.MAGIC))
+        if magic == qfile.MAGIC:
+            return qfile.loads(magic + fp.read())
+        fp.seek(-len(magic), 1)
+        msg = pickle.load(fp)
+        data = pickle.load(fp)
         if data.get('_parsemsg'):
             # Calculate the original size of the text now so that we won't
             # have to generate the message later when we do size restriction
@@ -171,6 +564,14 @@ class Switchboard:
 
     def finish(self, filebase, preserve=False):
         """See `ISwitchboard`."""
+        if _group is None:
+            self._finish_entry(filebase, preserve)
+        else:
+            # Don't remove the entry until everything it led to is committed.
+            _group.finish(self._finish_entry, filebase, preserve)
+
+    def _finish_entry(self, filebase, preserve):
+        """Remove or preserve the backup file for filebase."""
         bakfile = os.path.join(self.queue_directory, filebase + '.bak')
         try:
             if preserve:
@@ -182,6 +583,110 @@ class Switchboard:
         except EnvironmentError:
             elog.exception(
                 'Failed to unlink/preserve backup file: %s', bakfile)
+        fp = self._claims.pop(filebase, None)
+        if fp is not None:
+            fp.close()
+
+    def _update_slices(self):
+        """Pick up any change to the number of slices."""
+        path = os.path.join(self.queue_directory, SLICES_FILE)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if mtime == self._slices_mtime:
+            return False
+        self._slices_mtime = mtime
+        numslices = get_slice_count(self.queue_directory, self._numslices)
+        if numslices == self._numslices:
+            return False
+        self._numslices = numslices
+        # Our slice has changed, so the index is no longer valid.
+        self._lanes = None
+        self._indexed = set()
+        return True
+
+    def _in_slice(self, filebase):
+        """Return whether the file base falls within our slice."""
+        # Fast track for no slices.
+        if self._slice is None or self._numslices == 1:
+            return True
+        when, digest, lane, flow, cost = _parse(filebase)
+        return _owner(self._numslices, digest) == self._slice
+
+    def _reconcile(self):
+        """Rebuild the index from a full scan of the queue."""
+        files = self.get_files()
+        self._indexed = set(files)
+        self._lanes = [_Lane(self._fair_quantum, self._list_weights)
+                       for lane in LANES]
+        for filebase in files:
+            self._push(filebase)
+        self._reconcile_at = time.time() + self._reconcile_interval
+
+    def is_empty(self):
+        """See `ISwitchboard`."""
+        if self._lanes is None or time.time() >= self._reconcile_at:
+            self._reconcile()
+        return len(self._indexed) == 0
+
+    def notify(self, names):
+        """See `ISwitchboard`."""
+        if self._lanes is None:
+            # The index will be built from scratch anyway.
+            return
+        if names is None:
+            self._lanes = None
+            self._indexed = set()
+            return
+        for name in names:
+            filebase, ext = os.path.splitext(name)
+            if (ext == '.pck' and filebase not in self._indexed and
+                    self._in_slice(filebase)):
+                self._push(filebase)
+                self._indexed.add(filebase)
+
+    def _push(self, filebase):
+        """Add a file base to the index."""
+        when, digest, lane, flow, cost = _parse(filebase)
+        if not self._fair_share:
+            flow = None
+        self._lanes[lane].push(when, filebase, flow, cost)
+
+    def next_files(self, count=None):
+        """See `ISwitchboard`."""
+        if self._slice is not None and self._update_slices():
+            # Entries that were in flight in other slices may now be ours.
+            # Those which are still being worked on are locked, so this
+            # only recovers those whose runner has gone away.
+            self.recover_backup_files()
+        if self._lanes is None or time.time() >= self._reconcile_at:
+            self._reconcile()
+        if count is None:
+            count = len(self._indexed)
+        while count > 0:
+            # The index can be dropped or go stale while we're being
+            # iterated over, and entries can be added to it.
+            if self._lanes is None or time.time() >= self._reconcile_at:
+                self._reconcile()
+            waiting = [lane for lane in self._lanes if len(lane) > 0]
+            if len(waiting) == 0:
+                break
+            if len(waiting) == 1:
+                self._passed_over = 0
+                filebase = waiting[0].pop()
+            elif self._passed_over >= self._starvation_limit:
+                # Don't let the lower lanes starve.  Serve the entry which
+                # has been waiting longest, whatever its lane.
+                lane = min(waiting, key=_Lane.oldest)
+                filebase = lane.pop(oldest=True)
+                self._passed_over = 0
+            else:
+                self._passed_over += 1
+                filebase = waiting[0].pop()
+            self._indexed.discard(filebase)
+            count -= 1
+            yield filebase
 
     @property
     def files(self):
@@ -191,20 +696,15 @@ class Switchboard:
     def get_files(self, extension='.pck'):
         """See `ISwitchboard`."""
         times = {}
-        lower = self._lower
-        upper = self._upper
         for f in os.listdir(self.queue_directory):
             # By ignoring anything that doesn't end in .pck, we ignore
             # tempfiles and avoid a race condition.
             filebase, ext = os.path.splitext(f)
             if ext != extension:
                 continue
-            when, digest = filebase.split('+', 1)
-            # Throw out any files which don't match our bitrange.  BAW: test
-            # performance and end-cases of this algorithm.  MAS: both
-            # comparisons need to be <= to get complete range.
-            if lower is None or (lower <= int(digest, 16) <= upper):
-                key = float(when)
+            # Throw out any files which don't match our bitrange.
+            if self._in_slice(filebase):
+                key = _parse(filebase)[0]
                 while key in times:
                     key += DELTA
                 times[key] = filebase
@@ -222,12 +722,31 @@ class Switchboard:
         for filebase in self.get_files('.bak'):
             src = os.path.join(self.queue_directory, filebase + '.bak')
             dst = os.path.join(self.queue_directory, filebase + '.pck')
-            with open(src, 'rb+') as fp:
+            # If we dequeued this entry ourselves, we're giving up on it.
+            claim = self._claims.pop(filebase, None)
+            if claim is not None:
+                claim.close()
+            try:
+                fp = open(src, 'rb+')
+            except FileNotFoundError:
+                # Its runner just finished it.
+                continue
+            with fp:
+                if not _try_lock(fp):
+                    # Another runner is still working on this entry.
+                    continue
+                entry = None
                 try:
-                    # Throw away the message object.
-                    pickle.load(fp)
-                    data_pos = fp.tell()
-                    data = pickle.load(fp)
+                    if fp.read(len(qfile.MAGIC)) == qfile.MAGIC:
+                        fp.seek(0)
+                        entry = fp.read()
+                        data = qfile.load_metadata(entry)
+                    else:
+                        # Throw away the message object.
+                        fp.seek(0)
+                        pickle.load(fp)
+                        data_pos = fp.tell()
+                        data = pickle.load(fp)
                 except Exception as error:
                     # If unpickling throws any exception, just log and
                     # preserve this entry
@@ -236,12 +755,16 @@ class Switchboard:
                     self.finish(filebase, preserve=True)
                 else:
                     data['_bak_count'] = data.get('_bak_count', 0) + 1
-                    fp.seek(data_pos)
-                    if data.get('_parsemsg'):
-                        protocol = 0
+                    if entry is not None:
+                        fp.seek(0)
+                        fp.write(qfile.replace_metadata(entry, data))
                     else:
-                        protocol = 1
-                    pickle.dump(data, fp, protocol)
+                        fp.seek(data_pos)
+                        if data.get('_parsemsg'):
+                            protocol = 0
+                        else:
+                            protocol = 1
+                        pickle.dump(data, fp, protocol)
                     fp.truncate()
                     fp.flush()
                     os.fsync(fp.fileno())
@@ -253,6 +776,109 @@ class Switchboard:
                         os.rename(src, dst)
 
 
+
+def _parse(filebase):
+    """Split a file base into its received time, digest, lane, flow and cost.
+
+    File bases written by older versions only have the first two parts.
+    """
+    parts = filebase.split('+')
+    lane = (int(parts[2]) if len(parts) > 2 else NORMAL_LANE)
+    flow = (parts[3] if len(parts) > 3 else '')
+    cost = (int(parts[4]) if len(parts) > 4 else 1)
+    return float(parts[0]), parts[1], lane, flow, cost
+
+
+def _flow(list_id):
+    """Return the fair scheduling flow for a list id."""
+    return hashlib.sha1(list_id.encode('utf-8')).hexdigest()[:8]
+
+
+@lru_cache()
+def _ring(numslices):
+    """Return the hash ring for the given number of slices.
+
+    :return: 2-tuple of the sorted points on the ring, and the slice owning
+        each point.
+    """
+    points = []
+    for slice in range(numslices):
+        for point in range(RING_POINTS):
+            key = '{0}:{1}'.format(slice, point).encode('ascii')
+            points.append((int(hashlib.sha1(key).hexdigest(), 16), slice))
+    points.sort()
+    return ([point for point, slice in points],
+            [slice for point, slice in points])
+
+
+def _owner(numslices, digest):
+    """Return the slice owning the given hex digest."""
+    points, slices = _ring(numslices)
+    index = bisect.bisect(points, int(digest, 16))
+    return slices[index % len(points)]
+
+
+def _try_lock(fp, length=0, start=0):
+    """Try to lock an open queue file, returning whether we got the lock.
+
+    These are POSIX record locks, so they are released when the process
+    exits, however it exits.
+    """
+    try:
+        fcntl.lockf(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB, length, start)
+    except OSError as error:
+        if error.errno in (errno.EACCES, errno.EAGAIN):
+            return False
+        raise
+    return True
+
+
+def get_slice_count(queue_directory, default):
+    """Return the number of slices a queue is currently split into.
+
+    :param queue_directory: The queue directory.
+    :type queue_directory: str
+    :param default: The number of slices to return if none is recorded in the
+        queue directory.
+    :type default: int
+    :return: The number of slices.
+    :rtype: int
+    """
+    try:
+        with open(os.path.join(queue_directory, SLICES_FILE)) as fp:
+            return int(fp.read().strip())
+    except (FileNotFoundError, ValueError):
+        return default
+
+
+def set_slice_count(queue_directory, count):
+    """Record the number of slices a queue is split into.
+
+    The queue's runners pick up the new count the next time they look for
+    queue entries.
+
+    :param queue_directory: The queue directory.
+    :type queue_directory: str
+    :param count: The number of slices.
+    :type count: int
+    """
+    assert count > 0, 'Bad slice count: {0}'.format(count)
+    path = os.path.join(queue_directory, SLICES_FILE)
+    tmpfile = path + '.tmp'
+    with open(tmpfile, 'w') as fp:
+        print(count, file=fp)
+    os.rename(tmpfile, path)
+
+
+
+def _fsync(filename):
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
 
 def handle_ConfigurationUpdatedEvent(event):
     """Initialize the global switchboards for input/output."""
@@ -269,4 +895,5 @@ def handle_ConfigurationUpdatedEvent(event):
             substitutions = config.paths
             substitutions['name'] = name
             path = expand(conf.path, substitutions)
-            config.switchboards[name] = Switchboard(name, path)
+            switchboard_class = find_name(conf.switchboard)
+            config.switchboards[name] = switchboard_class(name, path)
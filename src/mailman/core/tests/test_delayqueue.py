@@ -0,0 +1,181 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the delay queue."""
+
+__all__ = [
+    'TestDelayQueue',
+    ]
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from datetime import datetime, timedelta
+from mailman.config import config
+from mailman.core.delayqueue import DelayQueue
+from mailman.core.switchboard import Switchboard
+from mailman.testing.helpers import (
+    LogFileMark, specialized_message_from_string as mfs)
+from mailman.testing.layers import ConfigLayer
+
+
+NOW = datetime(2015, 3, 4, 5, 6, 7)
+
+
+
+class TestDelayQueue(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        self._directory = os.path.join(tempdir, 'delay')
+        self._delay_queue = DelayQueue(self._directory)
+        self._outq = Switchboard('out', os.path.join(tempdir, 'out'))
+
+    def _park(self, message_id, seconds):
+        msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: {0}
+
+""".format(message_id))
+        return self._delay_queue.park(
+            msg, dict(listid='test.example.com'),
+            NOW + timedelta(seconds=seconds))
+
+    def _released(self):
+        message_ids = []
+        for filebase in self._outq.files:
+            msg, msgdata = self._outq.dequeue(filebase)
+            self._outq.finish(filebase)
+            message_ids.append(msg['message-id'])
+        return sorted(message_ids)
+
+    def test_park(self):
+        filebase = self._park('<first>', 10)
+        due, msg, msgdata = self._delay_queue.get(filebase)
+        self.assertEqual(due, NOW + timedelta(seconds=10))
+        self.assertEqual(msg['message-id'], '<first>')
+        self.assertEqual(msgdata, dict(listid='test.example.com'))
+
+    def test_files_in_due_order(self):
+        second = self._park('<second>', 20)
+        first = self._park('<first>', 10)
+        self.assertEqual(self._delay_queue.files, [first, second])
+        self.assertEqual(self._delay_queue.next_due(),
+                         NOW + timedelta(seconds=10))
+
+    def test_release_when_due(self):
+        self._park('<first>', 10)
+        self._park('<second>', 20)
+        self.assertEqual(self._delay_queue.release(self._outq, NOW), 0)
+        self.assertEqual(self._released(), [])
+        self.assertEqual(self._delay_queue.release(
+            self._outq, NOW + timedelta(seconds=10)), 1)
+        self.assertEqual(self._released(), ['<first>'])
+        # The released entry is gone from the delay queue.
+        self.assertEqual(len(self._delay_queue.files), 1)
+        self.assertEqual(self._delay_queue.next_due(),
+                         NOW + timedelta(seconds=20))
+
+    def test_entries_parked_by_others(self):
+        # Entries parked by other processes are picked up.
+        self.assertIsNone(self._delay_queue.next_due())
+        other = DelayQueue(self._directory)
+        other.park(mfs('Message-ID: <first>\n\n'), {}, NOW)
+        self.assertEqual(self._delay_queue.next_due(), NOW)
+        self.assertEqual(self._delay_queue.release(self._outq, NOW), 1)
+        self.assertEqual(self._released(), ['<first>'])
+
+    def _park_unnoticed(self, mtime):
+        # Park an entry from another process, without changing the time the
+        # directory was last modified.
+        other = DelayQueue(self._directory)
+        other.park(mfs('Message-ID: <second>\n\n'), {}, NOW)
+        os.utime(self._directory, ns=(mtime, mtime))
+
+    def test_parked_in_the_same_tick(self):
+        # An entry parked within the same tick as the listing is picked up,
+        # even though the directory's time didn't change.
+        self._park('<first>', 10)
+        mtime = os.stat(self._directory).st_mtime_ns
+        self.assertEqual(len(self._delay_queue.files), 1)
+        self._park_unnoticed(mtime)
+        self.assertEqual(self._delay_queue.next_due(), NOW)
+        self.assertEqual(len(self._delay_queue.files), 2)
+
+    def test_rescan(self):
+        # The directory is listed again once the rescan interval has passed.
+        self._park('<first>', 10)
+        # The listing is well after the directory last changed.
+        os.utime(self._directory, (0, 0))
+        delay_queue = DelayQueue(self._directory, rescan_interval=3600)
+        rescanning = DelayQueue(self._directory, rescan_interval=0)
+        self.assertEqual(len(delay_queue.files), 1)
+        self.assertEqual(len(rescanning.files), 1)
+        self._park_unnoticed(0)
+        self.assertEqual(len(delay_queue.files), 1)
+        self.assertEqual(rescanning.next_due(), NOW)
+        self.assertEqual(len(rescanning.files), 2)
+
+    def test_released_once(self):
+        # Entries released by another process are skipped.
+        self._park('<first>', 0)
+        self.assertEqual(self._delay_queue.next_due(), NOW)
+        other = DelayQueue(self._directory)
+        self.assertEqual(other.release(self._outq, NOW), 1)
+        self.assertEqual(self._delay_queue.release(self._outq, NOW), 0)
+        self.assertIsNone(self._delay_queue.next_due())
+        self.assertEqual(self._released(), ['<first>'])
+
+    def test_recover_backup_files(self):
+        filebase = self._park('<first>', 0)
+        path = os.path.join(self._directory, filebase)
+        os.rename(path + '.pck', path + '.bak')
+        self._delay_queue.recover_backup_files()
+        self.assertEqual(self._delay_queue.files, [filebase])
+
+    def test_unreadable_entry(self):
+        # An entry which can't be read back is moved to the bad queue,
+        # instead of being recovered and failing again on every restart.
+        bad = self._park('<bad>', 0)
+        self._park('<good>', 0)
+        with open(os.path.join(self._directory, bad + '.pck'), 'wb') as fp:
+            fp.write(b'not a pickle')
+        mark = LogFileMark('mailman.runner')
+        self.assertEqual(self._delay_queue.release(self._outq, NOW), 1)
+        self.assertEqual(self._released(), ['<good>'])
+        psvfile = os.path.join(
+            config.switchboards['bad'].queue_directory, bad + '.psv')
+        self.addCleanup(os.remove, psvfile)
+        self.assertTrue(os.path.exists(psvfile))
+        self.assertIn(bad, mark.read())
+        self._delay_queue.recover_backup_files()
+        self.assertEqual(os.listdir(self._directory), [])
+
+    def test_wakeup(self):
+        # Parking an entry touches the directory the releaser is watching.
+        wakeup_directory = os.path.join(self._directory, 'wakeup')
+        os.mkdir(wakeup_directory)
+        os.utime(wakeup_directory, (0, 0))
+        delay_queue = DelayQueue(self._directory, wakeup_directory)
+        delay_queue.park(mfs('Message-ID: <first>\n\n'), {}, NOW)
+        self.assertNotEqual(os.stat(wakeup_directory).st_mtime, 0)
@@ -0,0 +1,163 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the log based switchboard."""
+
+__all__ = [
+    'TestLogSwitchboard',
+    ]
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mailman.config import config
+from mailman.core.logswitchboard import LogSwitchboard
+from mailman.core.switchboard import MAX_BAK_COUNT
+from mailman.interfaces.switchboard import ISwitchboard
+from mailman.testing.helpers import (
+    configuration, specialized_message_from_string as mfs)
+from mailman.testing.layers import ConfigLayer
+from zope.interface.verify import verifyObject
+
+
+
+class TestLogSwitchboard(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._queue_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._queue_directory)
+        self._switchboard = LogSwitchboard('test', self._queue_directory)
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+
+    def _segments(self):
+        return sorted(filename
+                      for filename in os.listdir(self._queue_directory)
+                      if filename.endswith('.seg'))
+
+    def test_interface(self):
+        self.assertTrue(verifyObject(ISwitchboard, self._switchboard))
+
+    def test_enqueue_dequeue(self):
+        filebase = self._switchboard.enqueue(self._msg, listid='test.ex.com')
+        self.assertEqual(self._switchboard.files, [filebase])
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertEqual(msg['message-id'], '<ant>')
+        self.assertEqual(msgdata['listid'], 'test.ex.com')
+        # The entry is now claimed, which is the equivalent of a .bak file.
+        self.assertEqual(self._switchboard.files, [])
+        self.assertEqual(self._switchboard.get_files('.bak'), [filebase])
+        self._switchboard.finish(filebase)
+        self.assertEqual(self._switchboard.get_files('.bak'), [])
+        # Nothing is written per message.
+        self.assertEqual(self._segments(), ['0000000000.seg'])
+
+    def test_fifo(self):
+        filebases = [self._switchboard.enqueue(self._msg, index=i)
+                     for i in range(10)]
+        self.assertEqual(self._switchboard.files, filebases)
+        # Another switchboard on the same directory sees the same thing.
+        other = LogSwitchboard('test', self._queue_directory)
+        self.assertEqual(other.files, filebases)
+        msg, msgdata = other.dequeue(filebases[3])
+        self.assertEqual(msgdata['index'], 3)
+        self.assertNotIn(filebases[3], self._switchboard.files)
+
+    def test_dequeue_twice(self):
+        filebase = self._switchboard.enqueue(self._msg)
+        self._switchboard.dequeue(filebase)
+        self.assertRaises(FileNotFoundError,
+                          self._switchboard.dequeue, filebase)
+        self.assertRaises(FileNotFoundError,
+                          self._switchboard.dequeue, 'bogus+0123')
+
+    @configuration('runner.test', segment_size=2048)
+    def test_segments_are_reclaimed(self):
+        switchboard = LogSwitchboard('test', self._queue_directory)
+        filebases = [switchboard.enqueue(self._msg, padding='x' * 500)
+                     for i in range(10)]
+        self.assertGreater(len(self._segments()), 2)
+        self.assertEqual(switchboard.files, filebases)
+        for filebase in filebases:
+            switchboard.dequeue(filebase)
+            switchboard.finish(filebase)
+        # Only the segment being appended to is left.
+        self.assertEqual(len(self._segments()), 1)
+        self.assertEqual(switchboard.files, [])
+        # And the queue still works.
+        filebase = switchboard.enqueue(self._msg)
+        self.assertEqual(switchboard.files, [filebase])
+
+    def test_large_entry(self):
+        # An entry larger than the segment size gets its own segment.
+        with configuration('runner.test', segment_size=1024):
+            switchboard = LogSwitchboard('test', self._queue_directory)
+            filebase = switchboard.enqueue(self._msg, padding='x' * 4096)
+            msg, msgdata = switchboard.dequeue(filebase)
+        self.assertEqual(msgdata['padding'], 'x' * 4096)
+
+    def test_slices(self):
+        filebases = set(self._switchboard.enqueue(self._msg, index=i)
+                        for i in range(20))
+        slice_0 = LogSwitchboard('test', self._queue_directory, 0, 2)
+        slice_1 = LogSwitchboard('test', self._queue_directory, 1, 2)
+        files_0 = set(slice_0.files)
+        files_1 = set(slice_1.files)
+        self.assertEqual(files_0 & files_1, set())
+        self.assertEqual(files_0 | files_1, filebases)
+
+    def test_recover_backup_files(self):
+        filebase = self._switchboard.enqueue(self._msg)
+        self._switchboard.dequeue(filebase)
+        for count in range(1, MAX_BAK_COUNT):
+            # Simulate a crash and restart of the runner.
+            switchboard = LogSwitchboard(
+                'test', self._queue_directory, recover=True)
+            self.assertEqual(switchboard.files, [filebase])
+            msg, msgdata = switchboard.dequeue(filebase)
+            self.assertEqual(msgdata['_bak_count'], count)
+        # After too many recoveries, the entry is preserved.
+        switchboard = LogSwitchboard(
+            'test', self._queue_directory, recover=True)
+        self.assertEqual(switchboard.files, [])
+        self.assertEqual(switchboard.get_files('.bak'), [])
+        bad_dir = config.switchboards['bad'].queue_directory
+        psvfile = os.path.join(bad_dir, filebase + '.psv')
+        self.assertTrue(os.path.exists(psvfile))
+        os.remove(psvfile)
+
+    def test_preserve(self):
+        filebase = self._switchboard.enqueue(self._msg)
+        self._switchboard.dequeue(filebase)
+        self._switchboard.finish(filebase, preserve=True)
+        bad = config.switchboards['bad']
+        self.assertEqual(bad.get_files('.psv'), [filebase])
+        os.remove(os.path.join(bad.queue_directory, filebase + '.psv'))
+
+    @configuration('runner.out',
+                   switchboard='mailman.core.logswitchboard.LogSwitchboard')
+    def test_configured_switchboard(self):
+        self.assertIsInstance(config.switchboards['out'], LogSwitchboard)
+        self.assertNotIsInstance(config.switchboards['in'], LogSwitchboard)
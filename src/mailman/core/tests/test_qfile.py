@@ -0,0 +1,186 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the raw queue file format."""
+
+__all__ = [
+    'TestQFile',
+    'TestRawSwitchboard',
+    ]
+
+
+import os
+import copy
+import uuid
+import pickle
+import shutil
+import tempfile
+import unittest
+
+from datetime import datetime, timedelta, timezone
+from mailman.core import qfile
+from mailman.core.switchboard import MAX_BAK_COUNT, Switchboard
+from mailman.email.message import Message, UserNotification
+from mailman.interfaces.member import DeliveryMode
+from mailman.testing.helpers import (
+    configuration, specialized_message_from_string as mfs)
+from mailman.testing.layers import ConfigLayer
+
+
+
+class TestQFile(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+Hello
+""")
+
+    def test_metadata(self):
+        msgdata = dict(
+            listid='test.example.com',
+            recipients={'anne@example.com', 'bart@example.com'},
+            deliver_after=datetime(2015, 1, 2, 3, 4, 5, 6),
+            received_time=datetime(2015, 1, 2, tzinfo=timezone.utc),
+            delay=timedelta(hours=1),
+            pair=('a', 1),
+            member_id=uuid.uuid4(),
+            numbers={1: 'one'},
+            nested=[dict(data=b'\xff')],
+            version=3,
+            )
+        raw, entry = qfile.dumps(self._msg, msgdata)
+        msg, data = qfile.loads(entry)
+        self.assertEqual(data, msgdata)
+        self.assertEqual(qfile.load_metadata(entry), msgdata)
+
+    def test_unsupported_metadata(self):
+        self.assertRaises(TypeError, qfile.dumps,
+                          self._msg, dict(mode=DeliveryMode.regular))
+
+    def test_parsed_lazily(self):
+        raw, entry = qfile.dumps(self._msg, {})
+        self.assertTrue(entry.endswith(raw))
+        msg, data = qfile.loads(entry)
+        self.assertIsInstance(msg, Message)
+        self.assertIn('_qfile_raw', msg.__dict__)
+        # Passing the message on doesn't parse it.
+        self.assertEqual(qfile.dumps(msg, {})[0], raw)
+        self.assertIn('_qfile_raw', msg.__dict__)
+        # Looking inside it does.
+        self.assertEqual(msg['message-id'], '<ant>')
+        self.assertNotIn('_qfile_raw', msg.__dict__)
+        self.assertIs(type(msg), Message)
+        self.assertEqual(msg.get_payload(), 'Hello\n')
+
+    def test_attributes(self):
+        msg = UserNotification(
+            'anne@example.com', 'test@example.com', 'Greetings', 'Hello')
+        msg.original_size = 123
+        raw, entry = qfile.dumps(msg, {})
+        msg, data = qfile.loads(entry)
+        self.assertIsInstance(msg, UserNotification)
+        self.assertEqual(msg.original_size, 123)
+        self.assertEqual(msg['subject'], 'Greetings')
+        self.assertIs(type(msg), UserNotification)
+
+    def test_copy_and_pickle(self):
+        raw, entry = qfile.dumps(self._msg, {})
+        msg, data = qfile.loads(entry)
+        for other in (copy.deepcopy(msg), pickle.loads(pickle.dumps(msg))):
+            self.assertIs(type(other), Message)
+            self.assertEqual(other['message-id'], '<ant>')
+
+    def test_text(self):
+        raw, entry = qfile.dumps(self._msg, {}, text=True)
+        msg, data = qfile.loads(entry)
+        self.assertEqual(msg['message-id'], '<ant>')
+        self.assertEqual(data['original_size'], len(str(self._msg)))
+        self.assertEqual(msg.original_size, data['original_size'])
+
+    def test_replace_metadata(self):
+        raw, entry = qfile.dumps(self._msg, dict(when=datetime(2015, 1, 1)))
+        entry = qfile.replace_metadata(entry, dict(when=datetime(2015, 1, 2)))
+        msg, data = qfile.loads(entry)
+        self.assertEqual(data, dict(when=datetime(2015, 1, 2)))
+        self.assertEqual(msg['message-id'], '<ant>')
+
+
+
+class TestRawSwitchboard(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._queue_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._queue_directory)
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+
+    def _read(self, filebase, extension='.pck'):
+        path = os.path.join(self._queue_directory, filebase + extension)
+        with open(path, 'rb') as fp:
+            return fp.read()
+
+    @configuration('runner.test', qfile_format='raw')
+    def test_enqueue_dequeue(self):
+        switchboard = Switchboard('test', self._queue_directory)
+        filebase = switchboard.enqueue(self._msg, listid='test.example.com')
+        self.assertTrue(self._read(filebase).startswith(qfile.MAGIC))
+        msg, msgdata = switchboard.dequeue(filebase)
+        self.assertEqual(msg['message-id'], '<ant>')
+        self.assertEqual(msgdata['listid'], 'test.example.com')
+        self.assertNotIn('_parsemsg', msgdata)
+
+    @configuration('runner.test', qfile_format='raw')
+    def test_fall_back_to_pickle(self):
+        switchboard = Switchboard('test', self._queue_directory)
+        filebase = switchboard.enqueue(self._msg, mode=DeliveryMode.regular)
+        self.assertFalse(self._read(filebase).startswith(qfile.MAGIC))
+        msg, msgdata = switchboard.dequeue(filebase)
+        self.assertEqual(msgdata['mode'], DeliveryMode.regular)
+
+    def test_read_either_format(self):
+        with configuration('runner.test', qfile_format='raw'):
+            raw = Switchboard('test', self._queue_directory).enqueue(
+                self._msg, format='raw')
+        switchboard = Switchboard('test', self._queue_directory)
+        pickled = switchboard.enqueue(self._msg, format='pickle')
+        self.assertFalse(self._read(pickled).startswith(qfile.MAGIC))
+        for filebase in (raw, pickled):
+            msg, msgdata = switchboard.dequeue(filebase)
+            self.assertEqual(msg['message-id'], '<ant>')
+
+    @configuration('runner.test', qfile_format='raw')
+    def test_recover_backup_files(self):
+        switchboard = Switchboard('test', self._queue_directory)
+        filebase = switchboard.enqueue(self._msg)
+        switchboard.dequeue(filebase)
+        for count in range(1, MAX_BAK_COUNT):
+            switchboard = Switchboard(
+                'test', self._queue_directory, recover=True)
+            self.assertEqual(switchboard.files, [filebase])
+            msg, msgdata = switchboard.dequeue(filebase)
+            self.assertEqual(msgdata['_bak_count'], count)
+            self.assertEqual(msg['message-id'], '<ant>')
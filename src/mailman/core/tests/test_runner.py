@@ -18,6 +18,8 @@
 """Test some Runner base class behavior."""
 
 __all__ = [
+    'TestArrivals',
+    'TestColocation',
     'TestRunner',
     ]
 
@@ -27,13 +29,19 @@ import unittest
 from mailman.app.lifecycle import create_list
 from mailman.config import config
 from mailman.core.runner import Runner
+from mailman.core.switchboard import Switchboard
+from mailman.interfaces.action import Action
 from mailman.interfaces.runner import RunnerCrashEvent
+from mailman.interfaces.usermanager import IUserManager
+from mailman.runners.incoming import IncomingRunner
 from mailman.runners.virgin import VirginRunner
 from mailman.testing.helpers import (
     LogFileMark, configuration, event_subscribers, get_queue_messages,
     make_digest_messages, make_testable_runner,
-    specialized_message_from_string as mfs)
+    specialized_message_from_string as mfs, subscribe)
 from mailman.testing.layers import ConfigLayer
+from unittest.mock import patch
+from zope.component import getUtility
 
 
 
@@ -42,7 +50,31 @@ class CrashingRunner(Runner):
         raise RuntimeError('borked')
 
 
+
+class SometimesCrashingRunner(Runner):
+    def _dispose(self, mlist, msg, msgdata):
+        # Make a database change, which must be rolled back if we crash.
+        getUtility(IUserManager).create_address(msg['from'])
+        if msgdata.get('crash'):
+            raise RuntimeError('borked')
+        config.switchboards['out'].enqueue(msg, msgdata)
+
+
 
+processed = []
+arriving = []
+
+class ArrivalRunner(Runner):
+    def _dispose(self, mlist, msg, msgdata):
+        processed.append(msg['message-id'])
+        # Entries arrive while the first one is being processed.
+        while len(arriving) > 0:
+            message_id, msgdata = arriving.pop(0)
+            config.switchboards[self.name].enqueue(
+                mfs('Message-ID: {0}\n\n'.format(message_id)), msgdata)
+
+
+
 class TestRunner(unittest.TestCase):
     """Test the Runner base class behavior."""
 
@@ -120,3 +152,198 @@ Message-ID: <ant>
         # The list's -request address is the original sender.
         self.assertEqual(bag.msgdata['original_sender'],
                          'test-request@example.com')
+
+    def test_stale_index_entry(self):
+        # The switchboard's index can name an entry which has already been
+        # dequeued.  The runner just skips it.
+        msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        runner = make_testable_runner(CrashingRunner, 'in')
+        filebase = config.switchboards['in'].enqueue(
+            msg, listid='test.example.com')
+        runner.switchboard.notify(None)
+        files = runner.switchboard.next_files()
+        self.assertEqual(next(files), filebase)
+        # Put it back in the index, but take it out of the queue.
+        runner.switchboard.notify([filebase + '.pck'])
+        config.switchboards['in'].dequeue(filebase)
+        config.switchboards['in'].finish(filebase)
+        error_log = LogFileMark('mailman.error')
+        self.assertEqual(runner._one_iteration(), 1)
+        self.assertEqual(error_log.read(), '')
+        self.assertEqual(len(get_queue_messages('shunt')), 0)
+        self.assertEqual(len(get_queue_messages('bad')), 0)
+
+    @configuration('runner.in', batch_size=10)
+    @configuration('runner.out', durability='group')
+    def test_batch(self):
+        # In batch mode, a message which crashes the runner is shunted on its
+        # own, and only its database changes are rolled back.
+        for person, crash in (('anne', False),
+                              ('bart', True),
+                              ('cris', False)):
+            msg = mfs("""\
+From: {0}@example.com
+To: test@example.com
+Message-ID: <{0}>
+
+""".format(person))
+            config.switchboards['in'].enqueue(
+                msg, listid='test.example.com', crash=crash)
+        runner = make_testable_runner(SometimesCrashingRunner, 'in')
+        self.assertEqual(runner.batch_size, 10)
+        runner.run()
+        shunted = get_queue_messages('shunt')
+        self.assertEqual(len(shunted), 1)
+        self.assertEqual(shunted[0].msg['message-id'], '<bart>')
+        messages = get_queue_messages('out')
+        self.assertEqual(sorted(bag.msg['message-id'] for bag in messages),
+                         ['<anne>', '<cris>'])
+        self.assertEqual(len(get_queue_messages('in')), 0)
+        self.assertEqual(runner.switchboard.get_files('.bak'), [])
+        # The database changes were committed, except for the crasher's.
+        user_manager = getUtility(IUserManager)
+        config.db.abort()
+        self.assertIsNotNone(user_manager.get_address('anne@example.com'))
+        self.assertIsNone(user_manager.get_address('bart@example.com'))
+        self.assertIsNotNone(user_manager.get_address('cris@example.com'))
+
+
+
+class TestArrivals(unittest.TestCase):
+    """Test entries arriving while a runner works through its queue."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        create_list('test@example.com')
+        create_list('big@example.com')
+        del processed[:]
+        del arriving[:]
+
+    def _enqueue(self, message_id, **msgdata):
+        config.switchboards['in'].enqueue(
+            mfs('Message-ID: {0}\n\n'.format(message_id)), msgdata)
+
+    @configuration('runner.in', poll_interval='0s')
+    def test_high_priority_arrival(self):
+        # A high priority entry arriving during a backlog is served next.
+        for message_id in ('<ant>', '<bee>', '<cat>'):
+            self._enqueue(message_id, listid='test.example.com')
+        arriving.append(
+            ('<urgent>', dict(listid='test.example.com', priority='high')))
+        runner = make_testable_runner(ArrivalRunner, 'in')
+        runner.run()
+        self.assertEqual(processed, ['<ant>', '<urgent>', '<bee>', '<cat>'])
+
+    @configuration('runner.in', poll_interval='0s', fair_share='yes')
+    def test_other_list_arrival(self):
+        # An entry for another mailing list arriving while a big list's
+        # backlog is worked through gets its fair turn.
+        recipients = ['person{0}@example.com'.format(i) for i in range(100)]
+        for message_id in ('<ant>', '<bee>', '<cat>'):
+            self._enqueue(message_id, listid='big.example.com',
+                          recipients=recipients)
+        arriving.append(('<small>', dict(
+            listid='test.example.com', recipients=['anne@example.com'])))
+        runner = make_testable_runner(ArrivalRunner, 'in')
+        runner.run()
+        self.assertEqual(processed, ['<ant>', '<small>', '<bee>', '<cat>'])
+
+
+
+captured = []
+
+def capture(mlist, msg, msgdata):
+    captured.append(msg)
+
+
+class TestColocation(unittest.TestCase):
+    """Test runners processing entries in other runners' processes."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._mlist = create_list('test@example.com')
+        member = subscribe(self._mlist, 'Anne')
+        member.moderation_action = Action.accept
+        self._msg = mfs("""\
+From: aperson@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        del captured[:]
+
+    @configuration('runner.in', colocate='pipeline out')
+    @configuration('mta', outgoing='mailman.core.tests.test_runner.capture')
+    def test_colocated(self):
+        # An accepted post goes straight through the pipeline and out.
+        config.switchboards['in'].enqueue(self._msg, listid='test.example.com')
+        runner = make_testable_runner(IncomingRunner, 'in')
+        runner.run()
+        self.assertEqual(len(captured), 1)
+        self.assertEqual(captured[0]['message-id'], '<ant>')
+        self.assertEqual(len(get_queue_messages('pipeline')), 0)
+        self.assertEqual(len(get_queue_messages('out')), 0)
+
+    @configuration('runner.in', colocate='pipeline out')
+    @configuration('mta', outgoing='mailman.core.tests.test_runner.capture')
+    def test_backlog(self):
+        # When the out queue already has entries, the post joins them there.
+        config.switchboards['out'].enqueue(
+            mfs('Message-ID: <bee>\n\n'), listid='test.example.com')
+        config.switchboards['in'].enqueue(self._msg, listid='test.example.com')
+        runner = make_testable_runner(IncomingRunner, 'in')
+        runner.run()
+        self.assertEqual(captured, [])
+        self.assertEqual(len(get_queue_messages('pipeline')), 0)
+        messages = get_queue_messages('out')
+        self.assertEqual(sorted(bag.msg['message-id'] for bag in messages),
+                         ['<ant>', '<bee>'])
+
+    @configuration('runner.in', colocate='pipeline out')
+    @configuration('mta', outgoing='mailman.core.tests.test_runner.capture')
+    def test_no_rescans(self):
+        # Taking entries over doesn't scan the colocated queue each time.
+        for message_id in ('<ant>', '<bee>', '<cat>'):
+            del self._msg['message-id']
+            self._msg['Message-ID'] = message_id
+            config.switchboards['in'].enqueue(
+                self._msg, listid='test.example.com')
+        scanned = []
+        reconcile = Switchboard._reconcile
+        def record_scan(switchboard):
+            scanned.append(switchboard.name)
+            reconcile(switchboard)
+        runner = make_testable_runner(IncomingRunner, 'in')
+        with patch.object(Switchboard, '_reconcile', record_scan):
+            runner.run()
+        self.assertEqual(len(captured), 3)
+        self.assertEqual(scanned.count('pipeline'), 1)
+        self.assertEqual(scanned.count('out'), 1)
+
+    @configuration('runner.in', colocate='out')
+    @configuration('runner.out',
+                   **{'class': 'mailman.core.tests.test_runner.CrashingRunner'})
+    def test_colocated_crash(self):
+        # An entry which crashes its colocated runner is shunted for that
+        # runner's queue, and only its database changes are rolled back.
+        del self._msg['from']
+        self._msg['From'] = 'bart@example.com'
+        config.switchboards['in'].enqueue(self._msg, listid='test.example.com')
+        runner = make_testable_runner(SometimesCrashingRunner, 'in')
+        runner.run()
+        shunted = get_queue_messages('shunt')
+        self.assertEqual(len(shunted), 1)
+        self.assertEqual(shunted[0].msg['message-id'], '<ant>')
+        self.assertEqual(shunted[0].msgdata['whichq'], 'out')
+        self.assertEqual(len(get_queue_messages('in')), 0)
+        self.assertEqual(len(get_queue_messages('out')), 0)
+        config.db.abort()
+        user_manager = getUtility(IUserManager)
+        self.assertIsNotNone(user_manager.get_address('bart@example.com'))
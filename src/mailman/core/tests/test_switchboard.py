@@ -19,14 +19,24 @@
 
 __all__ = [
     'TestSwitchboard',
+    'TestFairShare',
+    'TestGroupCommit',
+    'TestLanes',
+    'TestSlices',
+    'TestSwitchboardIndex',
     ]
 
 
+import os
+import shutil
+import tempfile
 import unittest
 
 from mailman.config import config
+from mailman.core.switchboard import (
+    Switchboard, get_slice_count, group_commit, set_slice_count)
 from mailman.testing.helpers import (
-    LogFileMark,
+    LogFileMark, configuration,
     specialized_message_from_string as mfs)
 from mailman.testing.layers import ConfigLayer
 from unittest.mock import patch
@@ -56,3 +66,361 @@ Message-ID: <ant>
         traceback = error_log.read().splitlines()
         self.assertEqual(traceback[1], 'Traceback (most recent call last):')
         self.assertEqual(traceback[-1], 'OSError: Oops!')
+
+
+
+class TestSwitchboardIndex(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._queue_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._queue_directory)
+        self._switchboard = Switchboard('test', self._queue_directory)
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+
+    def test_next_files_fifo(self):
+        filebases = [self._switchboard.enqueue(self._msg) for i in range(5)]
+        self.assertEqual(list(self._switchboard.next_files()), filebases)
+        # The index is now empty, even though the files are still there.
+        self.assertEqual(list(self._switchboard.next_files()), [])
+        self.assertEqual(self._switchboard.files, filebases)
+
+    def test_next_files_count(self):
+        filebases = [self._switchboard.enqueue(self._msg) for i in range(5)]
+        self.assertEqual(list(self._switchboard.next_files(2)),
+                         filebases[:2])
+        self.assertEqual(list(self._switchboard.next_files(2)),
+                         filebases[2:4])
+        self.assertEqual(list(self._switchboard.next_files()),
+                         filebases[4:])
+
+    def test_notify_names(self):
+        # Build the index.
+        self.assertEqual(list(self._switchboard.next_files()), [])
+        other = Switchboard('test', self._queue_directory)
+        filebase_1 = other.enqueue(self._msg)
+        filebase_2 = other.enqueue(self._msg)
+        # The index doesn't know about the new files until it's told.
+        self.assertEqual(list(self._switchboard.next_files()), [])
+        self._switchboard.notify(
+            [filebase_2 + '.pck', filebase_1 + '.pck', filebase_1 + '.pck',
+             filebase_1 + '.bak', 'junk.tmp'])
+        self.assertEqual(list(self._switchboard.next_files()),
+                         [filebase_1, filebase_2])
+
+    def test_notify_rescan(self):
+        self.assertEqual(list(self._switchboard.next_files()), [])
+        other = Switchboard('test', self._queue_directory)
+        filebase = other.enqueue(self._msg)
+        self._switchboard.notify(None)
+        self.assertEqual(list(self._switchboard.next_files()), [filebase])
+
+    def test_notify_slices(self):
+        slice_0 = Switchboard('test', self._queue_directory, 0, 2)
+        slice_1 = Switchboard('test', self._queue_directory, 1, 2)
+        self.assertEqual(list(slice_0.next_files()), [])
+        self.assertEqual(list(slice_1.next_files()), [])
+        names = [self._switchboard.enqueue(self._msg) + '.pck'
+                 for i in range(20)]
+        slice_0.notify(names)
+        slice_1.notify(names)
+        files_0 = set(slice_0.next_files())
+        files_1 = set(slice_1.next_files())
+        self.assertEqual(files_0 & files_1, set())
+        self.assertEqual(files_0 | files_1,
+                         set(os.path.splitext(name)[0] for name in names))
+
+    @configuration('runner.test', reconcile_interval='0s')
+    def test_reconcile(self):
+        # With no reconciliation interval, the index is rebuilt every time.
+        switchboard = Switchboard('test', self._queue_directory)
+        self.assertEqual(list(switchboard.next_files()), [])
+        filebase = self._switchboard.enqueue(self._msg)
+        self.assertEqual(list(switchboard.next_files()), [filebase])
+
+
+
+class TestLanes(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._queue_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._queue_directory)
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+
+    @configuration('runner.test', bulk_recipients=3)
+    def test_higher_lanes_first(self):
+        switchboard = Switchboard('test', self._queue_directory)
+        bulk = switchboard.enqueue(self._msg, recipients=['a', 'b', 'c'])
+        normal = switchboard.enqueue(self._msg, recipients=['a', 'b'])
+        high = switchboard.enqueue(self._msg, tomoderators=True)
+        fasttrack = switchboard.enqueue(self._msg, _fasttrack=True)
+        explicit = switchboard.enqueue(self._msg, priority='high',
+                                       recipients=['a', 'b', 'c'])
+        self.assertEqual(list(switchboard.next_files()),
+                         [high, fasttrack, explicit, normal, bulk])
+        # The files attribute is still in FIFO order.
+        self.assertEqual(switchboard.files,
+                         [bulk, normal, high, fasttrack, explicit])
+
+    def test_old_file_bases(self):
+        # File bases without a lane are in the normal lane.
+        switchboard = Switchboard('test', self._queue_directory)
+        self.assertEqual(list(switchboard.next_files()), [])
+        high = switchboard.enqueue(self._msg, priority='high')
+        normal = switchboard.enqueue(self._msg)
+        old = '+'.join(normal.split('+')[:2])
+        os.rename(os.path.join(self._queue_directory, normal + '.pck'),
+                  os.path.join(self._queue_directory, old + '.pck'))
+        switchboard.notify([old + '.pck', high + '.pck'])
+        self.assertEqual(list(switchboard.next_files()), [high, old])
+        msg, msgdata = switchboard.dequeue(old)
+        self.assertEqual(msg['message-id'], '<ant>')
+
+    @configuration('runner.test', bulk_recipients=3)
+    def test_bad_priority(self):
+        # An unknown priority is logged, and the entry goes in the lane it
+        # would have gone in without one.
+        switchboard = Switchboard('test', self._queue_directory)
+        normal = switchboard.enqueue(self._msg)
+        error_log = LogFileMark('mailman.error')
+        bulk = switchboard.enqueue(self._msg, priority='urgent',
+                                   recipients=['a', 'b', 'c'])
+        high = switchboard.enqueue(self._msg, priority='urgent',
+                                   tomoderators=True)
+        self.assertIn("Ignoring bad priority in test queue: 'urgent'",
+                      error_log.read())
+        self.assertEqual(list(switchboard.next_files()), [high, normal, bulk])
+
+    @configuration('runner.test', starvation_limit=2)
+    def test_no_starvation(self):
+        switchboard = Switchboard('test', self._queue_directory)
+        bulk = switchboard.enqueue(self._msg, priority='bulk')
+        high = [switchboard.enqueue(self._msg, priority='high')
+                for i in range(5)]
+        self.assertEqual(list(switchboard.next_files()),
+                         high[:2] + [bulk] + high[2:])
+
+
+
+class TestFairShare(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._queue_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._queue_directory)
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+
+    def _enqueue(self, switchboard, list_id, count, recipients=10):
+        return [switchboard.enqueue(self._msg, listid=list_id,
+                                    recipients=list(range(recipients)))
+                for i in range(count)]
+
+    @configuration('runner.test', fair_share='yes', fair_quantum=10)
+    def test_lists_take_turns(self):
+        switchboard = Switchboard('test', self._queue_directory)
+        big = self._enqueue(switchboard, 'big.example.com', 5)
+        small = self._enqueue(switchboard, 'small.example.com', 2)
+        self.assertEqual(list(switchboard.next_files()),
+                         [big[0], small[0], big[1], small[1]] + big[2:])
+
+    @configuration('runner.test', fair_share='yes', fair_quantum=10)
+    def test_recipient_counts(self):
+        # An entry with many recipients uses up its list's turns.
+        switchboard = Switchboard('test', self._queue_directory)
+        big = self._enqueue(switchboard, 'big.example.com', 2, 30)
+        small = self._enqueue(switchboard, 'small.example.com', 4)
+        self.assertEqual(list(switchboard.next_files()),
+                         small[:2] + big[:1] + small[2:] + big[1:])
+
+    @configuration('runner.test', fair_share='yes', fair_quantum=10,
+                   list_weights='big.example.com:2')
+    def test_weights(self):
+        switchboard = Switchboard('test', self._queue_directory)
+        big = self._enqueue(switchboard, 'big.example.com', 4)
+        small = self._enqueue(switchboard, 'small.example.com', 2)
+        self.assertEqual(list(switchboard.next_files()),
+                         big[:2] + small[:1] + big[2:] + small[1:])
+
+    def test_fifo_without_fair_share(self):
+        switchboard = Switchboard('test', self._queue_directory)
+        big = self._enqueue(switchboard, 'big.example.com', 3)
+        small = self._enqueue(switchboard, 'small.example.com', 1)
+        self.assertEqual(list(switchboard.next_files()), big + small)
+
+
+
+class TestGroupCommit(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._queue_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._queue_directory)
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+
+    @configuration('runner.test', durability='group')
+    def test_deferred_enqueue(self):
+        switchboard = Switchboard('test', self._queue_directory)
+        with group_commit():
+            filebase = switchboard.enqueue(self._msg)
+            # The entry isn't visible until the group is committed.
+            self.assertEqual(switchboard.files, [])
+        self.assertEqual(switchboard.files, [filebase])
+        # Outside of a group commit, entries are written immediately.
+        other = switchboard.enqueue(self._msg)
+        self.assertEqual(switchboard.files, [filebase, other])
+
+    @configuration('runner.test', durability='fsync')
+    def test_fsync_enqueue(self):
+        # Queues with fsync durability don't take part in group commits.
+        switchboard = Switchboard('test', self._queue_directory)
+        with group_commit():
+            filebase = switchboard.enqueue(self._msg)
+            self.assertEqual(switchboard.files, [filebase])
+
+    @configuration('runner.test', durability='buffered')
+    def test_buffered_enqueue(self):
+        switchboard = Switchboard('test', self._queue_directory)
+        with group_commit():
+            filebase = switchboard.enqueue(self._msg)
+            self.assertEqual(switchboard.files, [filebase])
+        self.assertEqual(switchboard.files, [filebase])
+
+    def test_deferred_finish(self):
+        switchboard = Switchboard('test', self._queue_directory)
+        filebase = switchboard.enqueue(self._msg)
+        switchboard.dequeue(filebase)
+        with group_commit():
+            switchboard.finish(filebase)
+            self.assertEqual(switchboard.get_files('.bak'), [filebase])
+        self.assertEqual(switchboard.get_files('.bak'), [])
+
+    @configuration('runner.test', durability='group')
+    def test_failed_group(self):
+        # When the group fails, nothing it wrote becomes visible, and nothing
+        # it finished is removed.
+        switchboard = Switchboard('test', self._queue_directory)
+        filebase = switchboard.enqueue(self._msg)
+        switchboard.dequeue(filebase)
+        with self.assertRaises(RuntimeError):
+            with group_commit():
+                switchboard.enqueue(self._msg)
+                switchboard.finish(filebase)
+                raise RuntimeError
+        self.assertEqual(switchboard.files, [])
+        self.assertEqual(switchboard.get_files('.bak'), [filebase])
+        self.assertEqual(os.listdir(self._queue_directory),
+                         [filebase + '.bak'])
+
+
+
+class TestSlices(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._queue_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._queue_directory)
+        self._switchboard = Switchboard('test', self._queue_directory)
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+
+    def _owners(self, filebases, count):
+        owners = {}
+        for slice_number in range(count):
+            switchboard = Switchboard(
+                'test', self._queue_directory, slice_number, count)
+            for filebase in switchboard.files:
+                self.assertNotIn(filebase, owners)
+                owners[filebase] = slice_number
+        self.assertEqual(set(owners), set(filebases))
+        return owners
+
+    def test_any_number_of_slices(self):
+        filebases = [self._switchboard.enqueue(self._msg) for i in range(60)]
+        owners = self._owners(filebases, 3)
+        # Every slice gets some of the entries.
+        self.assertEqual(set(owners.values()), {0, 1, 2})
+
+    def test_few_entries_move(self):
+        # When a queue goes from 4 to 6 slices, only the entries which the
+        # new slices take over change owner.
+        filebases = [self._switchboard.enqueue(self._msg) for i in range(300)]
+        before = self._owners(filebases, 4)
+        after = self._owners(filebases, 6)
+        moved = [filebase for filebase in filebases
+                 if before[filebase] != after[filebase]]
+        self.assertEqual(
+            set(after[filebase] for filebase in moved), {4, 5})
+        self.assertLess(len(moved), 200)
+
+    def test_slice_count_file(self):
+        self.assertEqual(get_slice_count(self._queue_directory, 4), 4)
+        set_slice_count(self._queue_directory, 3)
+        self.assertEqual(get_slice_count(self._queue_directory, 4), 3)
+        # The count file isn't a queue entry.
+        self.assertEqual(self._switchboard.files, [])
+
+    def test_rescale(self):
+        filebases = [self._switchboard.enqueue(self._msg) for i in range(40)]
+        slice_0 = Switchboard('test', self._queue_directory, 0, 1)
+        self.assertEqual(len(list(slice_0.next_files(1))), 1)
+        # The queue is split in two, so the first slice's index is rebuilt
+        # and it now only sees its half of the queue.
+        set_slice_count(self._queue_directory, 2)
+        slice_1 = Switchboard('test', self._queue_directory, 1, 1)
+        files_0 = set(slice_0.next_files())
+        files_1 = set(slice_1.next_files())
+        self.assertEqual(files_0 & files_1, set())
+        self.assertEqual(files_0 | files_1, set(filebases))
+
+    def test_locked_backup_files_are_not_recovered(self):
+        filebase = self._switchboard.enqueue(self._msg)
+        # Another runner process dequeues the entry and is still working on
+        # it when this process tries to recover it.
+        ready_read, ready_write = os.pipe()
+        done_read, done_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                switchboard = Switchboard('test', self._queue_directory)
+                switchboard.dequeue(filebase)
+                os.write(ready_write, b'x')
+                os.read(done_read, 1)
+            finally:
+                os._exit(0)
+        os.read(ready_read, 1)
+        try:
+            Switchboard('test', self._queue_directory, recover=True)
+            self.assertEqual(self._switchboard.get_files('.bak'), [filebase])
+        finally:
+            os.write(done_write, b'x')
+            os.waitpid(pid, 0)
+            for fd in (ready_read, ready_write, done_read, done_write):
+                os.close(fd)
+        # Now that the other process has gone away, the entry is recovered.
+        Switchboard('test', self._queue_directory, recover=True)
+        self.assertEqual(self._switchboard.files, [filebase])
@@ -0,0 +1,137 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test waiting for new queue entries."""
+
+__all__ = [
+    'TestRunnerWakeup',
+    'TestWatchers',
+    ]
+
+
+import time
+import shutil
+import tempfile
+import unittest
+import threading
+
+from mailman.config import config
+from mailman.core.logswitchboard import LogSwitchboard
+from mailman.core.runner import Runner
+from mailman.core.switchboard import Switchboard
+from mailman.core.watcher import InotifyWatcher, PollingWatcher, make_watcher
+from mailman.testing.helpers import (
+    configuration, specialized_message_from_string as mfs)
+from mailman.testing.layers import ConfigLayer
+
+
+try:
+    InotifyWatcher(tempfile.gettempdir()).close()
+except OSError:
+    HAS_INOTIFY = False
+else:
+    HAS_INOTIFY = True
+
+
+
+
+class TestWatchers(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._queue_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._queue_directory)
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+
+    def _watch(self, watcher):
+        self.addCleanup(watcher.close)
+        return watcher
+
+    @unittest.skipUnless(HAS_INOTIFY, 'inotify is not available')
+    def test_inotify_names_enqueued_files(self):
+        switchboard = Switchboard('test', self._queue_directory)
+        watcher = self._watch(InotifyWatcher(self._queue_directory))
+        filebase = switchboard.enqueue(self._msg)
+        self.assertEqual(watcher.wait(1), [filebase + '.pck'])
+        # There's nothing more to report.
+        self.assertEqual(watcher.wait(0), [])
+
+    @unittest.skipUnless(HAS_INOTIFY, 'inotify is not available')
+    def test_inotify_log_switchboard(self):
+        switchboard = LogSwitchboard('test', self._queue_directory)
+        watcher = self._watch(InotifyWatcher(self._queue_directory))
+        switchboard.enqueue(self._msg)
+        # The directory was touched, but no entry file was added.
+        self.assertIsNone(watcher.wait(1))
+
+    def test_polling(self):
+        watcher = self._watch(PollingWatcher(self._queue_directory, 0.01))
+        self.assertEqual(watcher.wait(0.05), [])
+        # Make sure the directory's modification time visibly changes.
+        time.sleep(0.01)
+        Switchboard('test', self._queue_directory).enqueue(self._msg)
+        self.assertIsNone(watcher.wait(1))
+        self.assertEqual(watcher.wait(0), [])
+
+    def test_timeout(self):
+        watcher = make_watcher(self._queue_directory, 'inotify', 0.01)
+        self._watch(watcher)
+        start = time.time()
+        self.assertEqual(watcher.wait(0.1), [])
+        self.assertGreaterEqual(time.time() - start, 0.09)
+
+    def test_sleep(self):
+        self.assertIsNone(make_watcher(self._queue_directory, 'sleep', 0.01))
+
+
+
+
+class TestRunnerWakeup(unittest.TestCase):
+    layer = ConfigLayer
+
+    def _snooze_time(self):
+        # The runner would sleep for a long time, but it gets woken up when
+        # something is enqueued shortly after it starts waiting.
+        runner = Runner('in')
+        msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        timer = threading.Timer(
+            0.2, config.switchboards['in'].enqueue, (msg,))
+        start = time.time()
+        timer.start()
+        runner._snooze(0)
+        elapsed = time.time() - start
+        timer.join()
+        runner._watcher.close()
+        return elapsed
+
+    @configuration('runner.in', sleep_time='10s', wakeup='inotify')
+    def test_inotify_wakeup(self):
+        self.assertLess(self._snooze_time(), 5)
+
+    @configuration('runner.in', sleep_time='10s', wakeup='poll')
+    def test_poll_wakeup(self):
+        self.assertLess(self._snooze_time(), 5)
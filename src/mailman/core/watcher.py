@@ -0,0 +1,182 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Waiting for new entries in queue directories.
+
+An idle runner used to sleep for its whole `sleep_time` before looking at its
+queue directory again.  A watcher lets it block until something is enqueued
+instead.  On Linux, the kernel's inotify facility tells us the moment an entry
+is moved into the queue directory.  Elsewhere we fall back to polling the
+directory's modification time, which is still much cheaper than listing it.
+"""
+
+__all__ = [
+    'InotifyWatcher',
+    'PollingWatcher',
+    'make_watcher',
+    ]
+
+
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import logging
+import ctypes.util
+
+
+# From <sys/inotify.h>.
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+# struct inotify_event: wd, mask, cookie, len, followed by the name.
+EVENT_HEADER = struct.Struct('iIII')
+
+log = logging.getLogger('mailman.runner')
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return None
+    if not hasattr(libc, 'inotify_init1'):
+        return None
+    return libc
+
+_libc = _load_libc()
+
+
+
+class InotifyWatcher:
+    """Wait for queue entries using inotify."""
+
+    def __init__(self, directory):
+        if _libc is None:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self._fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        # Files are moved into the queue directory once they are complete.
+        # Switchboards that don't create files touch the directory itself.
+        wd = _libc.inotify_add_watch(
+            self._fd, os.fsencode(directory), IN_MOVED_TO | IN_ATTRIB)
+        if wd < 0:
+            error = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(error, os.strerror(error), directory)
+
+    def wait(self, timeout):
+        """Wait for something to be added to the directory.
+
+        :param timeout: The maximum number of seconds to wait.
+        :type timeout: float
+        :return: The names of the files added to the directory, which is
+            empty if nothing happened before the timeout.  None is returned
+            if something changed, but we can't tell exactly what.
+        :rtype: list of strings, or None
+        """
+        try:
+            readable, writable, exceptional = select.select(
+                [self._fd], [], [], timeout)
+        except InterruptedError:
+            # A signal arrived; let the runner check whether it should stop.
+            return []
+        if len(readable) == 0:
+            return []
+        names = []
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(
+                    data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if mask & IN_Q_OVERFLOW or len(name) == 0:
+                    # Either events were lost, or the directory itself was
+                    # touched.  Either way, the directory must be rescanned.
+                    names = None
+                elif names is not None:
+                    names.append(os.fsdecode(name))
+        return names
+
+    def close(self):
+        """Stop watching the directory."""
+        os.close(self._fd)
+
+
+
+class PollingWatcher:
+    """Wait for queue entries by polling the directory modification time."""
+
+    def __init__(self, directory, interval):
+        self._directory = directory
+        self._interval = interval
+        self._mtime = os.stat(directory).st_mtime_ns
+
+    def wait(self, timeout):
+        """See `InotifyWatcher`."""
+        until = time.time() + timeout
+        while True:
+            mtime = os.stat(self._directory).st_mtime_ns
+            if mtime != self._mtime:
+                self._mtime = mtime
+                return None
+            remaining = until - time.time()
+            if remaining <= 0:
+                return []
+            time.sleep(min(self._interval, remaining))
+
+    def close(self):
+        """See `InotifyWatcher`."""
+        pass
+
+
+
+def make_watcher(directory, method, interval):
+    """Create a watcher for a queue directory.
+
+    :param directory: The queue directory to watch.
+    :type directory: string
+    :param method: The wakeup method, either 'inotify' or 'poll'.  When
+        inotify is not available, polling is used instead.
+    :type method: string
+    :param interval: For polling, the number of seconds between checks.
+    :type interval: float
+    :return: The watcher, or None if the method is 'sleep'.
+    """
+    if method == 'sleep':
+        return None
+    if method == 'inotify':
+        try:
+            return InotifyWatcher(directory)
+        except OSError as error:
+            log.info('Cannot watch %s, polling instead: %s',
+                     directory, error)
+    else:
+        assert method == 'poll', 'Unknown wakeup method: {}'.format(method)
+    return PollingWatcher(directory, interval)
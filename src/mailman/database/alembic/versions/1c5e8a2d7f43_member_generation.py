@@ -0,0 +1,27 @@
+"""Member generation
+
+Revision ID: 1c5e8a2d7f43
+Revises: 4bd95c99b2e
+Create Date: 2015-04-24 11:52:30.574162
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1c5e8a2d7f43'
+down_revision = '4bd95c99b2e'
+
+from alembic import op
+import sqlalchemy as sa
+
+from mailman.database.types import UUID
+
+
+def upgrade():
+    op.add_column('mailinglist', sa.Column(
+        'member_generation', UUID(), nullable=True))
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        # SQLite does not support dropping columns.
+        op.drop_column('mailinglist', 'member_generation')
@@ -0,0 +1,50 @@
+"""Retry store
+
+Revision ID: 3a2c4f1d6b8e
+Revises: 2bb9b382198
+Create Date: 2015-04-20 10:12:41.283417
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3a2c4f1d6b8e'
+down_revision = '2bb9b382198'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('retrymessage',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('message_id', sa.Unicode(), nullable=True),
+        sa.Column('list_id', sa.Unicode(), nullable=True),
+        sa.Column('deliver_until', sa.DateTime(), nullable=True),
+        sa.Column('message', sa.LargeBinary(), nullable=True),
+        sa.Column('msgdata', sa.LargeBinary(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+        )
+    op.create_table('retryrecipient',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('email', sa.Unicode(), nullable=True),
+        sa.Column('domain', sa.Unicode(), nullable=True),
+        sa.Column('next_attempt', sa.DateTime(), nullable=True),
+        sa.Column('attempts', sa.Integer(), nullable=True),
+        sa.Column('last_response', sa.Unicode(), nullable=True),
+        sa.Column('retry_message_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['retry_message_id'], ['retrymessage.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+    op.create_index(op.f('ix_retryrecipient_next_attempt'),
+                    'retryrecipient', ['next_attempt'], unique=False)
+    op.create_index(op.f('ix_retryrecipient_retry_message_id'),
+                    'retryrecipient', ['retry_message_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_retryrecipient_retry_message_id'),
+                  table_name='retryrecipient')
+    op.drop_index(op.f('ix_retryrecipient_next_attempt'),
+                  table_name='retryrecipient')
+    op.drop_table('retryrecipient')
+    op.drop_table('retrymessage')
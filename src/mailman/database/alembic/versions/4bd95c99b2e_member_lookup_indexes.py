@@ -0,0 +1,31 @@
+"""Member lookup indexes
+
+Revision ID: 4bd95c99b2e
+Revises: 3a2c4f1d6b8e
+Create Date: 2015-04-22 14:37:05.118264
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4bd95c99b2e'
+down_revision = '3a2c4f1d6b8e'
+
+from alembic import op
+
+
+def upgrade():
+    op.create_index(op.f('ix_address_email'),
+                    'address', ['email'], unique=False)
+    op.create_index(op.f('ix_member_list_id'),
+                    'member', ['list_id'], unique=False)
+    op.create_index(op.f('ix_member_address_id'),
+                    'member', ['address_id'], unique=False)
+    op.create_index(op.f('ix_member_user_id'),
+                    'member', ['user_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_member_user_id'), table_name='member')
+    op.drop_index(op.f('ix_member_address_id'), table_name='member')
+    op.drop_index(op.f('ix_member_list_id'), table_name='member')
+    op.drop_index(op.f('ix_address_email'), table_name='address')
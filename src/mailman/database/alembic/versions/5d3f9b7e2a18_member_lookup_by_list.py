@@ -0,0 +1,31 @@
+"""Member lookup by list
+
+Revision ID: 5d3f9b7e2a18
+Revises: 1c5e8a2d7f43
+Create Date: 2015-04-27 09:14:52.703916
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5d3f9b7e2a18'
+down_revision = '1c5e8a2d7f43'
+
+from alembic import op
+
+
+def upgrade():
+    op.drop_index(op.f('ix_member_address_id'), table_name='member')
+    op.drop_index(op.f('ix_member_user_id'), table_name='member')
+    op.create_index('ix_member_address_id_list_id',
+                    'member', ['address_id', 'list_id'], unique=False)
+    op.create_index('ix_member_user_id_list_id',
+                    'member', ['user_id', 'list_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_member_user_id_list_id', table_name='member')
+    op.drop_index('ix_member_address_id_list_id', table_name='member')
+    op.create_index(op.f('ix_member_user_id'),
+                    'member', ['user_id'], unique=False)
+    op.create_index(op.f('ix_member_address_id'),
+                    'member', ['address_id'], unique=False)
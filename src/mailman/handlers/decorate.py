@@ -21,6 +21,7 @@ __all__ = [
     'Decorate',
     'decorate',
     'decorate_template',
+    'decoration_data',
     ]
 
 
@@ -47,20 +48,7 @@ def process(mlist, msg, msgdata):
     # Digests and Mailman-craft messages should not get additional headers.
     if msgdata.get('isdigest') or msgdata.get('nodecorate'):
         return
-    d = {}
-    member = msgdata.get('member')
-    if member is not None:
-        # Calculate the extra personalization dictionary.
-        recipient = msgdata.get('recipient', member.address.original_email)
-        d['user_address'] = recipient
-        d['user_delivered_to'] = member.address.original_email
-        d['user_language'] = member.preferred_language.description
-        d['user_name'] = (member.user.display_name
-                          if member.user.display_name
-                          else member.address.original_email)
-        d['user_optionsurl'] = member.options_url
-    # These strings are descriptive for the log file and shouldn't be i18n'd
-    d.update(msgdata.get('decoration-data', {}))
+    d = decoration_data(msgdata)
     try:
         header = decorate(mlist, mlist.header_uri, d)
     except URLError:
@@ -197,6 +185,26 @@ def process(mlist, msg, msgdata):
     msg['Content-Type'] = 'multipart/mixed'
 
 
+
+def decoration_data(msgdata):
+    """Return the extra interpolation variables for a message's recipient."""
+    d = {}
+    member = msgdata.get('member')
+    if member is not None:
+        # Calculate the extra personalization dictionary.
+        recipient = msgdata.get('recipient', member.address.original_email)
+        d['user_address'] = recipient
+        d['user_delivered_to'] = member.address.original_email
+        d['user_language'] = member.preferred_language.description
+        d['user_name'] = (member.user.display_name
+                          if member.user.display_name
+                          else member.address.original_email)
+        d['user_optionsurl'] = member.options_url
+    # These strings are descriptive for the log file and shouldn't be i18n'd
+    d.update(msgdata.get('decoration-data', {}))
+    return d
+
+
 
 def decorate(mlist, uri, extradict=None):
     """Expand the decoration template from its URI."""
@@ -28,11 +28,11 @@ __all__ = [
     ]
 
 
+from mailman.app.recipients import get_regular_recipients
 from mailman.config import config
 from mailman.core import errors
 from mailman.core.i18n import _
 from mailman.interfaces.handler import IHandler
-from mailman.interfaces.member import DeliveryStatus
 from mailman.utilities.string import wrap
 from zope.interface import implementer
 
@@ -84,9 +84,7 @@ for delivery.  The original message as received by Mailman is attached.
 """)
                 raise errors.RejectMessage(wrap(text))
         # Calculate the regular recipients of the message
-        recipients = set(member.address.email
-                         for member in mlist.regular_members.members
-                         if member.delivery_status == DeliveryStatus.enabled)
+        recipients = get_regular_recipients(mlist)
         # Remove the sender if they don't want to receive their own posts
         if not include_sender and member.address.email in recipients:
             recipients.remove(member.address.email)
@@ -247,6 +247,10 @@ class IMailingList(Interface):
         deliver disabled or not, or of the type of digest they are to
         receive.""")
 
+    member_generation = Attribute(
+        """A token which changes whenever the mailing list's members, their
+        addresses or their delivery preferences change.""")
+
     subscription_policy = Attribute(
         """The policy for subscribing new members to the list.""")
 
@@ -22,6 +22,7 @@ __all__ = [
     'DeliveryMode',
     'DeliveryStatus',
     'IMember',
+    'MemberAddressChangeEvent',
     'MemberRole',
     'MembershipChangeEvent',
     'MembershipError',
@@ -88,6 +89,14 @@ class SubscriptionEvent(MembershipChangeEvent):
         return '{0} joined {1}'.format(self.member.address, self.mlist.list_id)
 
 
+class MemberAddressChangeEvent(MembershipChangeEvent):
+    """Event which gets triggered when a member's address changes."""
+
+    def __str__(self):
+        return '{0} changed address on {1}'.format(
+            self.member.address, self.mlist.list_id)
+
+
 class UnsubscriptionEvent(MembershipChangeEvent):
     """Event which gets triggered when a user leaves a mailing list.
 
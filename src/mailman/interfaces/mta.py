@@ -18,9 +18,11 @@
 """Interface for mail transport agent integration."""
 
 __all__ = [
+    'IMailExchangerResolver',
     'IMailTransportAgentAliases',
     'IMailTransportAgentDelivery',
     'IMailTransportAgentLifecycle',
+    'IRecipientChunker',
     ]
 
 
@@ -31,10 +33,13 @@ from zope.interface import Interface
 
 class SomeRecipientsFailed(MailmanError):
     """Delivery to some or all recipients failed"""
-    def __init__(self, temporary_failures, permanent_failures):
+    def __init__(self, temporary_failures, permanent_failures,
+                 responses=None):
         super(SomeRecipientsFailed, self).__init__()
         self.temporary_failures = temporary_failures
         self.permanent_failures = permanent_failures
+        # The SMTP response for each failed recipient, where it is known.
+        self.responses = ({} if responses is None else responses)
 
 
 
@@ -116,3 +121,41 @@ class IMailTransportAgentDelivery(Interface):
         :return: delivery failures as defined by `smtplib.SMTP.sendmail`
         :rtype: dictionary
         """
+
+
+
+class IRecipientChunker(Interface):
+    """A strategy for splitting bulk delivery recipients into chunks.
+
+    Implementations are created with the maximum number of recipients per
+    chunk, where zero or less means there is no maximum.
+    """
+
+    def chunkify(recipients):
+        """Split a set of recipients into chunks.
+
+        Each chunk is delivered in a separate SMTP transaction, in the order
+        the chunks are returned.
+
+        :param recipients: The recipient email addresses.
+        :type recipients: sequence of strings
+        :return: The chunks, none of which are empty or contain more than the
+            maximum number of recipients.
+        :rtype: iterator of sets of strings
+        """
+
+
+
+class IMailExchangerResolver(Interface):
+    """Find the mail exchangers for domains."""
+
+    def get_exchangers(domain):
+        """Return the mail exchangers for a domain.
+
+        :param domain: The domain.
+        :type domain: string
+        :return: The host names of the domain's mail exchangers, in order of
+            preference.  This is empty if the domain has no mail exchangers
+            or they can't be found.
+        :rtype: list of strings
+        """
@@ -19,12 +19,26 @@
 
 __all__ = [
     'IPreferences',
+    'PreferencesChangeEvent',
     ]
 
 
 from zope.interface import Interface, Attribute
 
 
+
+class PreferencesChangeEvent:
+    """Event which gets triggered when a preference is set."""
+
+    def __init__(self, preferences, name):
+        self.preferences = preferences
+        self.name = name
+
+    def __str__(self):
+        return '<{0} {1}>'.format(self.__class__.__name__, self.name)
+
+
+
 
 class IPreferences(Interface):
     """Delivery related information."""
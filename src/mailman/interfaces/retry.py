@@ -0,0 +1,106 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Interfaces for retrying deliveries to recipients with temporary failures."""
+
+__all__ = [
+    'IRetryRecipient',
+    'IRetryStore',
+    ]
+
+
+from zope.interface import Attribute, Interface
+
+
+
+class IRetryRecipient(Interface):
+    """A recipient whose delivery is to be retried."""
+
+    email = Attribute('The email address of the recipient.')
+
+    domain = Attribute('The domain of the email address, in lower case.')
+
+    list_id = Attribute('The List-ID of the mailing list.')
+
+    message_id = Attribute('The Message-ID of the message.')
+
+    next_attempt = Attribute(
+        """When the delivery to the recipient is to be tried again.""")
+
+    attempts = Attribute(
+        """The number of times delivery to the recipient has been tried.""")
+
+    last_response = Attribute(
+        """The SMTP response to the last attempt, or None if unknown.""")
+
+
+
+class IRetryStore(Interface):
+    """The store of the deliveries to be retried.
+
+    Each message is stored once, however many of its recipients have to be
+    retried.  The recipients are tracked individually, and those which are
+    due are delivered in new delivery jobs, one for each domain.
+    """
+
+    def record(msg, msgdata, failures):
+        """Record the outcome of a delivery.
+
+        For a fresh delivery, the message is stored, along with the
+        temporarily failed recipients.  For a delivery job made by
+        `schedule()`, the recipients which didn't fail are forgotten.  Once
+        the message's retry period has run out, the failed recipients are
+        given up on.
+
+        :param msg: The message.
+        :type msg: `Message`
+        :param msgdata: The message metadata of the delivery.
+        :type msgdata: dict
+        :param failures: The temporarily failed recipients, mapped to the
+            SMTP response for each, or None.
+        :type failures: dict
+        :return: The number of recipients to be retried.
+        :rtype: int
+        """
+
+    def schedule(now=None):
+        """Make the delivery jobs for the recipients which are due.
+
+        The recipients of a job are not due again until the retry interval
+        has passed, so that if the job is lost, they are tried again.
+
+        :param now: The current time, for testing.
+        :type now: `datetime`
+        :return: The delivery jobs, as 2-tuples of the message and metadata
+            to be enqueued to the out queue.
+        :rtype: list
+        """
+
+    next_attempt = Attribute(
+        """When the next recipient is due, or None if there are none.""")
+
+    recipients = Attribute(
+        """An iterator over all the `IRetryRecipient`s, in due order.""")
+
+    def get_recipients(email):
+        """Return the deliveries to be retried for an email address.
+
+        :param email: The email address.
+        :type email: str
+        :return: The `IRetryRecipient`s for the address.
+        :rtype: iterator
+        """
@@ -18,7 +18,9 @@
 """Interface for a roster of members."""
 
 __all__ = [
+    'IDeliveryRoster',
     'IRoster',
+    'IRosterStatistics',
     ]
 
 
@@ -68,6 +70,20 @@ class IRoster(Interface):
         :rtype: `IMember` or None
         """
 
+    def get_members(emails):
+        """Get the members for many addresses at once.
+
+        This is like calling ``get_member()`` for each address, except that
+        it takes a constant number of queries, and the members are loaded
+        along with their addresses, users and preferences.
+
+        :param emails: The email addresses to search for.
+        :type emails: iterable of strings
+        :return: The members found, keyed by email address.  Addresses which
+            aren't members are missing.
+        :rtype: dict
+        """
+
     def get_memberships(email):
         """Get the memberships for the given address.
 
@@ -76,3 +92,34 @@ class IRoster(Interface):
         :return: All the memberships associated with this email address.
         :rtype: sequence of length 0, 1, or 2 of ``IMember``
         """
+
+
+
+class IDeliveryRoster(IRoster):
+    """A roster of the members getting a particular kind of delivery."""
+
+    recipients = Attribute(
+        """The set of email addresses of the members whose delivery is
+        enabled.
+
+        The members' effective delivery preferences are worked out by the
+        database, so the members themselves aren't loaded.""")
+
+
+
+
+class IRosterStatistics(Interface):
+    """Counting the members of many mailing lists at once."""
+
+    def get_counts(list_ids):
+        """Count the members of the mailing lists.
+
+        :param list_ids: The list ids of the mailing lists.
+        :type list_ids: iterable of strings
+        :return: For each list id, a dictionary mapping each `MemberRole` to
+            the number of members with that role, and each `DeliveryMode` to
+            the number of regular members getting that kind of delivery.
+            Roles and delivery modes which no member has are missing, as are
+            the mailing lists without any members.
+        :rtype: dict
+        """
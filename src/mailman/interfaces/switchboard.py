@@ -46,7 +46,18 @@ class ISwitchboard(Interface):
         keyword arguments are added to the metadata dictonary, with precedence
         given to the keyword arguments.
 
-        The base name of the message file is returned.
+        The entry's priority lane is taken from the 'priority' key of the
+        metadata, which can be 'high', 'normal' or 'bulk'.  Without it, or
+        with any other value, notifications to the list owners and
+        moderators and internally crafted messages go in the high lane, and
+        messages with a large number of recipients go in the bulk lane.
+
+        The entry normally goes to whichever slice of the queue its file base
+        hashes to.  A '_slice' key in the metadata picks the slice instead.
+
+        The base name of the message file is returned.  If the entry was
+        instead handed over to a runner in this process (see
+        `mailman.core.switchboard.handoff()`), None is returned.
         """
 
     def dequeue(filebase):
@@ -81,6 +92,44 @@ class ISwitchboard(Interface):
         returned.
         """
 
+    def next_files(count=None):
+        """Iterate over the next .pck files in the queue, in priority order.
+
+        Entries are enqueued into a high, normal or bulk priority lane,
+        depending on their metadata.  Higher lanes are served first, and
+        within a lane, entries are served in FIFO order.  So that the lower
+        lanes are not starved, the longest waiting entry is served after a
+        number of entries have jumped ahead of it.
+
+        Unlike the 'files' attribute, this does not scan the queue directory
+        every time.  Instead the file bases come from an index which is kept
+        up to date by calling .notify(), and which is periodically rebuilt by
+        scanning the queue directory.  Every file base is removed from the
+        index as it is returned, so an entry that fails to be dequeued is not
+        returned again until the next rebuild.
+
+        :param count: The maximum number of file bases to return.  When None,
+            all the file bases in the index are returned.
+        :type count: int or None
+        """
+
+    def is_empty():
+        """Return whether the queue's index has no entries.
+
+        Like .next_files(), this uses the index, which is only rebuilt from
+        a scan of the queue directory when it is missing or due to be
+        rebuilt.  No entries are removed from the index.
+        """
+
+    def notify(names):
+        """Tell the switchboard about new files in the queue directory.
+
+        :param names: The names of the files added to the queue directory,
+            or None if it is not known what changed.  In the latter case, the
+            index used by .next_files() is rebuilt before it is next used.
+        :type names: list of strings, or None
+        """
+
     def recover_backup_files():
         """Move all backup files to active message files.
 
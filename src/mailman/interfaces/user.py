@@ -18,8 +18,10 @@
 """Interface describing the basics of a user."""
 
 __all__ = [
+    'AddressLinkChangeEvent',
     'IUser',
     'PasswordChangeEvent',
+    'PreferredAddressChangeEvent',
     'UnverifiedAddressError',
     ]
 
@@ -33,6 +35,21 @@ class UnverifiedAddressError(AddressError):
     """Unverified address cannot be used as a user's preferred address."""
 
 
+
+class AddressLinkChangeEvent:
+    """Event which gets triggered when an address is linked or unlinked."""
+
+    def __init__(self, user, address):
+        self.user = user
+        self.address = address
+
+    def __str__(self):
+        return '<{0} {1} {2}>'.format(self.__class__.__name__,
+                                      self.user.display_name,
+                                      self.address.email)
+
+
+
 
 class PasswordChangeEvent:
     """Event which gets triggered when a user changes their password."""
@@ -45,6 +62,19 @@ class PasswordChangeEvent:
                                   self.user.display_name)
 
 
+
+class PreferredAddressChangeEvent:
+    """Event which gets triggered when a user's preferred address changes."""
+
+    def __init__(self, user):
+        self.user = user
+
+    def __str__(self):
+        return '<{0} {1}>'.format(self.__class__.__name__,
+                                  self.user.display_name)
+
+
+
 
 class IUser(Interface):
     """A basic user."""
@@ -18,13 +18,31 @@
 """Interface describing the user management service."""
 
 __all__ = [
+    'AddressDeletingEvent',
     'IUserManager',
+    'UserDeletingEvent',
     ]
 
 
 from zope.interface import Interface, Attribute
 
 
+
+class AddressDeletingEvent:
+    """An address is about to be deleted."""
+
+    def __init__(self, address):
+        self.address = address
+
+
+
+class UserDeletingEvent:
+    """A user is about to be deleted."""
+
+    def __init__(self, user):
+        self.user = user
+
+
 
 class IUserManager(Interface):
     """The global user management service."""
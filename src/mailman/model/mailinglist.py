@@ -23,11 +23,12 @@ __all__ = [
 
 
 import os
+import uuid
 
 from mailman.config import config
 from mailman.database.model import Model
 from mailman.database.transaction import dbconnection
-from mailman.database.types import Enum
+from mailman.database.types import Enum, UUID
 from mailman.interfaces.action import Action, FilterAction
 from mailman.interfaces.address import IAddress
 from mailman.interfaces.archiver import ArchivePolicy
@@ -97,6 +98,7 @@ class MailingList(Model):
     digest_last_sent_at = Column(DateTime)
     volume = Column(Integer)
     last_post_at = Column(DateTime)
+    member_generation = Column(UUID)
     # Attributes which are directly modifiable via the web u/i.  The more
     # complicated attributes are currently stored as pickles, though that
     # will change as the schema and implementation is developed.
@@ -198,6 +200,7 @@ class MailingList(Model):
         self._list_id = '{0}.{1}'.format(listname, hostname)
         # For the pending database
         self.next_request_id = 1
+        self.member_generation = uuid.uuid4()
         # We need to set up the rosters.  Normally, this method will get called
         # when the MailingList object is loaded from the database, but when the
         # constructor is called, SQLAlchemy's `load` event isn't triggered.
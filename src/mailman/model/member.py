@@ -30,12 +30,13 @@ from mailman.interfaces.action import Action
 from mailman.interfaces.address import IAddress
 from mailman.interfaces.listmanager import IListManager
 from mailman.interfaces.member import (
-    IMember, MemberRole, MembershipError, UnsubscriptionEvent)
+    IMember, MemberAddressChangeEvent, MemberRole, MembershipError,
+    UnsubscriptionEvent)
 from mailman.interfaces.user import IUser, UnverifiedAddressError
 from mailman.interfaces.usermanager import IUserManager
 from mailman.utilities.uid import UniqueIDFactory
-from sqlalchemy import Column, ForeignKey, Integer, Unicode
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, ForeignKey, Index, Integer, Unicode
+from sqlalchemy.orm import backref, relationship
 from zope.component import getUtility
 from zope.event import notify
 from zope.interface import implementer
@@ -50,17 +51,23 @@ class Member(Model):
     """See `IMember`."""
 
     __tablename__ = 'member'
+    # Members are looked up by their address or user within a mailing list.
+    __table_args__ = (
+        Index('ix_member_address_id_list_id', 'address_id', 'list_id'),
+        Index('ix_member_user_id_list_id', 'user_id', 'list_id'),
+        )
 
     id = Column(Integer, primary_key=True)
     _member_id = Column(UUID)
     role = Column(Enum(MemberRole))
-    list_id = Column(Unicode)
+    list_id = Column(Unicode, index=True)
     moderation_action = Column(Enum(Action))
 
     address_id = Column(Integer, ForeignKey('address.id'))
     _address = relationship('Address')
     preferences_id = Column(Integer, ForeignKey('preferences.id'))
-    preferences = relationship('Preferences')
+    preferences = relationship(
+        'Preferences', backref=backref('member', uselist=False))
     user_id = Column(Integer, ForeignKey('user.id'))
     _user = relationship('User')
 
@@ -96,6 +103,10 @@ class Member(Model):
     @property
     def mailing_list(self):
         """See `IMember`."""
+        # Rosters looking up many members at once tell them their list.
+        mlist = getattr(self, '_mailing_list', None)
+        if mlist is not None:
+            return mlist
         list_manager = getUtility(IListManager)
         return list_manager.get_by_list_id(self.list_id)
 
@@ -127,13 +138,14 @@ class Member(Model):
         if user is None or user != self.user:
             raise MembershipError('Address is not controlled by user')
         self._address = new_address
+        notify(MemberAddressChangeEvent(self.mailing_list, self))
 
     @property
     def user(self):
         """See `IMember`."""
         return (self._user
                 if self._address is None
-                else getUtility(IUserManager).get_user(self._address.email))
+                else self._address.user)
 
     @property
     def subscriber(self):
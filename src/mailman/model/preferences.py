@@ -26,9 +26,12 @@ from mailman.database.model import Model
 from mailman.database.types import Enum
 from mailman.interfaces.languages import ILanguageManager
 from mailman.interfaces.member import DeliveryMode, DeliveryStatus
-from mailman.interfaces.preferences import IPreferences
+from mailman.interfaces.preferences import (
+    IPreferences, PreferencesChangeEvent)
 from sqlalchemy import Boolean, Column, Integer, Unicode
+from sqlalchemy.orm import validates
 from zope.component import getUtility
+from zope.event import notify
 from zope.interface import implementer
 
 
@@ -51,6 +54,13 @@ class Preferences(Model):
     def __repr__(self):
         return '<Preferences object at {0:#x}>'.format(id(self))
 
+    @validates('acknowledge_posts', 'hide_address', '_preferred_language',
+               'receive_list_copy', 'receive_own_postings', 'delivery_mode',
+               'delivery_status')
+    def _changed(self, key, value):
+        notify(PreferencesChangeEvent(self, key.lstrip('_')))
+        return value
+
     @property
     def preferred_language(self):
         if self._preferred_language is None:
@@ -0,0 +1,219 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Model for retrying deliveries to recipients with temporary failures."""
+
+__all__ = [
+    'RetryMessage',
+    'RetryRecipient',
+    'RetryStore',
+    ]
+
+
+import pickle
+import logging
+
+from itertools import groupby
+from lazr.config import as_timedelta
+from mailman.config import config
+from mailman.database.model import Model
+from mailman.database.transaction import dbconnection
+from mailman.interfaces.retry import IRetryRecipient, IRetryStore
+from mailman.utilities.datetime import now as right_now
+from sqlalchemy import (
+    Column, DateTime, ForeignKey, Integer, LargeBinary, Unicode, func)
+from sqlalchemy.orm import relationship
+from zope.interface import implementer
+
+
+log = logging.getLogger('mailman.smtp')
+
+# Metadata which only applies to a single delivery, and isn't kept.
+DELIVERY_KEYS = ('recipients', 'retry_id', 'fanout', 'deliver_after',
+                 'deliver_until', 'last_recip_count')
+
+
+
+class RetryMessage(Model):
+    """A message whose delivery is to be retried for some recipients."""
+
+    __tablename__ = 'retrymessage'
+
+    id = Column(Integer, primary_key=True)
+    message_id = Column(Unicode)
+    list_id = Column(Unicode)
+    deliver_until = Column(DateTime)
+    message = Column(LargeBinary)
+    msgdata = Column(LargeBinary)
+
+    def __init__(self, msg, msgdata, deliver_until):
+        message_id = msg.get('message-id')
+        if isinstance(message_id, bytes):
+            message_id = message_id.decode('ascii')
+        self.message_id = message_id
+        self.list_id = msgdata.get('listid')
+        self.deliver_until = deliver_until
+        self.message = pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)
+        msgdata = dict((key, value) for key, value in msgdata.items()
+                       if key not in DELIVERY_KEYS
+                       and not key.startswith('_'))
+        self.msgdata = pickle.dumps(msgdata, pickle.HIGHEST_PROTOCOL)
+
+
+
+@implementer(IRetryRecipient)
+class RetryRecipient(Model):
+    """See `IRetryRecipient`."""
+
+    __tablename__ = 'retryrecipient'
+
+    id = Column(Integer, primary_key=True)
+    email = Column(Unicode)
+    domain = Column(Unicode)
+    next_attempt = Column(DateTime, index=True)
+    attempts = Column(Integer)
+    last_response = Column(Unicode)
+
+    retry_message_id = Column(
+        Integer, ForeignKey('retrymessage.id'), index=True)
+    message = relationship('RetryMessage')
+
+    def __init__(self, message, email, next_attempt, last_response=None):
+        self.message = message
+        self.email = email
+        self.domain = email.rpartition('@')[2].lower()
+        self.next_attempt = next_attempt
+        self.attempts = 1
+        self.last_response = last_response
+
+    @property
+    def list_id(self):
+        return self.message.list_id
+
+    @property
+    def message_id(self):
+        return self.message.message_id
+
+
+
+@implementer(IRetryStore)
+class RetryStore:
+    """See `IRetryStore`."""
+
+    @dbconnection
+    def record(self, store, msg, msgdata, failures):
+        """See `IRetryStore`."""
+        now = right_now()
+        retry_id = msgdata.get('retry_id')
+        if retry_id is None:
+            if len(failures) == 0:
+                return 0
+            # Messages coming from the old retry queue bring their own
+            # retry period.
+            deliver_until = msgdata.get('deliver_until', now + as_timedelta(
+                config.mta.delivery_retry_period))
+            message = RetryMessage(msg, msgdata, deliver_until)
+            store.add(message)
+            recipients = {}
+        else:
+            message = store.query(RetryMessage).get(retry_id)
+            if message is None:
+                # The message was given up on while this job was underway.
+                return 0
+            recipients = dict(
+                (recipient.email, recipient)
+                for recipient in store.query(RetryRecipient).filter(
+                    RetryRecipient.message == message,
+                    RetryRecipient.email.in_(msgdata['recipients'])))
+            # Forget the recipients which were delivered to, or failed
+            # permanently.
+            for email, recipient in recipients.items():
+                if email not in failures:
+                    store.delete(recipient)
+            if len(failures) < len(msgdata['recipients']):
+                # Progress has been made, so keep trying a while longer.
+                message.deliver_until = now + as_timedelta(
+                    config.mta.delivery_retry_period)
+        if len(failures) > 0 and now > message.deliver_until:
+            log.error('Discarding message with persistent temporary '
+                      'failures: {0}'.format(msg['message-id']))
+            for recipient in recipients.values():
+                if recipient.email in failures:
+                    store.delete(recipient)
+            failures = {}
+        next_attempt = now + as_timedelta(config.mta.delivery_retry_interval)
+        for email, response in failures.items():
+            recipient = recipients.get(email)
+            if recipient is None:
+                store.add(RetryRecipient(
+                    message, email, next_attempt, response))
+            else:
+                recipient.next_attempt = next_attempt
+                if response is not None:
+                    recipient.last_response = response
+        store.flush()
+        if store.query(RetryRecipient).filter(
+                RetryRecipient.message == message).count() == 0:
+            store.delete(message)
+        return len(failures)
+
+    @dbconnection
+    def schedule(self, store, now=None):
+        """See `IRetryStore`."""
+        if now is None:
+            now = right_now()
+        next_attempt = now + as_timedelta(config.mta.delivery_retry_interval)
+        due = store.query(RetryRecipient).filter(
+            RetryRecipient.next_attempt <= now).order_by(
+            RetryRecipient.retry_message_id, RetryRecipient.domain).all()
+        jobs = []
+        for (message_id, domain), recipients in groupby(
+                due, lambda recipient: (recipient.retry_message_id,
+                                        recipient.domain)):
+            recipients = list(recipients)
+            for recipient in recipients:
+                recipient.next_attempt = next_attempt
+                recipient.attempts += 1
+            message = recipients[0].message
+            msgdata = pickle.loads(message.msgdata)
+            msgdata['recipients'] = [
+                recipient.email for recipient in recipients]
+            msgdata['retry_id'] = message_id
+            jobs.append((pickle.loads(message.message), msgdata))
+        return jobs
+
+    @property
+    @dbconnection
+    def next_attempt(self, store):
+        """See `IRetryStore`."""
+        return store.query(func.min(RetryRecipient.next_attempt)).scalar()
+
+    @property
+    @dbconnection
+    def recipients(self, store):
+        """See `IRetryStore`."""
+        for recipient in store.query(RetryRecipient).order_by(
+                RetryRecipient.next_attempt, RetryRecipient.id):
+            yield recipient
+
+    @dbconnection
+    def get_recipients(self, store, email):
+        """See `IRetryStore`."""
+        for recipient in store.query(RetryRecipient).filter(
+                func.lower(RetryRecipient.email) == email.lower()).order_by(
+                RetryRecipient.next_attempt, RetryRecipient.id):
+            yield recipient
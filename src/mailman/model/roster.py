@@ -30,19 +30,73 @@ __all__ = [
     'ModeratorRoster',
     'OwnerRoster',
     'RegularMemberRoster',
+    'RosterStatistics',
     'Subscribers',
     ]
 
 
+from mailman.core.constants import system_preferences
 from mailman.database.transaction import dbconnection
-from mailman.interfaces.member import DeliveryMode, MemberRole
-from mailman.interfaces.roster import IRoster
+from mailman.interfaces.member import DeliveryMode, DeliveryStatus, MemberRole
+from mailman.interfaces.roster import (
+    IDeliveryRoster, IRoster, IRosterStatistics)
 from mailman.model.address import Address
 from mailman.model.member import Member
-from sqlalchemy import and_, or_
+from mailman.model.preferences import Preferences
+from sqlalchemy import and_, func, or_
+from sqlalchemy.orm import aliased, joinedload
 from zope.interface import implementer
 
 
+# The number of email addresses, or list ids, looked up per query, which
+# keeps the number of query parameters within SQLite's limit.
+MAX_PARAMETERS = 500
+
+
+
+def _with_preferences(query, *preferences, outer=False):
+    """Work out the effective preferences of the members in a query.
+
+    A member's preference is taken from the member, its address or the
+    address's user, in that order, just like `Member._lookup()` does.
+
+    :param query: The query of the members.
+    :param preferences: The names of the preferences.
+    :type preferences: sequence of strings
+    :param outer: Whether to keep the members who have no address, such as
+        users without a preferred address.
+    :type outer: bool
+    :return: The query joined to the preferences, the addresses the members
+        receive their deliveries at, and the SQL expression of each
+        preference, which is NULL when the system default applies.
+    """
+    # Avoid circular imports.
+    from mailman.model.user import User
+    user = aliased(User)
+    address = aliased(Address)
+    address_user = aliased(User)
+    member_preferences = aliased(Preferences)
+    address_preferences = aliased(Preferences)
+    user_preferences = aliased(Preferences)
+    query = query.outerjoin(user, Member.user_id == user.id)
+    join_address = (query.outerjoin if outer else query.join)
+    query = join_address(
+        address, or_(Member.address_id == address.id,
+                     user._preferred_address_id == address.id)).outerjoin(
+        member_preferences,
+        Member.preferences_id == member_preferences.id).outerjoin(
+        address_preferences,
+        address.preferences_id == address_preferences.id).outerjoin(
+        address_user, address.user_id == address_user.id).outerjoin(
+        user_preferences,
+        address_user.preferences_id == user_preferences.id)
+    values = [func.coalesce(getattr(member_preferences, preference),
+                            getattr(address_preferences, preference),
+                            getattr(user_preferences, preference))
+              for preference in preferences]
+    return query, address, values
+
+
 
 @implementer(IRoster)
 class AbstractRoster:
@@ -97,40 +151,94 @@ class AbstractRoster:
             yield member.address
 
     @dbconnection
-    def _get_all_memberships(self, store, email):
+    def _find_subscribed(self, store, query, criterion,
+                         user_memberships=True):
+        """Find the roster's members subscribed by the matching addresses.
+
+        Members are subscribed either with an explicit address, or as a user
+        with their preferred address.  Each kind gets a query of its own,
+        which looks up the addresses through their email index first, and
+        then the members through their address or user within the mailing
+        list.
+
+        :param query: The query of the roster's members.
+        :param criterion: The SQL criterion matching the addresses.
+        :param user_memberships: Whether to also find the members subscribed
+            as a user.
+        :type user_memberships: bool
+        :return: The query of the members subscribed with an explicit
+            address, and if asked for, the query of the members subscribed
+            as a user.
+        :rtype: list
+        """
         # Avoid circular imports.
         from mailman.model.user import User
-        # Here's a query that finds all members subscribed with an explicit
-        # email address.
-        members_a = store.query(Member).filter(
-            Member.list_id == self._mlist.list_id,
-            Member.role == self.role,
-            Address.email == email,
-            Member.address_id == Address.id)
-        # Here's a query that finds all members subscribed with their
-        # preferred address.
-        members_u = store.query(Member).filter(
-            Member.list_id == self._mlist.list_id,
-            Member.role == self.role,
-            Address.email==email,
-            Member.user_id == User.id)
-        return members_a.union(members_u).all()
+        queries = [query.filter(Member.address_id.in_(
+            store.query(Address.id).filter(criterion)))]
+        if user_memberships:
+            queries.append(query.filter(Member.user_id.in_(
+                store.query(Address.user_id).join(
+                    User, and_(User.id == Address.user_id,
+                               User._preferred_address_id == Address.id)
+                    ).filter(criterion))))
+        return queries
+
+    def _get_all_memberships(self, email):
+        # Members subscribed with an explicit address come first.
+        memberships = []
+        for query in self._find_subscribed(
+                self._query(), Address.email == email.lower()):
+            memberships.extend(query.all())
+        return memberships
 
     def get_member(self, email):
         """See ``IRoster``."""
         memberships = self._get_all_memberships(email)
-        count = len(memberships)
-        if count == 0:
+        if len(memberships) == 0:
             return None
-        elif count == 1:
-            return memberships[0]
-        assert count == 2, 'Unexpected membership count: {}'.format(count)
-        # This is the case where the email address is subscribed both
-        # explicitly and indirectly through the preferred address.  By
-        # definition, we return the explicit address membership only.
-        return (memberships[0]
-                if memberships[0]._address is not None
-                else memberships[1])
+        # The email address may be subscribed both explicitly and indirectly
+        # through the preferred address.  By definition, we return the
+        # explicit address membership only, which is the first one.
+        return memberships[0]
+
+    def _get_many_memberships(self, emails, user_memberships=True):
+        # Avoid circular imports.
+        from mailman.model.user import User
+        # Load everything the members' properties need along with them.
+        options = (
+            joinedload(Member.preferences),
+            joinedload(Member._address).joinedload(Address.preferences),
+            joinedload(Member._address).joinedload(
+                Address.user).joinedload(User.preferences),
+            joinedload(Member._user).joinedload(User.preferences),
+            joinedload(Member._user).joinedload(
+                User._preferred_address).joinedload(Address.preferences),
+            )
+        # Addresses are stored in lower case, but the members are returned
+        # under the email addresses as given.
+        emails = list(emails)
+        found = {}
+        lower_case = list(set(email.lower() for email in emails))
+        for start in range(0, len(lower_case), MAX_PARAMETERS):
+            batch = lower_case[start:start + MAX_PARAMETERS]
+            for query in self._find_subscribed(
+                    self._query(), Address.email.in_(batch),
+                    user_memberships):
+                for member in query.options(*options):
+                    # Members subscribed with an explicit address come first
+                    # and win, as in get_member().
+                    email = member.address.email
+                    if email in found:
+                        continue
+                    # Members don't have to look up their mailing list.
+                    member._mailing_list = self._mlist
+                    found[email] = member
+        return dict((email, found[email.lower()]) for email in emails
+                    if email.lower() in found)
+
+    def get_members(self, emails):
+        """See `IRoster`."""
+        return self._get_many_memberships(emails)
 
     def get_memberships(self, email):
         """See ``IRoster``."""
@@ -186,65 +294,67 @@ class AdministratorRoster(AbstractRoster):
             or_(Member.role == MemberRole.owner,
                 Member.role == MemberRole.moderator))
 
-    @dbconnection
-    def get_member(self, store, email):
+    def get_member(self, email):
         """See `IRoster`."""
-        results = store.query(Member).filter(
-            Member.list_id == self._mlist.list_id,
-            or_(Member.role == MemberRole.moderator,
-                Member.role == MemberRole.owner),
-            Address.email == email,
-            Member.address_id == Address.id)
-        if results.count() == 0:
+        [query] = self._find_subscribed(
+            self._query(), Address.email == email.lower(),
+            user_memberships=False)
+        results = query.all()
+        if len(results) == 0:
             return None
-        elif results.count() == 1:
+        elif len(results) == 1:
             return results[0]
         else:
             raise AssertionError(
                 'Too many matching member results: {0}'.format(results))
 
+    def get_members(self, emails):
+        """See `IRoster`."""
+        return self._get_many_memberships(emails, user_memberships=False)
+
 
 
+@implementer(IDeliveryRoster)
 class DeliveryMemberRoster(AbstractRoster):
     """Return all the members having a particular kind of delivery."""
 
     role = MemberRole.member
+    # The delivery modes of the members in the roster.
+    delivery_modes = ()
+
+    def _one_of(self, value, preference, choices):
+        # The system default applies to the members who haven't set the
+        # preference anywhere.
+        clause = value.in_(choices)
+        if getattr(system_preferences, preference) in choices:
+            clause = or_(clause, value.is_(None))
+        return clause
+
+    def _query(self):
+        query, address, (delivery_mode,) = _with_preferences(
+            super()._query(), 'delivery_mode')
+        return query.filter(self._one_of(
+            delivery_mode, 'delivery_mode', self.delivery_modes))
 
     @property
-    def member_count(self):
-        """See `IRoster`."""
-        # XXX 2012-03-15 BAW: It would be nice to make this more efficient.
-        # The problem is that you'd have to change the loop in _get_members()
-        # checking the delivery mode to a query parameter.
-        return len(tuple(self.members))
-
-    @dbconnection
-    def _get_members(self, store, *delivery_modes):
-        """The set of members for a mailing list, filter by delivery mode.
-
-        :param delivery_modes: The modes to filter on.
-        :type delivery_modes: sequence of `DeliveryMode`.
-        :return: A generator of members.
-        :rtype: generator
-        """
-        results = store.query(Member).filter_by(
-            list_id = self._mlist.list_id,
-            role = MemberRole.member)
-        for member in results:
-            if member.delivery_mode in delivery_modes:
-                yield member
+    def recipients(self):
+        """See `IDeliveryRoster`."""
+        query, address, (delivery_mode, delivery_status) = _with_preferences(
+            super()._query(), 'delivery_mode', 'delivery_status')
+        results = query.filter(
+            self._one_of(delivery_mode, 'delivery_mode',
+                         self.delivery_modes),
+            self._one_of(delivery_status, 'delivery_status',
+                         (DeliveryStatus.enabled,)),
+            ).with_entities(address.email)
+        return set(email for (email,) in results)
 
 
 class RegularMemberRoster(DeliveryMemberRoster):
     """Return all the regular delivery members of a list."""
 
     name = 'regular_members'
-
-    @property
-    def members(self):
-        """See `IRoster`."""
-        for member in self._get_members(DeliveryMode.regular):
-            yield member
+    delivery_modes = (DeliveryMode.regular,)
 
 
 
@@ -252,14 +362,9 @@ class DigestMemberRoster(DeliveryMemberRoster):
     """Return all the regular delivery members of a list."""
 
     name = 'digest_members'
-
-    @property
-    def members(self):
-        """See `IRoster`."""
-        for member in self._get_members(DeliveryMode.plaintext_digests,
-                                        DeliveryMode.mime_digests,
-                                        DeliveryMode.summary_digests):
-            yield member
+    delivery_modes = (DeliveryMode.plaintext_digests,
+                      DeliveryMode.mime_digests,
+                      DeliveryMode.summary_digests)
 
 
 
@@ -328,9 +433,51 @@ class Memberships:
                 'Too many matching member results: {0}'.format(
                     results.count()))
 
+    def get_members(self, emails):
+        """See `IRoster`."""
+        members = {}
+        for email in emails:
+            member = self.get_member(email)
+            if member is not None:
+                members[email] = member
+        return members
+
     @dbconnection
     def get_memberships(self, store, address):
         """See `IRoster`."""
         # 2015-04-14 BAW: See LP: #1444055 -- this currently exists just to
         # pass a test.
         raise NotImplementedError
+
+
+
+
+@implementer(IRosterStatistics)
+class RosterStatistics:
+    """See `IRosterStatistics`."""
+
+    @dbconnection
+    def get_counts(self, store, list_ids):
+        """See `IRosterStatistics`."""
+        counts = {}
+        list_ids = list(set(list_ids))
+        for start in range(0, len(list_ids), MAX_PARAMETERS):
+            batch = list_ids[start:start + MAX_PARAMETERS]
+            # Members of all roles are counted, including those without an
+            # address, but only the delivery modes of the regular members
+            # are of interest.
+            query, address, (delivery_mode,) = _with_preferences(
+                store.query(Member), 'delivery_mode', outer=True)
+            results = query.filter(
+                Member.list_id.in_(batch)).with_entities(
+                Member.list_id, Member.role, delivery_mode,
+                func.count(Member.id)).group_by(
+                Member.list_id, Member.role, delivery_mode)
+            for list_id, role, mode, count in results:
+                list_counts = counts.setdefault(list_id, {})
+                list_counts[role] = list_counts.get(role, 0) + count
+                if role is MemberRole.member:
+                    if mode is None:
+                        mode = system_preferences.delivery_mode
+                    list_counts[mode] = list_counts.get(mode, 0) + count
+        return counts
@@ -0,0 +1,100 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the retry store."""
+
+__all__ = [
+    'TestRetryStore',
+    ]
+
+
+import unittest
+
+from datetime import timedelta
+from mailman.interfaces.retry import IRetryStore
+from mailman.testing.helpers import specialized_message_from_string as mfs
+from mailman.testing.layers import ConfigLayer
+from mailman.utilities.datetime import now
+from zope.component import getUtility
+
+
+
+class TestRetryStore(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._retry_store = getUtility(IRetryStore)
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <first>
+
+""")
+        self._msgdata = dict(listid='test.example.com', tolist=True,
+                             recipients=['bart@example.com'])
+
+    def test_nothing_to_retry(self):
+        self.assertEqual(self._retry_store.record(
+            self._msg, self._msgdata, {}), 0)
+        self.assertEqual(list(self._retry_store.recipients), [])
+        self.assertIsNone(self._retry_store.next_attempt)
+        self.assertEqual(self._retry_store.schedule(), [])
+
+    def test_delivery_metadata_is_not_kept(self):
+        self._retry_store.record(self._msg, self._msgdata, {
+            'bart@example.com': None})
+        jobs = self._retry_store.schedule(now() + timedelta(days=1))
+        self.assertEqual(len(jobs), 1)
+        msg, msgdata = jobs[0]
+        self.assertEqual(msg['message-id'], '<first>')
+        self.assertEqual(msgdata['listid'], 'test.example.com')
+        self.assertTrue(msgdata['tolist'])
+        self.assertEqual(msgdata['recipients'], ['bart@example.com'])
+
+    def test_jobs_by_domain(self):
+        self._retry_store.record(self._msg, self._msgdata, {
+            'anne@example.com': None,
+            'bart@EXAMPLE.COM': None,
+            'cris@example.org': None,
+            })
+        next_attempt = self._retry_store.next_attempt
+        self.assertGreater(next_attempt, now())
+        # Nothing is due yet.
+        self.assertEqual(self._retry_store.schedule(), [])
+        jobs = self._retry_store.schedule(next_attempt)
+        self.assertEqual(
+            sorted(sorted(msgdata['recipients']) for msg, msgdata in jobs),
+            [['anne@example.com', 'bart@EXAMPLE.COM'], ['cris@example.org']])
+        # The recipients aren't due again until after another interval.
+        self.assertEqual(self._retry_store.schedule(next_attempt), [])
+        self.assertGreater(self._retry_store.next_attempt, next_attempt)
+        self.assertEqual(
+            [recipient.attempts for recipient in self._retry_store.recipients],
+            [2, 2, 2])
+
+    def test_get_recipients(self):
+        self._retry_store.record(self._msg, self._msgdata, {
+            'anne@example.com': '450 Greylisted',
+            'bart@example.com': None,
+            })
+        recipients = list(self._retry_store.get_recipients(
+            'ANNE@example.com'))
+        self.assertEqual(len(recipients), 1)
+        self.assertEqual(recipients[0].email, 'anne@example.com')
+        self.assertEqual(recipients[0].domain, 'example.com')
+        self.assertEqual(recipients[0].last_response, '450 Greylisted')
+        self.assertEqual(recipients[0].message_id, '<first>')
@@ -18,8 +18,10 @@
 """Test rosters."""
 
 __all__ = [
+    'TestDeliveryRoster',
     'TestMailingListRoster',
     'TestMembershipsRoster',
+    'TestRosterStatistics',
     ]
 
 
@@ -27,7 +29,9 @@ import unittest
 
 from mailman.app.lifecycle import create_list
 from mailman.interfaces.address import IAddress
-from mailman.interfaces.member import DeliveryMode, MemberRole
+from mailman.interfaces.roster import IRosterStatistics
+from mailman.interfaces.member import (
+    DeliveryMode, DeliveryStatus, MemberRole)
 from mailman.interfaces.user import IUser
 from mailman.interfaces.usermanager import IUserManager
 from mailman.testing.layers import ConfigLayer
@@ -127,8 +131,111 @@ class TestMailingListRoster(unittest.TestCase):
         self.assertEqual(self._mlist.digest_members.member_count, 1)
         self.assertEqual(self._mlist.subscribers.member_count, 4)
 
+    def test_get_members(self):
+        # Many members can be looked up at once.
+        anne = self._mlist.subscribe(self._anne, role=MemberRole.member)
+        cris = self._mlist.subscribe(self._cris, role=MemberRole.member)
+        self._mlist.subscribe(self._bart, role=MemberRole.owner)
+        emails = ['anne@example.com', 'bart@example.com',
+                  'cris@example.com', 'dave@example.com']
+        self.assertEqual(self._mlist.members.get_members(emails),
+                         {'anne@example.com': anne, 'cris@example.com': cris})
+        self.assertEqual(
+            list(self._mlist.administrators.get_members(emails)),
+            ['bart@example.com'])
+        self.assertEqual(self._mlist.members.get_members([]), {})
+
+    def test_get_many_members(self):
+        # Looking up lots of addresses takes more than one query.
+        self._mlist.subscribe(self._anne, role=MemberRole.member)
+        emails = ['person{0}@example.com'.format(i) for i in range(1200)]
+        emails.append('anne@example.com')
+        self.assertEqual(list(self._mlist.members.get_members(emails)),
+                         ['anne@example.com'])
+
 
 
+class TestDeliveryRoster(unittest.TestCase):
+    """Test the rosters of the members getting regular and digest delivery."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._mlist = create_list('test@example.com')
+        user_manager = getUtility(IUserManager)
+        self._anne = user_manager.create_address('anne@example.com')
+        self._bart = user_manager.create_address('bart@example.com')
+        self._cris = user_manager.make_user('cris@example.com')
+        preferred = list(self._cris.addresses)[0]
+        preferred.verified_on = now()
+        self._cris.preferred_address = preferred
+
+    def _emails(self, roster):
+        return sorted(member.address.email for member in roster.members)
+
+    def test_system_default(self):
+        # Without any preferences, members get regular delivery.
+        self._mlist.subscribe(self._anne)
+        self._mlist.subscribe(self._cris)
+        self.assertEqual(self._emails(self._mlist.regular_members),
+                         ['anne@example.com', 'cris@example.com'])
+        self.assertEqual(self._mlist.digest_members.member_count, 0)
+        self.assertEqual(self._mlist.regular_members.recipients,
+                         set(['anne@example.com', 'cris@example.com']))
+
+    def test_member_preferences_win(self):
+        # The member's own preferences override those of its address.
+        member = self._mlist.subscribe(self._anne)
+        self._anne.preferences.delivery_mode = DeliveryMode.mime_digests
+        self.assertEqual(self._mlist.regular_members.member_count, 0)
+        member.preferences.delivery_mode = DeliveryMode.regular
+        self.assertEqual(self._emails(self._mlist.regular_members),
+                         ['anne@example.com'])
+        self.assertEqual(self._mlist.digest_members.member_count, 0)
+
+    def test_user_preferences(self):
+        # A user's preferences apply to their preferred address memberships
+        # and to the memberships of their addresses.
+        self._mlist.subscribe(self._cris)
+        address = self._cris.register('cris@example.org')
+        address.verified_on = now()
+        self._mlist.subscribe(address)
+        self._cris.preferences.delivery_mode = DeliveryMode.plaintext_digests
+        self.assertEqual(self._mlist.regular_members.member_count, 0)
+        self.assertEqual(self._emails(self._mlist.digest_members),
+                         ['cris@example.com', 'cris@example.org'])
+        self.assertEqual(self._mlist.digest_members.recipients,
+                         set(['cris@example.com', 'cris@example.org']))
+
+    def test_disabled_members_are_not_recipients(self):
+        # Members whose delivery is disabled are still in the roster, but
+        # they aren't recipients.
+        self._mlist.subscribe(self._anne)
+        member = self._mlist.subscribe(self._bart)
+        member.preferences.delivery_status = DeliveryStatus.by_user
+        self.assertEqual(self._emails(self._mlist.regular_members),
+                         ['anne@example.com', 'bart@example.com'])
+        self.assertEqual(self._mlist.regular_members.recipients,
+                         set(['anne@example.com']))
+        # Preferences are resolved the same way for the delivery status.
+        self._anne.preferences.delivery_status = DeliveryStatus.by_bounces
+        self.assertEqual(self._mlist.regular_members.recipients, set())
+
+    def test_get_member(self):
+        # Members are only found in the roster of their delivery mode.
+        member = self._mlist.subscribe(self._anne)
+        member.preferences.delivery_mode = DeliveryMode.mime_digests
+        self.assertIsNone(
+            self._mlist.regular_members.get_member('anne@example.com'))
+        self.assertEqual(
+            self._mlist.digest_members.get_member('anne@example.com'),
+            member)
+        self.assertEqual(
+            self._mlist.digest_members.get_members(['anne@example.com']),
+            {'anne@example.com': member})
+
+
+
 class TestMembershipsRoster(unittest.TestCase):
     """Test the memberships roster."""
 
@@ -169,6 +276,8 @@ class TestMembershipsRoster(unittest.TestCase):
         self.assertEqual(
             [member.address.email for member in memberships],
             ['anne@example.com'])
+        members = self._ant.members.get_members(['anne@example.com'])
+        self.assertEqual(members['anne@example.com'].user, self._anne)
 
     def test_subscribed_as_user_and_address(self):
         # Anne subscribes to a mailing list twice, once as a user and once
@@ -185,6 +294,9 @@ class TestMembershipsRoster(unittest.TestCase):
         subscriber = member.subscriber
         self.assertTrue(IAddress.providedBy(subscriber))
         self.assertFalse(IUser.providedBy(subscriber))
+        # So is get_members().
+        members = self._ant.members.get_members(['anne@example.com'])
+        self.assertEqual(members, {'anne@example.com': member})
         # get_memberships() returns them all.
         memberships = self._ant.members.get_memberships('anne@example.com')
         self.assertEqual(len(memberships), 2)
@@ -200,3 +312,86 @@ class TestMembershipsRoster(unittest.TestCase):
         self.assertEqual(
             [record.address.email for record in memberships],
             ['anne@example.com', 'anne@example.com'])
+
+    def test_mixed_case_email(self):
+        # Members are found whatever the case of the email address.
+        self._ant.subscribe(self._anne)
+        member = self._ant.members.get_member('Anne@Example.com')
+        self.assertEqual(member.user, self._anne)
+        members = self._ant.members.get_members(['Anne@Example.com'])
+        self.assertEqual(members, {'Anne@Example.com': member})
+
+    def test_subscribed_as_user_other_address(self):
+        # A user subscribed with their preferred address isn't a member
+        # through their other addresses, nor are other users.
+        self._ant.subscribe(self._anne)
+        user_manager = getUtility(IUserManager)
+        self._anne.register('anne@example.org')
+        user_manager.make_user('bart@example.com')
+        for email in ('anne@example.org', 'bart@example.com'):
+            self.assertIsNone(self._ant.members.get_member(email))
+            self.assertEqual(self._ant.members.get_memberships(email), [])
+        self.assertEqual(
+            list(self._ant.members.get_members(
+                ['anne@example.org', 'bart@example.com'])),
+            [])
+
+
+
+
+class TestRosterStatistics(unittest.TestCase):
+    """Test the member counts of many mailing lists."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._ant = create_list('ant@example.com')
+        self._bee = create_list('bee@example.com')
+        self._cat = create_list('cat@example.com')
+        user_manager = getUtility(IUserManager)
+        self._anne = user_manager.create_address('anne@example.com')
+        self._bart = user_manager.create_address('bart@example.com')
+        self._cris = user_manager.make_user('cris@example.com')
+        preferred = list(self._cris.addresses)[0]
+        preferred.verified_on = now()
+        self._cris.preferred_address = preferred
+        self._statistics = getUtility(IRosterStatistics)
+
+    def test_roles(self):
+        self._ant.subscribe(self._anne)
+        self._ant.subscribe(self._bart)
+        self._ant.subscribe(self._anne, MemberRole.owner)
+        self._bee.subscribe(self._bart, MemberRole.moderator)
+        counts = self._statistics.get_counts(
+            [self._ant.list_id, self._bee.list_id, self._cat.list_id])
+        self.assertEqual(counts[self._ant.list_id][MemberRole.member], 2)
+        self.assertEqual(counts[self._ant.list_id][MemberRole.owner], 1)
+        self.assertNotIn(MemberRole.moderator, counts[self._ant.list_id])
+        self.assertEqual(counts[self._bee.list_id], {MemberRole.moderator: 1})
+        # Mailing lists without any members are left out.
+        self.assertNotIn(self._cat.list_id, counts)
+
+    def test_delivery_modes(self):
+        # The delivery modes of the members are resolved like the delivery
+        # rosters do, falling back to the system default.
+        self._ant.subscribe(self._anne)
+        member = self._ant.subscribe(self._bart)
+        member.preferences.delivery_mode = DeliveryMode.mime_digests
+        self._ant.subscribe(self._cris)
+        self._cris.preferences.delivery_mode = DeliveryMode.plaintext_digests
+        # Only members are counted by their delivery mode.
+        self._ant.subscribe(self._bart, MemberRole.owner)
+        counts = self._statistics.get_counts([self._ant.list_id])
+        self.assertEqual(counts, {self._ant.list_id: {
+            MemberRole.member: 3,
+            MemberRole.owner: 1,
+            DeliveryMode.regular: 1,
+            DeliveryMode.mime_digests: 1,
+            DeliveryMode.plaintext_digests: 1,
+            }})
+        # The counts agree with the rosters.
+        self.assertEqual(self._ant.regular_members.member_count, 1)
+        self.assertEqual(self._ant.digest_members.member_count, 2)
+
+    def test_no_lists(self):
+        self.assertEqual(self._statistics.get_counts([]), {})
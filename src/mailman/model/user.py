@@ -29,7 +29,8 @@ from mailman.database.types import UUID
 from mailman.interfaces.address import (
     AddressAlreadyLinkedError, AddressNotLinkedError)
 from mailman.interfaces.user import (
-    IUser, PasswordChangeEvent, UnverifiedAddressError)
+    AddressLinkChangeEvent, IUser, PasswordChangeEvent,
+    PreferredAddressChangeEvent, UnverifiedAddressError)
 from mailman.model.address import Address
 from mailman.model.preferences import Preferences
 from mailman.model.roster import Memberships
@@ -119,12 +120,14 @@ class User(Model):
         if address.user is not None:
             raise AddressAlreadyLinkedError(address)
         address.user = self
+        notify(AddressLinkChangeEvent(self, address))
 
     def unlink(self, address):
         """See `IUser`."""
         if address.user is None or address.user is not self:
             raise AddressNotLinkedError(address)
         address.user = None
+        notify(AddressLinkChangeEvent(self, address))
 
     @property
     def preferred_address(self):
@@ -144,11 +147,13 @@ class User(Model):
         elif address.user != self:
             raise AddressAlreadyLinkedError(address)
         self._preferred_address = address
+        notify(PreferredAddressChangeEvent(self))
 
     @preferred_address.deleter
     def preferred_address(self):
         """See `IUser`."""
         self._preferred_address = None
+        notify(PreferredAddressChangeEvent(self))
 
     @dbconnection
     def controls(self, store, email):
@@ -170,9 +175,7 @@ class User(Model):
             address = Address(email=email, display_name=display_name)
             address.preferences = Preferences()
         # Link the address to the user if it is not already linked.
-        if address.user is not None:
-            raise AddressAlreadyLinkedError(address)
-        address.user = self
+        self.link(address)
         return address
 
     @property
@@ -24,11 +24,13 @@ __all__ = [
 
 from mailman.database.transaction import dbconnection
 from mailman.interfaces.address import ExistingAddressError
-from mailman.interfaces.usermanager import IUserManager
+from mailman.interfaces.usermanager import (
+    AddressDeletingEvent, IUserManager, UserDeletingEvent)
 from mailman.model.address import Address
 from mailman.model.member import Member
 from mailman.model.preferences import Preferences
 from mailman.model.user import User
+from zope.event import notify
 from zope.interface import implementer
 
 
@@ -69,6 +71,7 @@ class UserManager:
     @dbconnection
     def delete_user(self, store, user):
         """See `IUserManager`."""
+        notify(UserDeletingEvent(user))
         store.delete(user.preferences)
         store.delete(user)
 
@@ -115,6 +118,7 @@ class UserManager:
     @dbconnection
     def delete_address(self, store, address):
         """See `IUserManager`."""
+        notify(AddressDeletingEvent(address))
         # If there's a user controlling this address, it has to first be
         # unlinked before the address can be deleted.
         if address.user:
@@ -0,0 +1,453 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Asynchronous individual delivery.
+
+Individual delivery sends a separate message to every recipient, which with
+`smtplib` means a full round trip to the MTA for each SMTP command of each
+message, one message at a time.  The delivery here instead keeps many SMTP
+sessions open at once with asyncio, and when the MTA supports ESMTP
+PIPELINING (RFC 2920), sends each transaction's MAIL, RCPT and DATA commands
+without waiting for the replies in between.  Messages are crafted as the
+sessions become ready for them, so only a few are held in memory at once.
+"""
+
+__all__ = [
+    'AsyncConnection',
+    'AsyncIndividualDelivery',
+    ]
+
+
+import re
+import base64
+import socket
+import asyncio
+import logging
+import smtplib
+
+from lazr.config import as_boolean
+from mailman.config import config
+from mailman.mta.base import IndividualDelivery
+from mailman.mta.breaker import get_circuit_breaker
+from mailman.mta.connection import CONNECTION_ERRORS
+from mailman.mta.smarthosts import get_smart_hosts
+
+
+log = logging.getLogger('mailman.smtp')
+
+CRLF = b'\r\n'
+# The number of seconds to wait for the MTA to reply.
+TIMEOUT = 300
+
+EOL_RE = re.compile(r'\r\n|\r|\n')
+DOT_RE = re.compile(r'^\.', re.MULTILINE)
+
+
+
+def _prepare(text):
+    """Turn a message into the bytes sent after the DATA command."""
+    data = DOT_RE.sub('..', EOL_RE.sub('\r\n', text))
+    if not data.endswith('\r\n'):
+        data += '\r\n'
+    return data.encode('utf-8', 'surrogateescape') + b'.\r\n'
+
+
+
+class AsyncConnection:
+    """Manage an asynchronous connection to the SMTP server."""
+
+    def __init__(self, host, port, sessions_per_connection,
+                 smtp_user=None, smtp_pass=None, loop=None, smart_hosts=None,
+                 breaker=None):
+        """Create a connection manager.
+
+        The arguments are as for `Connection`, plus the event loop to use.
+        """
+        self._host = host
+        self._port = port
+        self._sessions_per_connection = sessions_per_connection
+        self._username = smtp_user
+        self._password = smtp_pass
+        self._loop = loop
+        self._smart_hosts = smart_hosts
+        self._smart_host = None
+        self._breaker = breaker
+        self._session_count = None
+        self._reader = None
+        self._writer = None
+        self.pipelining = False
+
+    @asyncio.coroutine
+    def _reply(self):
+        """Read a reply from the server.
+
+        :return: 2-tuple of the reply code and text.
+        """
+        lines = []
+        while True:
+            line = yield from asyncio.wait_for(
+                self._reader.readline(), TIMEOUT, loop=self._loop)
+            if not line.endswith(b'\n'):
+                raise smtplib.SMTPServerDisconnected(
+                    'Connection unexpectedly closed')
+            try:
+                code = int(line[:3])
+            except ValueError:
+                raise smtplib.SMTPResponseException(-1, line)
+            lines.append(line[4:].strip())
+            if line[3:4] != b'-':
+                return code, b'\n'.join(lines)
+
+    @asyncio.coroutine
+    def _command(self, command):
+        """Send a command and return the server's reply."""
+        self._writer.write(command.encode('utf-8') + CRLF)
+        return (yield from self._reply())
+
+    @asyncio.coroutine
+    def _connect(self, failed):
+        """Open a new connection.
+
+        This is the asynchronous equivalent of `Connection._connect()`.
+        """
+        if self._smart_hosts is None:
+            yield from self._open(self._host, self._port)
+            return
+        while True:
+            smart_host = self._smart_hosts.select(exclude=failed)
+            assert smart_host is not None, 'No smarthosts left'
+            try:
+                yield from self._open(smart_host.host, smart_host.port)
+            except (OSError, asyncio.TimeoutError,
+                    smtplib.SMTPException) as error:
+                log.error('Cannot connect to smarthost %s:%s: %s',
+                          smart_host.host, smart_host.port, error)
+                if self._writer is not None:
+                    self._writer.close()
+                    self._reader = self._writer = None
+                self._smart_hosts.failed(smart_host)
+                failed.add(smart_host)
+                if len(failed) == len(self._smart_hosts.hosts):
+                    raise
+                continue
+            self._smart_hosts.connected(smart_host)
+            self._smart_host = smart_host
+            return
+
+    @asyncio.coroutine
+    def _open(self, host, port):
+        """Open a connection to an SMTP server."""
+        log.debug('Connecting to %s:%s', host, port)
+        self._reader, self._writer = yield from asyncio.open_connection(
+            host, port, loop=self._loop)
+        code, text = yield from self._reply()
+        if code != 220:
+            raise smtplib.SMTPConnectError(code, text)
+        local_hostname = socket.getfqdn()
+        code, text = yield from self._command('EHLO ' + local_hostname)
+        if code == 250:
+            extensions = [line.split()[0].upper()
+                          for line in text.splitlines()[1:] if line.strip()]
+            self.pipelining = (b'PIPELINING' in extensions)
+        else:
+            code, text = yield from self._command('HELO ' + local_hostname)
+            if code != 250:
+                raise smtplib.SMTPHeloError(code, text)
+            self.pipelining = False
+        if self._username is not None and self._password is not None:
+            log.debug('Logging in')
+            credentials = '\0{0}\0{1}'.format(self._username, self._password)
+            code, text = yield from self._command('AUTH PLAIN {0}'.format(
+                base64.b64encode(credentials.encode('utf-8')).decode('ascii')))
+            if code != 235:
+                raise smtplib.SMTPAuthenticationError(code, text)
+        self._session_count = self._sessions_per_connection
+
+    @asyncio.coroutine
+    def sendmail(self, envsender, recipients, data):
+        """Send a message, like `smtplib.SMTP.sendmail`.
+
+        :param envsender: The envelope sender.
+        :type envsender: string
+        :param recipients: The recipients.
+        :type recipients: sequence of strings
+        :param data: The message, ready for the DATA command; see
+            `_prepare()`.
+        :type data: bytes
+        :return: The refused recipients, mapped to the server's reply code
+            and text.
+        :rtype: dict
+        :raises SMTPRecipientsRefused: when all the recipients are refused.
+        :raises SMTPResponseException: when the transaction is refused.
+        """
+        if as_boolean(config.devmode.enabled):
+            # Force the recipients to the specified address, but still deliver
+            # to the same number of recipients.
+            recipients = [config.devmode.recipient] * len(recipients)
+        failed = set()
+        while True:
+            try:
+                if self._writer is None:
+                    try:
+                        yield from self._connect(failed)
+                    except (OSError, asyncio.TimeoutError,
+                            smtplib.SMTPException) as error:
+                        if self._breaker is not None:
+                            self._breaker.failed(error)
+                        raise
+                    if self._breaker is not None:
+                        self._breaker.succeeded()
+                refused = yield from self._transaction(
+                    envsender, recipients, data)
+            except (CONNECTION_ERRORS + (asyncio.TimeoutError,)) as error:
+                smart_host = self._smart_host
+                yield from self.quit()
+                if smart_host is None:
+                    raise
+                # Fail over to another smarthost, if there is one left.
+                self._smart_hosts.failed(smart_host)
+                failed.add(smart_host)
+                if len(failed) == len(self._smart_hosts.hosts):
+                    raise
+                log.error('Lost smarthost %s:%s, failing over: %s',
+                          smart_host.host, smart_host.port, error)
+                continue
+            except (OSError, smtplib.SMTPException):
+                # For safety, close this connection.  The next send attempt
+                # will automatically re-open it.  Pass the exception on up.
+                yield from self.quit()
+                raise
+            break
+        # This session has been successfully completed.
+        self._session_count -= 1
+        if self._session_count == 0:
+            yield from self.quit()
+        return refused
+
+    @asyncio.coroutine
+    def _transaction(self, envsender, recipients, data):
+        commands = ['MAIL FROM:<{0}>'.format(envsender)]
+        commands.extend('RCPT TO:<{0}>'.format(recipient)
+                        for recipient in recipients)
+        commands.append('DATA')
+        replies = []
+        if self.pipelining:
+            # Send the whole batch of commands, then collect the replies.
+            self._writer.write(CRLF.join(
+                command.encode('utf-8') for command in commands) + CRLF)
+            for command in commands:
+                replies.append((yield from self._reply()))
+        else:
+            # Stop as soon as the server refuses the sender, or all the
+            # recipients.
+            replies.append((yield from self._command(commands[0])))
+            if replies[0][0] == 250:
+                for command in commands[1:-1]:
+                    replies.append((yield from self._command(command)))
+                if any(code in (250, 251) for code, text in replies[1:]):
+                    replies.append((yield from self._command('DATA')))
+        mail_reply = replies[0]
+        rcpt_replies = replies[1:len(recipients) + 1]
+        data_reply = (replies[-1] if len(replies) == len(commands) else None)
+        refused = {recipient: reply
+                   for recipient, reply in zip(recipients, rcpt_replies)
+                   if reply[0] not in (250, 251)}
+        if data_reply is not None and data_reply[0] == 354:
+            if mail_reply[0] != 250 or len(refused) == len(recipients):
+                # The server shouldn't have accepted the DATA command, but
+                # it did, so send an empty message to finish the transaction
+                # before resetting it.
+                self._writer.write(b'.\r\n')
+                yield from self._reply()
+            else:
+                self._writer.write(data)
+                code, text = yield from self._reply()
+                if code != 250:
+                    yield from self._command('RSET')
+                    raise smtplib.SMTPDataError(code, text)
+                return refused
+        yield from self._command('RSET')
+        if mail_reply[0] != 250:
+            raise smtplib.SMTPSenderRefused(
+                mail_reply[0], mail_reply[1], envsender)
+        if len(refused) == len(recipients):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        raise smtplib.SMTPDataError(*data_reply)
+
+    @asyncio.coroutine
+    def quit(self):
+        """Close the connection, like `smtplib.SMTP.quit`."""
+        if self._writer is None:
+            return
+        writer = self._writer
+        self._reader = self._writer = None
+        if self._smart_host is not None:
+            self._smart_hosts.disconnected(self._smart_host)
+            self._smart_host = None
+        try:
+            writer.write(b'QUIT\r\n')
+            yield from writer.drain()
+        except OSError:
+            pass
+        writer.close()
+
+
+
+class AsyncIndividualDelivery(IndividualDelivery):
+    """Deliver individual messages over many concurrent SMTP sessions.
+
+    This is a drop-in replacement for `IndividualDelivery`, and it is
+    customized with the same mixins and callbacks.
+    """
+
+    def __init__(self):
+        """See `IndividualDelivery`."""
+        super(AsyncIndividualDelivery, self).__init__()
+        self._sessions = int(config.mta.max_async_sessions)
+
+    def deliver(self, mlist, msg, msgdata):
+        """See `IMailTransportAgentDelivery`."""
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(
+                self._deliver(loop, mlist, msg, msgdata))
+        finally:
+            loop.close()
+
+    @asyncio.coroutine
+    def _deliver(self, loop, mlist, msg, msgdata):
+        refused = {}
+        recipients = msgdata.get('recipients', set())
+        if len(recipients) == 0:
+            return refused
+        username = (config.mta.smtp_user if config.mta.smtp_user else None)
+        password = (config.mta.smtp_pass if config.mta.smtp_pass else None)
+        # Messages are crafted only as fast as the sessions can send them.
+        count = max(1, min(self._sessions, len(recipients)))
+        queue = asyncio.Queue(count, loop=loop)
+        template = self._make_template(mlist, msg, msgdata)
+        members = mlist.members.get_members(recipients)
+        smart_hosts = get_smart_hosts()
+        breaker = get_circuit_breaker()
+        workers = []
+        for i in range(count):
+            connection = AsyncConnection(
+                config.mta.smtp_host, int(config.mta.smtp_port),
+                int(config.mta.max_sessions_per_connection),
+                username, password, loop, smart_hosts, breaker)
+            workers.append(loop.create_task(
+                self._work(loop, connection, queue, refused)))
+        try:
+            for recipient in recipients:
+                log.debug('AsyncIndividualDelivery to: %s', recipient)
+                message_copy, msgdata_copy = self._craft(
+                    mlist, msg, msgdata, recipient, template, members)
+                sender = self._get_sender(mlist, message_copy, msgdata_copy)
+                yield from self._put(loop, queue, workers, (
+                    sender, recipient, _prepare(message_copy.as_string()),
+                    message_copy['message-id']))
+            for worker in workers:
+                yield from self._put(loop, queue, workers, None)
+        except:
+            # Nothing more is coming, so don't leave the workers waiting.
+            for worker in workers:
+                worker.cancel()
+            raise
+        finally:
+            yield from asyncio.wait(workers, loop=loop)
+        for worker in workers:
+            # Pass on any unexpected exceptions.
+            worker.result()
+        return refused
+
+    @asyncio.coroutine
+    def _put(self, loop, queue, workers, item):
+        """Queue an item for the workers, as long as they are still working.
+
+        :raises: The exception that a worker died of.
+        """
+        put = asyncio.ensure_future(queue.put(item), loop=loop)
+        while not put.done():
+            running = [worker for worker in workers if not worker.done()]
+            if len(running) == 0:
+                # Nobody is left to take the item.
+                put.cancel()
+                break
+            yield from asyncio.wait(
+                running + [put], loop=loop,
+                return_when=asyncio.FIRST_COMPLETED)
+            for worker in workers:
+                if worker.done() and (worker.cancelled() or
+                                      worker.exception() is not None):
+                    put.cancel()
+                    worker.result()
+
+    @asyncio.coroutine
+    def _work(self, loop, connection, queue, refused):
+        try:
+            while True:
+                item = yield from queue.get()
+                if item is None:
+                    break
+                sender, recipient, data, message_id = item
+                try:
+                    refused.update((yield from self._send_async(
+                        loop, connection, sender, [recipient], data,
+                        message_id)))
+                except asyncio.CancelledError:
+                    raise
+                except Exception as error:
+                    # Keep working, so that the delivery isn't held up, but
+                    # try the recipient again later.
+                    log.exception('%s unexpected delivery error', message_id)
+                    refused[recipient] = (444, str(error))
+                    # The session could be in any state now.
+                    yield from connection.quit()
+        finally:
+            yield from connection.quit()
+
+    @asyncio.coroutine
+    def _send_async(self, loop, connection, sender, recipients, data,
+                    message_id):
+        """Send a message, turning errors into refusals.
+
+        This is the asynchronous equivalent of `BaseDelivery._send()`.
+        """
+        try:
+            delay = self._reserve(recipients, message_id)
+            if delay > 0:
+                yield from asyncio.sleep(delay, loop=loop)
+            return (yield from connection.sendmail(sender, recipients, data))
+        except smtplib.SMTPRecipientsRefused as error:
+            log.error('%s recipients refused: %s', message_id, error)
+            return error.recipients
+        except smtplib.SMTPResponseException as error:
+            log.error('%s response exception: %s', message_id, error)
+            return dict(
+                # recipient -> (code, error)
+                (recipient, (error.smtp_code, error.smtp_error))
+                for recipient in recipients)
+        except (OSError, asyncio.TimeoutError, smtplib.SMTPException) as error:
+            # MTA not responding, or other socket problems, or any other
+            # kind of SMTPException.  In that case, nothing got delivered,
+            # so treat this as a temporary failure.
+            log.error('%s low level smtp error: %s', message_id, error)
+            error = str(error)
+            return dict(
+                # recipient -> (code, error)
+                (recipient, (444, error))
+                for recipient in recipients)
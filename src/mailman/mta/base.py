@@ -24,13 +24,18 @@ __all__ = [
 
 
 import copy
+import time
 import socket
 import logging
 import smtplib
 
 from mailman.config import config
 from mailman.interfaces.mta import IMailTransportAgentDelivery
-from mailman.mta.connection import Connection
+from mailman.mta.breaker import get_circuit_breaker
+from mailman.mta.connection import Connection, ConnectionPool
+from mailman.mta.smarthosts import get_smart_hosts
+from mailman.mta.splicing import MessageTemplate, RenderedMessage
+from mailman.mta.throttle import get_throttle
 from zope.interface import implementer
 
 
@@ -46,10 +51,20 @@ class BaseDelivery:
         """Create a basic deliverer."""
         username = (config.mta.smtp_user if config.mta.smtp_user else None)
         password = (config.mta.smtp_pass if config.mta.smtp_pass else None)
+        smart_hosts = get_smart_hosts()
+        breaker = get_circuit_breaker()
         self._connection = Connection(
             config.mta.smtp_host, int(config.mta.smtp_port),
             int(config.mta.max_sessions_per_connection),
-            username, password)
+            username, password, smart_hosts, breaker)
+        # Connections are only opened when they are first used, so creating
+        # the pool is cheap even if nothing ends up being sent through it.
+        threads = int(config.mta.max_delivery_threads)
+        self._pool = (None if threads <= 1 else ConnectionPool(
+            threads, config.mta.smtp_host, int(config.mta.smtp_port),
+            int(config.mta.max_sessions_per_connection),
+            username, password, smart_hosts, breaker))
+        self._throttle = get_throttle()
 
     def _deliver_to_recipients(self, mlist, msg, msgdata, recipients):
         """Low-level delivery to a set of recipients.
@@ -67,10 +82,30 @@ class BaseDelivery:
         """
         # Do the actual sending.
         sender = self._get_sender(mlist, msg, msgdata)
-        message_id = msg['message-id']
+        return self._send(self._connection, sender, recipients,
+                          msg.as_string(), msg['message-id'])
+
+    def _send(self, connection, sender, recipients, msgtext, message_id):
+        """Send a message over a connection, turning errors into refusals.
+
+        :param connection: The connection to send the message over.
+        :type connection: `Connection`
+        :param sender: The envelope sender.
+        :type sender: string
+        :param recipients: The recipients of this message.
+        :type recipients: sequence
+        :param msgtext: The message text.
+        :type msgtext: string
+        :param message_id: The Message-ID, for logging.
+        :type message_id: string
+        :return: delivery failures as defined by `smtplib.SMTP.sendmail`
+        :rtype: dictionary
+        """
+        delay = self._reserve(recipients, message_id)
+        if delay > 0:
+            time.sleep(delay)
         try:
-            refused = self._connection.sendmail(
-                sender, recipients, msg.as_string())
+            refused = connection.sendmail(sender, recipients, msgtext)
         except smtplib.SMTPRecipientsRefused as error:
             log.error('%s recipients refused: %s', message_id, error)
             refused = error.recipients
@@ -93,6 +128,19 @@ class BaseDelivery:
                 for recipient in recipients)
         return refused
 
+    def _reserve(self, recipients, message_id):
+        """Reserve the recipients' share of the throttled delivery rates.
+
+        :return: The number of seconds to wait before sending.
+        :rtype: float
+        """
+        if self._throttle is None:
+            return 0
+        delay = self._throttle.reserve(recipients)
+        if delay > 0:
+            log.debug('%s throttled for %.1f seconds', message_id, delay)
+        return delay
+
     def _get_sender(self, mlist, msg, msgdata):
         """Return the envelope sender to use.
 
@@ -130,6 +178,16 @@ class IndividualDelivery(BaseDelivery):
     The core concept here is that for each recipient, the deliver() method
     iterates over the list of registered callbacks, each of which have a
     chance to modify the message before final delivery.
+
+    Copying and flattening the whole message for every recipient is slow
+    though, so when every callback is a method with a companion method named
+    with a `_template` suffix, the message is instead modified once, by the
+    companions, into a `MessageTemplate`.  Each companion is called with the
+    mailing list, a copy of the message and the message metadata, and the
+    template, and it puts the template's markers in the message where the
+    callback would make recipient specific changes.  A callback without a
+    companion needs its own copy of the message for every recipient, as does
+    any recipient whose text can't be spliced into the template.
     """
 
     def __init__(self):
@@ -146,25 +204,93 @@ class IndividualDelivery(BaseDelivery):
         """
         refused = {}
         recipients = msgdata.get('recipients', set())
+        template = self._make_template(mlist, msg, msgdata)
+        members = mlist.members.get_members(recipients)
         for recipient in recipients:
             log.debug('IndividualDelivery to: %s', recipient)
-            # Make a copy of the original messages and operator on it, since
-            # we're going to munge it repeatedly for each recipient.
-            message_copy = copy.deepcopy(msg)
-            msgdata_copy = msgdata.copy()
-            # Squirrel the current recipient away in the message metadata.
-            # That way the subclass's _get_sender() override can encode the
-            # recipient address in the sender, e.g. for VERP.
-            msgdata_copy['recipient'] = recipient
-            # See if the recipient is a member of the mailing list, and if so,
-            # squirrel this information away for use by other modules, such as
-            # the header/footer decorator.  XXX 2012-03-05 this is probably
-            # highly inefficient on the database.
-            member = mlist.members.get_member(recipient)
-            msgdata_copy['member'] = member
-            for callback in self.callbacks:
-                callback(mlist, message_copy, msgdata_copy)
+            message_copy, msgdata_copy = self._craft(
+                mlist, msg, msgdata, recipient, template, members)
             status = self._deliver_to_recipients(
                 mlist, message_copy, msgdata_copy, [recipient])
             refused.update(status)
         return refused
+
+    def _make_template(self, mlist, msg, msgdata):
+        """Make the template shared by all the recipients' messages.
+
+        :param mlist: The mailing list being delivered to.
+        :type mlist: `IMailingList`
+        :param msg: The original message being delivered.
+        :type msg: `Message`
+        :param msgdata: Additional message metadata for this delivery.
+        :type msgdata: dictionary
+        :return: The template, or None if the callbacks can't use one.
+        :rtype: `MessageTemplate`
+        """
+        companions = []
+        for callback in self.callbacks:
+            companion = getattr(
+                self, getattr(callback, '__name__', '') + '_template', None)
+            if getattr(callback, '__self__', None) is not self or (
+                    companion is None):
+                return None
+            companions.append(companion)
+        template = MessageTemplate()
+        message_copy = copy.deepcopy(msg)
+        msgdata_copy = msgdata.copy()
+        for companion in companions:
+            companion(mlist, message_copy, msgdata_copy, template)
+        if not template.compile(message_copy):
+            log.debug('Not splicing %s', msg.get('message-id'))
+            return None
+        template.changes = {
+            key: value for key, value in msgdata_copy.items()
+            if key not in msgdata or msgdata[key] is not value}
+        return template
+
+    def _craft(self, mlist, msg, msgdata, recipient, template=None,
+               members=None):
+        """Craft the message for a single recipient.
+
+        :param mlist: The mailing list being delivered to.
+        :type mlist: `IMailingList`
+        :param msg: The original message being delivered.
+        :type msg: `Message`
+        :param msgdata: Additional message metadata for this delivery.
+        :type msgdata: dictionary
+        :param recipient: The recipient's email address.
+        :type recipient: string
+        :param template: The template made by `_make_template()`, if any.
+        :type template: `MessageTemplate`
+        :param members: The recipients' memberships, as returned by the
+            roster's `get_members()`, if they've been looked up already.
+        :type members: dict
+        :return: 2-tuple of the recipient's copies of the message and its
+            metadata, as modified by the callbacks.
+        """
+        msgdata_copy = msgdata.copy()
+        # Squirrel the current recipient away in the message metadata.
+        # That way the subclass's _get_sender() override can encode the
+        # recipient address in the sender, e.g. for VERP.
+        msgdata_copy['recipient'] = recipient
+        # See if the recipient is a member of the mailing list, and if so,
+        # squirrel this information away for use by other modules, such as
+        # the header/footer decorator.  The deliveries look up all the
+        # members at once, since one query each is highly inefficient on the
+        # database.
+        member = (mlist.members.get_member(recipient)
+                  if members is None
+                  else members.get(recipient))
+        msgdata_copy['member'] = member
+        if template is not None:
+            text = template.render(mlist, msgdata_copy)
+            if text is not None:
+                msgdata_copy.update(template.changes)
+                return (RenderedMessage(text, msg.get('message-id')),
+                        msgdata_copy)
+        # Make a copy of the original messages and operator on it, since
+        # we're going to munge it repeatedly for each recipient.
+        message_copy = copy.deepcopy(msg)
+        for callback in self.callbacks:
+            callback(mlist, message_copy, msgdata_copy)
+        return message_copy, msgdata_copy
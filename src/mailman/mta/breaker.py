@@ -0,0 +1,199 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Pausing outgoing deliveries while the MTA can't be reached.
+
+The circuit breaker counts the failures to connect to the MTA in a row.  Once
+there are too many of them, the breaker opens, and the out runners stop
+dequeuing messages until it is time to probe the MTA again.  Then one runner
+gets to try a delivery; if it connects, the breaker closes again, and if it
+doesn't, the time until the next probe is doubled, up to a maximum.
+
+The breaker's state is shared by all the runners through a small state file.
+"""
+
+__all__ = [
+    'BreakerState',
+    'CircuitBreaker',
+    'get_circuit_breaker',
+    ]
+
+
+import os
+import json
+import time
+import logging
+
+from enum import Enum
+from lazr.config import as_timedelta
+from mailman.config import config
+from mailman.utilities.filesystem import shared_state
+
+
+log = logging.getLogger('mailman.smtp')
+
+
+
+class BreakerState(Enum):
+    """The state of the circuit breaker."""
+    # Deliveries go ahead.
+    closed = 'closed'
+    # Deliveries are paused.
+    open = 'open'
+    # It is time to probe the MTA again.
+    half_open = 'half-open'
+
+
+
+class CircuitBreaker:
+    """A circuit breaker around the connections to the MTA."""
+
+    def __init__(self, path, threshold, min_interval, max_interval):
+        """Create a circuit breaker.
+
+        :param path: The state file shared by all the runners.
+        :type path: string
+        :param threshold: The number of failures in a row which opens the
+            breaker.
+        :type threshold: integer
+        :param min_interval: The number of seconds until the MTA is first
+            probed again.
+        :type min_interval: float
+        :param max_interval: The maximum number of seconds between probes.
+        :type max_interval: float
+        """
+        self._path = path
+        self._threshold = threshold
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+
+    def _read(self):
+        # While all is well, the state is empty, and the breaker doesn't need
+        # to lock the file just to find that out.  A partly written file
+        # reads as empty too, which is no worse than a little late.
+        try:
+            with open(self._path) as fp:
+                return json.loads(fp.read())
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def status(self, now=None):
+        """Return the state of the breaker.
+
+        :param now: The current time, for testing.
+        :type now: float
+        :return: A dictionary with the `BreakerState` as `state`, the
+            number of failures in a row as `failures`, the last error as
+            `error`, and the time of the next probe as `probe_at`, or None
+            when the breaker is closed.
+        :rtype: dict
+        """
+        if now is None:
+            now = time.time()
+        state = self._read()
+        probe_at = state.get('probe_at')
+        if probe_at is None:
+            breaker_state = BreakerState.closed
+        elif probe_at > now:
+            breaker_state = BreakerState.open
+        else:
+            breaker_state = BreakerState.half_open
+        return dict(state=breaker_state,
+                    failures=state.get('failures', 0),
+                    error=state.get('error'),
+                    probe_at=probe_at)
+
+    def allow(self, now=None):
+        """Return whether a delivery may be attempted.
+
+        When the breaker is half-open, only the first caller gets to probe
+        the MTA, and the others wait for the probe's interval again.
+
+        :param now: The current time, for testing.
+        :type now: float
+        :rtype: bool
+        """
+        if now is None:
+            now = time.time()
+        if self._read().get('probe_at') is None:
+            return True
+        with shared_state(self._path) as state:
+            probe_at = state.get('probe_at')
+            if probe_at is None:
+                return True
+            if probe_at > now:
+                return False
+            log.info('Probing the MTA after %s connection failures',
+                     state['failures'])
+            state['probe_at'] = now + state['interval']
+            state['probing'] = True
+            return True
+
+    def succeeded(self):
+        """Record a successful connection to the MTA."""
+        if len(self._read()) == 0:
+            return
+        with shared_state(self._path) as state:
+            if state.get('probe_at') is not None:
+                log.info('The MTA is back after %s connection failures',
+                         state['failures'])
+            state.clear()
+
+    def failed(self, error, now=None):
+        """Record a failure to connect to the MTA.
+
+        :param error: The error.
+        :type error: Exception
+        :param now: The current time, for testing.
+        :type now: float
+        """
+        if now is None:
+            now = time.time()
+        with shared_state(self._path) as state:
+            state['failures'] = state.get('failures', 0) + 1
+            state['error'] = str(error)
+            if state.get('probe_at') is None:
+                if state['failures'] < self._threshold:
+                    return
+                interval = self._min_interval
+            elif state.get('probing'):
+                interval = min(state['interval'] * 2, self._max_interval)
+            else:
+                # Connections made before the breaker opened are still
+                # failing, but that doesn't change when to probe.
+                return
+            log.error('Pausing deliveries for %s seconds after %s '
+                      'connection failures: %s',
+                      interval, state['failures'], error)
+            state.update(interval=interval, probe_at=now + interval,
+                         probing=False)
+
+
+
+def get_circuit_breaker():
+    """Return the configured circuit breaker.
+
+    :return: The circuit breaker, or None if there isn't one.
+    :rtype: `CircuitBreaker`
+    """
+    threshold = int(config.mta.breaker_threshold)
+    if threshold <= 0:
+        return None
+    return CircuitBreaker(
+        os.path.join(config.DATA_DIR, 'circuit-breaker.json'), threshold,
+        as_timedelta(config.mta.breaker_min_interval).total_seconds(),
+        as_timedelta(config.mta.breaker_max_interval).total_seconds())
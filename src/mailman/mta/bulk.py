@@ -22,44 +22,51 @@ __all__ = [
     ]
 
 
+import logging
+
+from mailman.config import config
 from mailman.mta.base import BaseDelivery
+from mailman.mta.limits import get_recipient_limits
+from mailman.utilities.modules import find_name
+
 
+log = logging.getLogger('mailman.smtp')
 
-# A mapping of top-level domains to bucket numbers.  The zeroth bucket is
-# reserved for everything else.  At one time, these were the most common
-# domains.
-CHUNKMAP = dict(
-    com=1,
-    net=2,
-    org=2,
-    edu=3,
-    us=3,
-    ca=3,
-    )
+# The reply code for a server which has run out of room for recipients in a
+# transaction; see RFC 5321, section 4.5.3.1.10.
+TOO_MANY_RECIPIENTS = 452
 
 
 
 class BulkDelivery(BaseDelivery):
     """Deliver messages to the MSA in as few sessions as possible."""
 
-    def __init__(self, max_recipients=None):
+    def __init__(self, max_recipients=None, chunker=None):
         """See `BaseDelivery`.
 
         :param max_recipients: The maximum number of recipients per delivery
             chunk.  None, zero or less means to group all recipients into one
             big chunk.
         :type max_recipients: integer
+        :param chunker: The strategy for splitting the recipients into
+            chunks.  The default comes from the configuration.
+        :type chunker: `IRecipientChunker`
         """
         super(BulkDelivery, self).__init__()
         self._max_recipients = (max_recipients
                                 if max_recipients is not None
                                 else 0)
+        self._chunker = (find_name(config.mta.chunker)(self._max_recipients)
+                         if chunker is None
+                         else chunker)
+        self._limits = get_recipient_limits()
 
     def chunkify(self, recipients):
         """Split a set of recipients into chunks.
 
         The `max_recipients` argument given to the constructor specifies the
-        maximum number of recipients in each chunk.
+        maximum number of recipients in each chunk, and the chunker decides
+        which recipients go together.
 
         :param recipients: The set of recipient email addresses
         :type recipients: sequence of email address strings
@@ -68,40 +75,65 @@ class BulkDelivery(BaseDelivery):
             contain fewer, and no packing is guaranteed.
         :rtype: list of sets of strings
         """
-        if self._max_recipients <= 0:
-            yield set(recipients)
-            return
-        # This algorithm was originally suggested by Chuq Von Rospach.  Start
-        # by splitting the recipient addresses into top-level domain buckets,
-        # using the "most common" domains.  Everything else ends up in the
-        # zeroth bucket.
-        by_bucket = {}
-        for address in recipients:
-            localpart, at, domain = address.partition('@')
-            domain_parts = domain.split('.')
-            bucket_number = CHUNKMAP.get(domain_parts[-1], 0)
-            by_bucket.setdefault(bucket_number, set()).add(address)
-        # Fill chunks by sorting the tld values by length.
-        chunk = set()
-        for tld_chunk in sorted(by_bucket.values(), key=len, reverse=True):
-            while tld_chunk:
-                chunk.add(tld_chunk.pop())
-                if len(chunk) == self._max_recipients:
-                    yield chunk
-                    chunk = set()
-            # Every tld bucket starts a new chunk, but only if non-empty
-            if len(chunk) > 0:
-                yield chunk
-                chunk = set()
-        # Be sure to include the last chunk, but only if it's non-empty.
-        if len(chunk) > 0:
-            yield chunk
+        return self._chunker.chunkify(recipients)
 
     def deliver(self, mlist, msg, msgdata):
         """See `IMailTransportAgentDelivery`."""
         refused = {}
-        for recipients in self.chunkify(msgdata.get('recipients', set())):
-            chunk_refused = self._deliver_to_recipients(
-                mlist, msg, msgdata, recipients)
-            refused.update(chunk_refused)
+        chunks = self._limits.split(
+            self.chunkify(msgdata.get('recipients', set())))
+        if len(chunks) == 0:
+            return refused
+        # Every chunk gets the same message, so it only has to be rendered
+        # once, before any threads are involved.
+        sender = self._get_sender(mlist, msg, msgdata)
+        msgtext = msg.as_string()
+        message_id = msg['message-id']
+        if self._pool is None or len(chunks) < 2:
+            for recipients in chunks:
+                refused.update(self._send_chunk(
+                    self._connection, sender, recipients, msgtext,
+                    message_id))
+            return refused
+        # Send the chunks in parallel, each over a connection from the pool.
+        def send(connection, recipients):
+            return self._send_chunk(
+                connection, sender, recipients, msgtext, message_id)
+        try:
+            for chunk_refused in self._pool.map(send, chunks):
+                refused.update(chunk_refused)
+        finally:
+            self._pool.quit()
+        return refused
+
+    def _send_chunk(self, connection, sender, recipients, msgtext,
+                    message_id):
+        """Send a chunk, re-sending recipients over the server's limit.
+
+        When the server accepts some of the recipients but refuses the rest
+        because there are too many of them, the refused recipients are sent
+        again right away, in chunks no bigger than the number which was
+        accepted, and that number is learned as the limit for their domains.
+
+        The arguments and return value are as for `BaseDelivery._send()`.
+        """
+        recipients = list(recipients)
+        refused = self._send(
+            connection, sender, recipients, msgtext, message_id)
+        too_many = sorted(recipient
+                          for recipient, (code, error) in refused.items()
+                          if code == TOO_MANY_RECIPIENTS)
+        limit = len(recipients) - len(too_many)
+        # When nothing was accepted, the server isn't just out of room.
+        if len(too_many) == 0 or limit == 0:
+            return refused
+        log.info('%s %s recipients over the limit of %s, sending them again',
+                 message_id, len(too_many), limit)
+        self._limits.learn(too_many, limit)
+        for recipient in too_many:
+            del refused[recipient]
+        for i in range(0, len(too_many), limit):
+            refused.update(self._send_chunk(
+                connection, sender, too_many[i:i + limit], msgtext,
+                message_id))
         return refused
@@ -0,0 +1,245 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Strategies for splitting bulk delivery recipients into chunks."""
+
+__all__ = [
+    'DNSResolver',
+    'DomainChunker',
+    'MailExchangerChunker',
+    'StaticResolver',
+    'TopLevelDomainChunker',
+    ]
+
+
+import time
+import logging
+
+from mailman.config import config
+from mailman.interfaces.mta import IMailExchangerResolver, IRecipientChunker
+from mailman.utilities.modules import find_name
+from zope.interface import implementer
+
+try:
+    import dns.resolver
+    import dns.exception
+except ImportError:
+    dns = None
+
+
+log = logging.getLogger('mailman.smtp')
+
+
+# A mapping of top-level domains to bucket numbers.  The zeroth bucket is
+# reserved for everything else.  At one time, these were the most common
+# domains.
+CHUNKMAP = dict(
+    com=1,
+    net=2,
+    org=2,
+    edu=3,
+    us=3,
+    ca=3,
+    )
+
+
+
+@implementer(IRecipientChunker)
+class TopLevelDomainChunker:
+    """Group recipients by the most common top-level domains."""
+
+    def __init__(self, max_recipients):
+        """See `IRecipientChunker`."""
+        self._max_recipients = max_recipients
+
+    def chunkify(self, recipients):
+        """See `IRecipientChunker`."""
+        if self._max_recipients <= 0:
+            yield set(recipients)
+            return
+        # This algorithm was originally suggested by Chuq Von Rospach.  Start
+        # by splitting the recipient addresses into top-level domain buckets,
+        # using the "most common" domains.  Everything else ends up in the
+        # zeroth bucket.
+        by_bucket = {}
+        for address in recipients:
+            localpart, at, domain = address.partition('@')
+            domain_parts = domain.split('.')
+            bucket_number = CHUNKMAP.get(domain_parts[-1], 0)
+            by_bucket.setdefault(bucket_number, set()).add(address)
+        # Fill chunks by sorting the tld values by length.
+        chunk = set()
+        for tld_chunk in sorted(by_bucket.values(), key=len, reverse=True):
+            while tld_chunk:
+                chunk.add(tld_chunk.pop())
+                if len(chunk) == self._max_recipients:
+                    yield chunk
+                    chunk = set()
+            # Every tld bucket starts a new chunk, but only if non-empty
+            if len(chunk) > 0:
+                yield chunk
+                chunk = set()
+        # Be sure to include the last chunk, but only if it's non-empty.
+        if len(chunk) > 0:
+            yield chunk
+
+
+
+@implementer(IRecipientChunker)
+class DomainChunker:
+    """Group recipients by their domain.
+
+    Domains with at least `max_domain_recipients` recipients get chunks of
+    their own, largest domain first.  What's left of each domain is packed
+    into shared chunks, without splitting a domain between them, so that small
+    domains don't each cost a separate SMTP transaction.
+    """
+
+    def __init__(self, max_recipients, max_domain_recipients=None):
+        """See `IRecipientChunker`.
+
+        :param max_domain_recipients: The maximum number of recipients in the
+            same domain per chunk.  Zero or less means the same as
+            `max_recipients`.  The default comes from the configuration.
+        :type max_domain_recipients: integer
+        """
+        self._max_recipients = max_recipients
+        self._max_domain_recipients = (
+            int(config.mta.max_domain_recipients)
+            if max_domain_recipients is None
+            else max_domain_recipients)
+
+    def _key(self, domain):
+        """Return the key grouping recipients in the given domain."""
+        return domain
+
+    def chunkify(self, recipients):
+        """See `IRecipientChunker`."""
+        by_key = {}
+        for address in recipients:
+            localpart, at, domain = address.rpartition('@')
+            by_key.setdefault(self._key(domain.lower()), []).append(address)
+        # Zero means no limit on either count.
+        limit = self._max_recipients
+        domain_limit = self._max_domain_recipients
+        if domain_limit <= 0 or 0 < limit < domain_limit:
+            domain_limit = limit
+        shared = set()
+        for key, addresses in sorted(by_key.items(),
+                                     key=lambda item: (-len(item[1]), item[0])):
+            addresses.sort()
+            if domain_limit > 0:
+                while len(addresses) >= domain_limit:
+                    yield set(addresses[:domain_limit])
+                    del addresses[:domain_limit]
+            if len(addresses) == 0:
+                continue
+            if 0 < limit < len(shared) + len(addresses):
+                yield shared
+                shared = set()
+            shared.update(addresses)
+        if len(shared) > 0:
+            yield shared
+
+
+
+class MailExchangerChunker(DomainChunker):
+    """Group recipients by the mail exchanger for their domain.
+
+    Domains sharing a mail exchanger, such as those hosted by the big mail
+    providers, end up in the same chunks, and the mail exchanger's recipients
+    count against `max_domain_recipients` together.
+    """
+
+    def __init__(self, max_recipients, max_domain_recipients=None,
+                 resolver=None):
+        """See `DomainChunker`.
+
+        :param resolver: The resolver finding the domains' mail exchangers.
+            The default comes from the configuration.
+        :type resolver: `IMailExchangerResolver`
+        """
+        super(MailExchangerChunker, self).__init__(
+            max_recipients, max_domain_recipients)
+        self._resolver = (find_name(config.mta.mx_resolver)()
+                          if resolver is None
+                          else resolver)
+        self._keys = {}
+
+    def _key(self, domain):
+        """See `DomainChunker`."""
+        key = self._keys.get(domain)
+        if key is None:
+            exchangers = self._resolver.get_exchangers(domain)
+            # Domains without a mail exchanger get mail delivered directly.
+            key = (exchangers[0] if len(exchangers) > 0 else domain)
+            self._keys[domain] = key
+        return key
+
+
+
+@implementer(IMailExchangerResolver)
+class StaticResolver:
+    """Mail exchangers from a fixed mapping."""
+
+    def __init__(self, exchangers=None):
+        """Create a resolver.
+
+        :param exchangers: The mail exchanger host names for each domain, in
+            order of preference.  Other domains have no mail exchangers.
+        :type exchangers: dictionary
+        """
+        self._exchangers = ({} if exchangers is None else exchangers)
+
+    def get_exchangers(self, domain):
+        """See `IMailExchangerResolver`."""
+        return list(self._exchangers.get(domain.lower(), []))
+
+
+
+@implementer(IMailExchangerResolver)
+class DNSResolver:
+    """Mail exchangers from the domains' DNS MX records.
+
+    This needs the dnspython package.  Without it, no domain has any mail
+    exchangers.  Answers are remembered for as long as their time to live.
+    """
+
+    # The answers for each domain, and when they expire.
+    _cache = {}
+
+    def get_exchangers(self, domain):
+        """See `IMailExchangerResolver`."""
+        if dns is None:
+            return []
+        domain = domain.lower()
+        expiration, exchangers = self._cache.get(domain, (0, None))
+        if expiration > time.time():
+            return list(exchangers)
+        try:
+            answer = dns.resolver.query(domain, 'MX')
+        except dns.exception.DNSException as error:
+            log.info('No mail exchangers found for %s: %s', domain, error)
+            exchangers = []
+            expiration = time.time() + 300
+        else:
+            records = sorted(answer, key=lambda record: record.preference)
+            exchangers = [record.exchange.to_text().rstrip('.').lower()
+                          for record in records]
+            expiration = answer.expiration
+        self._cache[domain] = (expiration, exchangers)
+        return list(exchangers)
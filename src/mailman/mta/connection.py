@@ -19,24 +19,35 @@
 
 __all__ = [
     'Connection',
+    'ConnectionPool',
     ]
 
 
+import socket
 import logging
 import smtplib
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
 from lazr.config import as_boolean
 from mailman.config import config
 
 
 log = logging.getLogger('mailman.smtp')
 
+# The errors which mean that the SMTP server couldn't be reached, or went
+# away, rather than that it refused something.
+CONNECTION_ERRORS = (
+    ConnectionError, socket.timeout, smtplib.SMTPConnectError,
+    smtplib.SMTPServerDisconnected)
+
 
 
 class Connection:
     """Manage a connection to the SMTP server."""
     def __init__(self, host, port, sessions_per_connection,
-                 smtp_user=None, smtp_pass=None):
+                 smtp_user=None, smtp_pass=None, smart_hosts=None,
+                 breaker=None):
         """Create a connection manager.
 
         :param host: The host name of the SMTP server to connect to.
@@ -54,20 +65,60 @@ class Connection:
         :type smtp_user: str
         :param smtp_pass: Optional SMTP authentication password.  If given,
             `smtp_user` must also be given.
+        :param smart_hosts: Optional group of SMTP servers to spread the
+            connections over, instead of `host` and `port`.  When one of them
+            can't be reached, or goes away, the others are tried.
+        :type smart_hosts: `SmartHosts`
+        :param breaker: Optional circuit breaker, which is told whether each
+            new connection could be opened.
+        :type breaker: `CircuitBreaker`
         """
         self._host = host
         self._port = port
         self._sessions_per_connection = sessions_per_connection
         self._username = smtp_user
         self._password = smtp_pass
+        self._smart_hosts = smart_hosts
+        self._smart_host = None
+        self._breaker = breaker
         self._session_count = None
         self._connection = None
 
-    def _connect(self):
-        """Open a new connection."""
-        self._connection = smtplib.SMTP()
-        log.debug('Connecting to %s:%s', self._host, self._port)
-        self._connection.connect(self._host, self._port)
+    def _connect(self, failed=None):
+        """Open a new connection.
+
+        :param failed: The smarthosts which have failed so far, which are
+            not tried again.  The ones which fail now are added to it.
+        :type failed: set of `SmartHost`
+        """
+        if self._smart_hosts is None:
+            self._open(self._host, self._port)
+            return
+        failed = (set() if failed is None else failed)
+        while True:
+            smart_host = self._smart_hosts.select(exclude=failed)
+            assert smart_host is not None, 'No smarthosts left'
+            try:
+                self._open(smart_host.host, smart_host.port)
+            except (socket.error, smtplib.SMTPException) as error:
+                log.error('Cannot connect to smarthost %s:%s: %s',
+                          smart_host.host, smart_host.port, error)
+                self._close()
+                self._smart_hosts.failed(smart_host)
+                failed.add(smart_host)
+                if len(failed) == len(self._smart_hosts.hosts):
+                    raise
+                continue
+            self._smart_hosts.connected(smart_host)
+            self._smart_host = smart_host
+            return
+
+    def _open(self, host, port):
+        """Open a connection to an SMTP server."""
+        connection = smtplib.SMTP()
+        log.debug('Connecting to %s:%s', host, port)
+        connection.connect(host, port)
+        self._connection = connection
         if self._username is not None and self._password is not None:
             log.debug('Logging in')
             self._connection.login(self._username, self._password)
@@ -79,17 +130,41 @@ class Connection:
             # Force the recipients to the specified address, but still deliver
             # to the same number of recipients.
             recipients = [config.devmode.recipient] * len(recipients)
-        if self._connection is None:
-            self._connect()
-        try:
-            log.debug('envsender: %s, recipients: %s, size(msgtext): %s',
-                      envsender, recipients, len(msgtext))
-            results = self._connection.sendmail(envsender, recipients, msgtext)
-        except smtplib.SMTPException:
-            # For safety, close this connection.  The next send attempt will
-            # automatically re-open it.  Pass the exception on up.
-            self.quit()
-            raise
+        failed = set()
+        while True:
+            if self._connection is None:
+                try:
+                    self._connect(failed)
+                except (socket.error, smtplib.SMTPException) as error:
+                    if self._breaker is not None:
+                        self._breaker.failed(error)
+                    raise
+                if self._breaker is not None:
+                    self._breaker.succeeded()
+            try:
+                log.debug('envsender: %s, recipients: %s, size(msgtext): %s',
+                          envsender, recipients, len(msgtext))
+                results = self._connection.sendmail(
+                    envsender, recipients, msgtext)
+            except CONNECTION_ERRORS as error:
+                smart_host = self._smart_host
+                self.quit()
+                if smart_host is None:
+                    raise
+                # Fail over to another smarthost, if there is one left.
+                self._smart_hosts.failed(smart_host)
+                failed.add(smart_host)
+                if len(failed) == len(self._smart_hosts.hosts):
+                    raise
+                log.error('Lost smarthost %s:%s, failing over: %s',
+                          smart_host.host, smart_host.port, error)
+                continue
+            except smtplib.SMTPException:
+                # For safety, close this connection.  The next send attempt
+                # will automatically re-open it.  Pass the exception on up.
+                self.quit()
+                raise
+            break
         # This session has been successfully completed.
         self._session_count -= 1
         # By testing exactly for equality to 0, we automatically handle the
@@ -99,6 +174,12 @@ class Connection:
             self.quit()
         return results
 
+    def _close(self):
+        """Close the connection without a word to the server."""
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
     def quit(self):
         """Mimic `smtplib.SMTP.quit`."""
         if self._connection is None:
@@ -108,3 +189,86 @@ class Connection:
         except smtplib.SMTPException:
             pass
         self._connection = None
+        if self._smart_host is not None:
+            self._smart_hosts.disconnected(self._smart_host)
+            self._smart_host = None
+
+
+
+class ConnectionPool:
+    """Manage several connections to the SMTP server, used in parallel."""
+
+    def __init__(self, size, host, port, sessions_per_connection,
+                 smtp_user=None, smtp_pass=None, smart_hosts=None,
+                 breaker=None):
+        """Create a connection pool.
+
+        :param size: The maximum number of connections open at once.
+        :type size: integer
+        :param host: The host name of the SMTP server to connect to.
+        :type host: string
+        :param port: The port number of the SMTP server to connect to.
+        :type port: integer
+        :param sessions_per_connection: The number of SMTP sessions per
+            connection, as for `Connection`.  Each connection in the pool
+            keeps its own count.
+        :type sessions_per_connection: integer
+        :param smtp_user: Optional SMTP authentication user name.
+        :type smtp_user: str
+        :param smtp_pass: Optional SMTP authentication password.
+        :type smtp_pass: str
+        :param smart_hosts: Optional group of SMTP servers, as for
+            `Connection`.
+        :type smart_hosts: `SmartHosts`
+        :param breaker: Optional circuit breaker, as for `Connection`.
+        :type breaker: `CircuitBreaker`
+        """
+        assert size > 0, 'Bad pool size: {0}'.format(size)
+        self._size = size
+        self._arguments = (host, port, sessions_per_connection,
+                           smtp_user, smtp_pass, smart_hosts, breaker)
+        self._lock = threading.Lock()
+        self._connections = []
+        self._idle = []
+
+    def _acquire(self):
+        with self._lock:
+            if len(self._idle) > 0:
+                return self._idle.pop()
+            connection = Connection(*self._arguments)
+            self._connections.append(connection)
+            return connection
+
+    def _release(self, connection):
+        with self._lock:
+            self._idle.append(connection)
+
+    def map(self, function, items):
+        """Call a function for each of the items, in parallel.
+
+        No more than `size` calls are made at once, and every call gets a
+        connection which nothing else is using at the same time.
+
+        :param function: The function to call with a `Connection` and an item.
+        :type function: callable
+        :param items: The items.
+        :type items: iterable
+        :return: The results of the calls, in the order of the items.
+        :rtype: list
+        """
+        def call(item):
+            connection = self._acquire()
+            try:
+                return function(connection, item)
+            finally:
+                self._release(connection)
+        with ThreadPoolExecutor(max_workers=self._size) as executor:
+            return list(executor.map(call, items))
+
+    def quit(self):
+        """Close all the connections."""
+        with self._lock:
+            for connection in self._connections:
+                connection.quit()
+            del self._connections[:]
+            del self._idle[:]
@@ -23,10 +23,17 @@ __all__ = [
     ]
 
 
+from functools import partial
 from mailman.config import config
+from mailman.handlers.decorate import decoration_data
 from mailman.mta.verp import VERPDelivery
 
 
+# The interpolation variables which differ between recipients.
+USER_KEYS = ('user_address', 'user_delivered_to', 'user_language',
+             'user_name', 'user_optionsurl')
+
+
 
 class DecoratingMixin:
     """Decorate a message with recipient-specific headers and footers."""
@@ -38,6 +45,25 @@ class DecoratingMixin:
         # Do not decorate a message more than once.
         msgdata['nodecorate'] = True
 
+    def decorate_template(self, mlist, msg, msgdata, template):
+        """Decorate the message with markers for the recipient's data."""
+        # The same recipient's data is needed for all the markers.
+        cache = {}
+        def value(key, mlist, msgdata):
+            if cache.get('msgdata') is not msgdata:
+                cache['msgdata'] = msgdata
+                cache['data'] = decoration_data(msgdata)
+            data = cache['data'].get(key)
+            return (data if isinstance(data, str) else None)
+        extra = {key: template.add(partial(value, key)) for key in USER_KEYS}
+        # As in the handler, explicit decoration data wins.
+        extra.update(msgdata.get('decoration-data', {}))
+        data = msgdata.copy()
+        data['decoration-data'] = extra
+        data.pop('member', None)
+        config.handlers['decorate'].process(mlist, msg, data)
+        msgdata['nodecorate'] = True
+
 
 
 class DecoratingDelivery(DecoratingMixin, VERPDelivery):
@@ -18,6 +18,8 @@
 """Generic delivery."""
 
 __all__ = [
+    'AsyncDeliver',
+    'Deliver',
     'deliver',
     ]
 
@@ -28,11 +30,13 @@ import logging
 from mailman.config import config
 from mailman.interfaces.mailinglist import Personalization
 from mailman.interfaces.mta import SomeRecipientsFailed
+from mailman.mta.asynchronous import AsyncIndividualDelivery
 from mailman.mta.decorating import DecoratingMixin
 from mailman.mta.personalized import PersonalizedMixin
 from mailman.mta.verp import VERPMixin
 from mailman.mta.base import IndividualDelivery
 from mailman.mta.bulk import BulkDelivery
+from mailman.utilities.modules import find_name
 from mailman.utilities.string import expand
 
 
@@ -62,6 +66,19 @@ class Deliver(VERPMixin, DecoratingMixin, PersonalizedMixin,
             ])
 
 
+class AsyncDeliver(VERPMixin, DecoratingMixin, PersonalizedMixin,
+                   AsyncIndividualDelivery):
+    """Like `Deliver`, but over many concurrent SMTP sessions."""
+
+    def __init__(self):
+        super(AsyncDeliver, self).__init__()
+        self.callbacks.extend([
+            self.avoid_duplicates,
+            self.decorate,
+            self.personalize_to,
+            ])
+
+
 
 def deliver(mlist, msg, msgdata):
     """Deliver a message to the outgoing mail server."""
@@ -74,9 +91,9 @@ def deliver(mlist, msg, msgdata):
     # use individual delivery.  If not specified, use bulk delivery.  See the
     # to-outgoing handler for when the 'verp' key is set in the metadata.
     if msgdata.get('verp', False):
-        agent = Deliver()
+        agent = find_name(config.mta.individual_delivery)()
     elif mlist.personalize != Personalization.none:
-        agent = Deliver()
+        agent = find_name(config.mta.individual_delivery)()
     else:
         agent = BulkDelivery(int(config.mta.max_recipients))
     log.debug('Using agent: %s', agent)
@@ -125,7 +142,12 @@ def deliver(mlist, msg, msgdata):
     # Process any failed deliveries.
     temporary_failures = []
     permanent_failures = []
+    responses = {}
     for recipient, (code, smtp_message) in refused.items():
+        response = (smtp_message.decode('utf-8', 'replace')
+                    if isinstance(smtp_message, bytes)
+                    else smtp_message)
+        responses[recipient] = '{0} {1}'.format(code, response)
         # RFC 5321, $4.5.3.1.10 says:
         #
         #   RFC 821 [1] incorrectly listed the error where an SMTP server
@@ -152,4 +174,5 @@ def deliver(mlist, msg, msgdata):
             log.info('%s', expand(template, substitutions))
     # Return the results
     if temporary_failures or permanent_failures:
-        raise SomeRecipientsFailed(temporary_failures, permanent_failures)
+        raise SomeRecipientsFailed(
+            temporary_failures, permanent_failures, responses)
@@ -0,0 +1,145 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Learned limits on the number of recipients per SMTP transaction.
+
+When a server runs out of room for recipients in a transaction, it refuses
+the rest of them with a 452 reply code.  The number of recipients it did
+accept is remembered for the domains of the refused recipients, so that later
+chunks with recipients in those domains are no bigger than that.  The limits
+are shared by all the runners through a small state file, and they are
+forgotten after a while, in case the server has been given more room.
+"""
+
+__all__ = [
+    'RecipientLimits',
+    'get_recipient_limits',
+    ]
+
+
+import os
+import time
+
+from lazr.config import as_timedelta
+from mailman.config import config
+from mailman.utilities.filesystem import shared_state
+
+
+def _domain(address):
+    return address.rpartition('@')[2].lower()
+
+
+
+class RecipientLimits:
+    """The learned recipient limits of the destination domains."""
+
+    def __init__(self, path, lifetime):
+        """Create a set of limits.
+
+        :param path: The state file shared by all the runners.
+        :type path: string
+        :param lifetime: How long a learned limit is remembered, in seconds.
+            Limits aren't remembered at all if this is zero or less.
+        :type lifetime: float
+        """
+        self._path = path
+        self._lifetime = lifetime
+
+    def get(self, recipients, now=None):
+        """Return the limits for some recipients' domains.
+
+        :param recipients: The recipients.
+        :type recipients: iterable of strings
+        :param now: The current time, for testing.
+        :type now: float
+        :return: The limits of the domains which have one.
+        :rtype: dictionary mapping domains to integers
+        """
+        if self._lifetime <= 0 or not os.path.exists(self._path):
+            return {}
+        if now is None:
+            now = time.time()
+        domains = set(_domain(recipient) for recipient in recipients)
+        with shared_state(self._path) as state:
+            return dict((domain, limit)
+                        for domain, (limit, expiration) in state.items()
+                        if domain in domains and expiration > now)
+
+    def learn(self, recipients, limit, now=None):
+        """Remember the limit for some recipients' domains.
+
+        A domain's limit only ever goes down, until it is forgotten.
+
+        :param recipients: The recipients which were over the limit.
+        :type recipients: iterable of strings
+        :param limit: The number of recipients which were accepted.
+        :type limit: integer
+        :param now: The current time, for testing.
+        :type now: float
+        """
+        if self._lifetime <= 0:
+            return
+        if now is None:
+            now = time.time()
+        domains = set(_domain(recipient) for recipient in recipients)
+        with shared_state(self._path) as state:
+            for domain, (old_limit, expiration) in list(state.items()):
+                if expiration <= now:
+                    del state[domain]
+            for domain in domains:
+                old_limit = state.get(domain, (limit, None))[0]
+                state[domain] = (min(limit, old_limit), now + self._lifetime)
+
+    def split(self, chunks):
+        """Split chunks which are over the limits of their domains.
+
+        :param chunks: The chunks of recipients.
+        :type chunks: iterable of sets of strings
+        :return: The chunks, each with no more recipients than the limit of
+            any of its domains.
+        :rtype: list of sets of strings
+        """
+        chunks = list(chunks)
+        limits = self.get(set().union(*chunks))
+        if len(limits) == 0:
+            return chunks
+        results = []
+        for chunk in chunks:
+            limit = min((limits[_domain(recipient)]
+                         for recipient in chunk
+                         if _domain(recipient) in limits),
+                        default=len(chunk))
+            if len(chunk) <= limit:
+                results.append(chunk)
+                continue
+            recipients = sorted(chunk)
+            for i in range(0, len(recipients), limit):
+                results.append(set(recipients[i:i + limit]))
+        return results
+
+
+
+def get_recipient_limits():
+    """Return the recipient limits shared by the runners.
+
+    :return: The limits.
+    :rtype: `RecipientLimits`
+    """
+    lifetime = as_timedelta(config.mta.recipient_limit_lifetime)
+    return RecipientLimits(
+        os.path.join(config.DATA_DIR, 'recipient-limits.json'),
+        lifetime.total_seconds())
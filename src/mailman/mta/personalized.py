@@ -27,6 +27,7 @@ from email.header import Header
 from email.utils import formataddr
 from mailman.interfaces.mailinglist import Personalization
 from mailman.interfaces.usermanager import IUserManager
+from mailman.mta.splicing import header_line
 from mailman.mta.verp import VERPDelivery
 from zope.component import getUtility
 
@@ -50,17 +51,31 @@ class PersonalizedMixin:
         # Personalize the To header if the list requests it.
         if mlist.personalize != Personalization.full:
             return
+        msg.replace_header('To', self._personal_to(msgdata))
+
+    def personalize_to_template(self, mlist, msg, msgdata, template):
+        """Mark where `personalize_to()` puts the recipient."""
+        if mlist.personalize != Personalization.full:
+            return
+        msg.replace_header('To', template.add(
+            lambda mlist, msgdata: header_line(
+                'To', self._personal_to(msgdata)),
+            line=True))
+
+    def _personal_to(self, msgdata):
         recipient = msgdata['recipient']
-        user_manager = getUtility(IUserManager)
-        user = user_manager.get_user(recipient)
+        member = msgdata.get('member')
+        # A member's user is usually loaded already.
+        user = (getUtility(IUserManager).get_user(recipient)
+                if member is None
+                else member.user)
         if user is None:
-            msg.replace_header('To', recipient)
-        else:
-            # Convert the unicode name to an email-safe representation.
-            # Create a Header instance for the name so that it's properly
-            # encoded for email transport.
-            name = Header(user.display_name).encode()
-            msg.replace_header('To', formataddr((name, recipient)))
+            return recipient
+        # Convert the unicode name to an email-safe representation.  Create a
+        # Header instance for the name so that it's properly encoded for
+        # email transport.
+        name = Header(user.display_name).encode()
+        return formataddr((name, recipient))
 
 
 
@@ -0,0 +1,210 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Spreading deliveries over several SMTP servers.
+
+Each new connection goes to one of the smarthosts, picked either by smooth
+weighted round-robin, or as the one with the fewest open connections for its
+weight.  A smarthost which fails too many times in a row is ejected, and
+connections go to the others until it is probed again.
+"""
+
+__all__ = [
+    'SmartHost',
+    'SmartHosts',
+    'get_smart_hosts',
+    ]
+
+
+import time
+import logging
+import threading
+
+from lazr.config import as_timedelta
+from mailman.config import config
+
+
+log = logging.getLogger('mailman.smtp')
+
+# The smarthosts of each configuration, so that their health is shared by all
+# the connections in a process.
+_smart_hosts = {}
+
+
+
+class SmartHost:
+    """An SMTP server, and its health."""
+
+    def __init__(self, host, port, weight=1):
+        self.host = host
+        self.port = port
+        self.weight = weight
+        # The number of connections open to the server.
+        self.connections = 0
+        # The number of failures since the last success.
+        self.failures = 0
+        # When the ejected server can be probed again, or None.
+        self.ejected_until = None
+        # The server's share of the round-robin so far.
+        self.current_weight = 0
+
+    def __repr__(self):
+        return '<SmartHost {0}:{1}>'.format(self.host, self.port)
+
+
+
+class SmartHosts:
+    """A group of smarthosts, with their health."""
+
+    def __init__(self, hosts, selection='round-robin', max_failures=3,
+                 reprobe_interval=30):
+        """Create a group of smarthosts.
+
+        :param hosts: The smarthosts.
+        :type hosts: sequence of `SmartHost`
+        :param selection: How the smarthost for a new connection is picked,
+            either 'round-robin' or 'least-connections'.
+        :type selection: string
+        :param max_failures: The number of failures in a row after which a
+            smarthost is ejected.
+        :type max_failures: integer
+        :param reprobe_interval: The number of seconds before an ejected
+            smarthost is tried again.
+        :type reprobe_interval: float
+        """
+        assert len(hosts) > 0, 'No smarthosts'
+        assert selection in ('round-robin', 'least-connections'), (
+            'Bad smarthost selection: {0}'.format(selection))
+        self.hosts = list(hosts)
+        self._selection = selection
+        self._max_failures = max_failures
+        self._reprobe_interval = reprobe_interval
+        self._lock = threading.Lock()
+
+    def select(self, exclude=(), now=None):
+        """Pick the smarthost for a new connection.
+
+        Ejected smarthosts are skipped until it is time to probe them again,
+        and then one connection is let through to each of them.  When every
+        smarthost is ejected, they are all tried anyway.
+
+        :param exclude: Smarthosts not to pick, such as the ones which have
+            already failed for this delivery.
+        :type exclude: collection of `SmartHost`
+        :param now: The current time, for testing.
+        :type now: float
+        :return: The smarthost, or None if they are all excluded.
+        :rtype: `SmartHost`
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            candidates = [host for host in self.hosts if host not in exclude]
+            healthy = [host for host in candidates
+                       if host.ejected_until is None
+                       or host.ejected_until <= now]
+            if len(healthy) > 0:
+                candidates = healthy
+            if len(candidates) == 0:
+                return None
+            if self._selection == 'least-connections':
+                selected = min(
+                    candidates,
+                    key=lambda host: host.connections / host.weight)
+            else:
+                # Smooth weighted round-robin, as in nginx.
+                total = 0
+                for host in candidates:
+                    host.current_weight += host.weight
+                    total += host.weight
+                selected = max(
+                    candidates, key=lambda host: host.current_weight)
+                selected.current_weight -= total
+            if (selected.ejected_until is not None
+                    and selected.ejected_until <= now):
+                # Let only this connection probe the smarthost.
+                log.info('Probing smarthost %s:%s',
+                         selected.host, selected.port)
+                selected.ejected_until = now + self._reprobe_interval
+            return selected
+
+    def connected(self, host):
+        """Record a successful connection to a smarthost."""
+        with self._lock:
+            host.connections += 1
+            host.failures = 0
+            if host.ejected_until is not None:
+                log.info('Smarthost %s:%s is back', host.host, host.port)
+                host.ejected_until = None
+
+    def disconnected(self, host):
+        """Record that a connection to a smarthost was closed."""
+        with self._lock:
+            host.connections -= 1
+
+    def failed(self, host, now=None):
+        """Record a failure to connect or talk to a smarthost."""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            host.failures += 1
+            if host.failures >= self._max_failures:
+                if host.ejected_until is None:
+                    log.error('Ejecting smarthost %s:%s after %s failures',
+                              host.host, host.port, host.failures)
+                host.ejected_until = now + self._reprobe_interval
+
+
+
+def get_smart_hosts():
+    """Return the configured smarthosts.
+
+    The health of the smarthosts is kept for as long as the configuration
+    doesn't change.
+
+    :return: The smarthosts, or None if only `[mta]smtp_host` is used.
+    :rtype: `SmartHosts`
+    """
+    key = (config.mta.smtp_hosts, config.mta.smtp_port,
+           config.mta.smtp_host_selection, config.mta.smtp_host_max_failures,
+           config.mta.smtp_host_reprobe_interval)
+    if key in _smart_hosts:
+        return _smart_hosts[key]
+    hosts = []
+    for line in config.mta.smtp_hosts.splitlines():
+        parts = line.split()
+        if len(parts) == 0:
+            continue
+        host, colon, port = parts[0].rpartition(':')
+        if len(colon) == 0:
+            host, port = port, config.mta.smtp_port
+        try:
+            port = int(port)
+            weight = (int(parts[1]) if len(parts) > 1 else 1)
+        except ValueError:
+            weight = 0
+        if len(parts) > 2 or weight <= 0:
+            log.error('Configuration error: [mta]smtp_hosts '
+                      'contains bogus line: {0}'.format(line))
+            continue
+        hosts.append(SmartHost(host, port, weight))
+    smart_hosts = (None if len(hosts) == 0 else SmartHosts(
+        hosts, config.mta.smtp_host_selection,
+        int(config.mta.smtp_host_max_failures),
+        as_timedelta(config.mta.smtp_host_reprobe_interval).total_seconds()))
+    _smart_hosts[key] = smart_hosts
+    return smart_hosts
@@ -0,0 +1,206 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Rendering individual messages by splicing a shared template.
+
+Individual delivery used to copy the whole message and flatten the copy again
+for every recipient, even though only a few headers and the decorations
+differ between recipients.  Instead, the recipient specific changes can be
+made once, to a single copy, with marker strings standing in for the text
+which differs.  That copy is flattened into a template, and each recipient's
+message text is produced by splicing their own text in at the markers.
+
+Splicing is only exact when the markers come through flattening verbatim, so
+a template is refused if any of them got encoded, and a recipient gets the
+message the old way if their text can't be spliced in safely.
+"""
+
+__all__ = [
+    'MessageTemplate',
+    'RenderedMessage',
+    'header_line',
+    ]
+
+
+import re
+import email
+
+from mailman.email.message import Message
+from uuid import uuid4
+
+
+# The attributes making up the state of a parsed message.
+_STATE = frozenset(Message().__dict__)
+# Transfer encodings which leave text spliced into a part as it is.
+IDENTITY_ENCODINGS = ('7bit', '8bit', 'binary')
+
+
+
+def header_line(name, value):
+    """Return a header exactly as it would appear in a flattened message.
+
+    :param name: The header name.
+    :type name: string
+    :param value: The header value.
+    :type value: string or `email.header.Header`
+    :return: The header line or lines, including the final newline.
+    :rtype: string
+    """
+    msg = Message()
+    msg[name] = value
+    return msg.as_string()[:-1]
+
+
+
+class RenderedMessage(Message):
+    """A recipient's message, spliced from a template.
+
+    The message text is all that's needed to deliver it, so the message is
+    only parsed if something looks inside it.  The Message-ID is the same for
+    every recipient, so it's available without parsing.
+    """
+
+    def __init__(self, text, message_id):
+        # Deliberately don't initialize the message state.
+        self._rendered = text
+        self._message_id = message_id
+
+    def __getattr__(self, name):
+        if name not in _STATE:
+            raise AttributeError(name)
+        parsed = email.message_from_string(self._rendered, Message)
+        self.__dict__.update(parsed.__dict__)
+        return getattr(self, name)
+
+    def get(self, name, failobj=None):
+        if '_headers' not in self.__dict__ and name.lower() == 'message-id':
+            return (failobj if self._message_id is None
+                    else self._message_id)
+        return super(RenderedMessage, self).get(name, failobj)
+
+    def as_string(self, unixfrom=False, maxheaderlen=0, policy=None):
+        if ('_headers' not in self.__dict__ and not unixfrom and
+                maxheaderlen == 0 and policy is None):
+            return self._rendered
+        return super(RenderedMessage, self).as_string(
+            unixfrom, maxheaderlen, policy)
+
+
+
+class MessageTemplate:
+    """A flattened message with splice points for recipient specific text."""
+
+    def __init__(self):
+        self._token = uuid4().hex[:12]
+        self._slots = []
+        self._parts = None
+        self._used = None
+        # The changes which marking the template made to the message
+        # metadata, which apply to every recipient.
+        self.changes = {}
+
+    def add(self, function, line=False):
+        """Add a splice point.
+
+        :param function: The function returning a recipient's text for this
+            splice point.  It is called with the mailing list and the
+            recipient's message metadata, and it returns None if the text
+            can't be spliced into the template.  Markers which don't end up
+            in the message are ignored.
+        :type function: callable
+        :param line: Whether the splice point is a whole header line, which
+            may be replaced by any number of lines, including none.  The
+            function must then return the complete lines.
+        :type line: bool
+        :return: The marker to put in the message where the text goes.
+        :rtype: string
+        """
+        marker = 'mailman-splice-{0}-{1}-{2}'.format(
+            self._token, ('line' if line else 'text'), len(self._slots))
+        self._slots.append((function, line))
+        return marker
+
+    def compile(self, msg):
+        """Flatten the marked message into the template.
+
+        :param msg: The message, with the markers in place.
+        :type msg: `Message`
+        :return: Whether the message can be used as a template.
+        :rtype: bool
+        """
+        # Markers in encoded parts can't be spliced.  Not all of them would be
+        # found in the flattened message, and quoted-printable would leave the
+        # markers alone, but not necessarily the recipients' text.
+        prefix = 'mailman-splice-{0}-'.format(self._token)
+        for part in msg.walk():
+            if part.is_multipart():
+                continue
+            encoding = part.get('content-transfer-encoding', '7bit').lower()
+            payload = part.get_payload(decode=True)
+            if (encoding not in IDENTITY_ENCODINGS and payload is not None
+                    and prefix.encode('ascii') in payload):
+                return False
+        text = msg.as_string()
+        # Header line markers stand for the whole header, including any
+        # continuation lines.
+        expression = re.compile(
+            r'^[^\n]*{0}line-(\d+)[^\n]*\n(?:[ \t][^\n]*\n)*'
+            r'|{0}text-(\d+)'.format(re.escape(prefix)), re.MULTILINE)
+        parts = []
+        used = set()
+        start = 0
+        for match in expression.finditer(text):
+            line_index, text_index = match.groups()
+            index = int(line_index if line_index is not None
+                        else text_index)
+            parts.append(text[start:match.start()])
+            parts.append(index)
+            used.add(index)
+            start = match.end()
+        parts.append(text[start:])
+        self._parts = parts
+        self._used = used
+        return True
+
+    def render(self, mlist, msgdata):
+        """Render a recipient's message text.
+
+        :param mlist: The mailing list being delivered to.
+        :type mlist: `IMailingList`
+        :param msgdata: The recipient's message metadata.
+        :type msgdata: dictionary
+        :return: The message text, or None if the recipient's text can't be
+            spliced into the template.
+        :rtype: string
+        """
+        values = {}
+        for index in self._used:
+            function, line = self._slots[index]
+            value = function(mlist, msgdata)
+            if value is None:
+                return None
+            # Spliced text must not need any encoding or reformatting, and
+            # since decorations have trailing spaces stripped, it mustn't
+            # leave any behind either.
+            if not line and (
+                    value == '' or value.endswith(' ') or
+                    '\n' in value or '\r' in value or
+                    any(ord(character) > 127 for character in value)):
+                return None
+            values[index] = value
+        return ''.join(part if isinstance(part, str) else values[part]
+                       for part in self._parts)
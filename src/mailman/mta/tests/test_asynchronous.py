@@ -0,0 +1,287 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test asynchronous individual delivery."""
+
+__all__ = [
+    'TestAsyncConnection',
+    'TestAsyncDeliver',
+    ]
+
+
+import socket
+import asyncio
+import smtplib
+import unittest
+import threading
+
+from mailman.app.lifecycle import create_list
+from mailman.mta.asynchronous import AsyncConnection, _prepare
+from mailman.mta.deliver import AsyncDeliver
+from mailman.testing.helpers import (
+    configuration, specialized_message_from_string as mfs, subscribe)
+from mailman.testing.layers import ConfigLayer
+from unittest.mock import patch
+
+
+
+class FakeSMTPServer:
+    """A minimal SMTP server, run in its own thread.
+
+    Recipients starting with 'bad' are refused, and the messages received are
+    recorded as 3-tuples of the sender, the recipients and the message bytes.
+    """
+
+    def __init__(self, pipelining):
+        self.pipelining = pipelining
+        self.messages = []
+        self.connections = 0
+        self._loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+
+    def start(self):
+        self._thread.start()
+        self._ready.wait()
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def _run(self):
+        server = self._loop.run_until_complete(asyncio.start_server(
+            self._handle, '127.0.0.1', 0, loop=self._loop))
+        self.port = server.sockets[0].getsockname()[1]
+        self._ready.set()
+        self._loop.run_forever()
+        server.close()
+        self._loop.run_until_complete(server.wait_closed())
+        self._loop.close()
+
+    @asyncio.coroutine
+    def _handle(self, reader, writer):
+        self.connections += 1
+        def reply(text):
+            writer.write(text.encode('ascii') + b'\r\n')
+        reply('220 localhost')
+        sender = None
+        recipients = []
+        while True:
+            line = yield from reader.readline()
+            if len(line) == 0:
+                break
+            command = line.decode('ascii').strip()
+            verb = command[:4].upper()
+            if verb == 'EHLO':
+                reply('250-localhost')
+                reply('250 PIPELINING' if self.pipelining else '250 HELP')
+            elif verb == 'MAIL':
+                sender = command[11:-1]
+                recipients = []
+                reply('250 OK')
+            elif verb == 'RCPT':
+                recipient = command[9:-1]
+                if recipient.startswith('bad'):
+                    reply('550 No such user')
+                else:
+                    recipients.append(recipient)
+                    reply('250 OK')
+            elif verb == 'DATA':
+                if len(recipients) == 0:
+                    reply('554 No valid recipients')
+                    continue
+                reply('354 End data with <CR><LF>.<CR><LF>')
+                lines = []
+                while True:
+                    line = yield from reader.readline()
+                    if line == b'.\r\n':
+                        break
+                    lines.append(line[1:] if line.startswith(b'.') else line)
+                self.messages.append((sender, recipients, b''.join(lines)))
+                reply('250 OK')
+            elif verb == 'RSET':
+                reply('250 OK')
+            elif verb == 'QUIT':
+                reply('221 Bye')
+                break
+            else:
+                reply('500 Unknown command')
+        writer.close()
+
+
+
+class TestAsyncConnection(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._server = FakeSMTPServer(pipelining=True)
+        self._server.start()
+        self.addCleanup(self._server.stop)
+        self._data = _prepare("""\
+From: anne@example.com
+To: bart@example.com
+Subject: aardvarks
+
+.hidden
+""")
+
+    def _sendmail(self, recipients, sessions_per_connection=0, count=1):
+        loop = asyncio.new_event_loop()
+        connection = AsyncConnection(
+            '127.0.0.1', self._server.port, sessions_per_connection,
+            loop=loop)
+        try:
+            for i in range(count):
+                refused = loop.run_until_complete(connection.sendmail(
+                    'anne@example.com', recipients, self._data))
+            return connection, refused
+        finally:
+            loop.run_until_complete(connection.quit())
+            loop.close()
+
+    def test_pipelining(self):
+        connection, refused = self._sendmail(
+            ['bart@example.com', 'bad@example.com', 'cris@example.com'])
+        self.assertTrue(connection.pipelining)
+        self.assertEqual(refused,
+                         {'bad@example.com': (550, b'No such user')})
+        self.assertEqual(len(self._server.messages), 1)
+        sender, recipients, message = self._server.messages[0]
+        self.assertEqual(sender, 'anne@example.com')
+        self.assertEqual(recipients, ['bart@example.com', 'cris@example.com'])
+        # Dot stuffing is undone by the server.
+        self.assertTrue(message.endswith(b'\r\n.hidden\r\n'))
+
+    def test_without_pipelining(self):
+        self._server.pipelining = False
+        connection, refused = self._sendmail(
+            ['bart@example.com', 'bad@example.com'])
+        self.assertFalse(connection.pipelining)
+        self.assertEqual(refused,
+                         {'bad@example.com': (550, b'No such user')})
+        self.assertEqual(len(self._server.messages), 1)
+
+    def test_all_recipients_refused(self):
+        for pipelining in (True, False):
+            self._server.pipelining = pipelining
+            with self.assertRaises(smtplib.SMTPRecipientsRefused) as cm:
+                self._sendmail(['bad@example.com', 'bad2@example.com'])
+            self.assertEqual(sorted(cm.exception.recipients),
+                             ['bad2@example.com', 'bad@example.com'])
+        self.assertEqual(self._server.messages, [])
+
+    def test_sessions_per_connection(self):
+        self._sendmail(['bart@example.com'], sessions_per_connection=2,
+                       count=5)
+        self.assertEqual(len(self._server.messages), 5)
+        self.assertEqual(self._server.connections, 3)
+
+
+
+class TestAsyncDeliver(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._server = FakeSMTPServer(pipelining=True)
+        self._server.start()
+        self.addCleanup(self._server.stop)
+        self._mlist = create_list('test@example.com')
+        self._recipients = []
+        for name in ('Anne', 'Bart', 'Cris', 'Dave', 'Elle'):
+            member = subscribe(self._mlist, name)
+            self._recipients.append(member.address.email)
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Subject: test
+Message-ID: <first>
+
+""")
+
+    def _deliver(self, msgdata, port=None):
+        with configuration('mta', smtp_host='127.0.0.1',
+                           smtp_port=(self._server.port if port is None
+                                      else port),
+                           max_async_sessions=3):
+            agent = AsyncDeliver()
+            return agent.deliver(self._mlist, self._msg, msgdata)
+
+    def test_verp_delivery(self):
+        refused = self._deliver(dict(recipients=self._recipients, verp=True))
+        self.assertEqual(refused, {})
+        senders = {}
+        for sender, recipients, message in self._server.messages:
+            self.assertEqual(len(recipients), 1)
+            senders[recipients[0]] = sender
+        self.assertEqual(sorted(senders), sorted(self._recipients))
+        self.assertEqual(senders['aperson@example.com'],
+                         'test-bounces+aperson=example.com@example.com')
+        # No more sessions than allowed were used.
+        self.assertLessEqual(self._server.connections, 3)
+
+    def test_refused_recipients(self):
+        recipients = self._recipients + ['bad@example.com']
+        refused = self._deliver(dict(recipients=recipients, verp=True))
+        self.assertEqual(refused,
+                         {'bad@example.com': (550, b'No such user')})
+        self.assertEqual(len(self._server.messages), 5)
+
+    def test_unreachable_server(self):
+        # Connection errors are temporary failures.
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        refused = self._deliver(dict(recipients=self._recipients), port)
+        self.assertEqual(sorted(refused), sorted(self._recipients))
+        for code, message in refused.values():
+            self.assertEqual(code, 444)
+
+    def test_reserve_error(self):
+        # Errors while reserving the throttled rates are temporary failures.
+        with patch.object(AsyncDeliver, '_reserve',
+                          side_effect=OSError('throttle unavailable')):
+            refused = self._deliver(dict(recipients=self._recipients))
+        self.assertEqual(sorted(refused), sorted(self._recipients))
+        for code, message in refused.values():
+            self.assertEqual(code, 444)
+
+    def test_unexpected_error(self):
+        # Unexpected errors sending to a recipient are temporary failures,
+        # and the workers carry on with the other recipients.
+        send_async = AsyncDeliver._send_async
+        @asyncio.coroutine
+        def send_or_fail(delivery, loop, connection, sender, recipients,
+                         *args):
+            if recipients == ['bperson@example.com']:
+                raise ValueError('line too long')
+            return (yield from send_async(
+                delivery, loop, connection, sender, recipients, *args))
+        with patch.object(AsyncDeliver, '_send_async', send_or_fail):
+            refused = self._deliver(dict(recipients=self._recipients))
+        self.assertEqual(refused,
+                         {'bperson@example.com': (444, 'line too long')})
+        self.assertEqual(len(self._server.messages), 4)
+
+    def test_worker_dies(self):
+        # When a worker dies, the delivery doesn't wait forever for it to
+        # take more recipients, and the error is passed on.
+        @asyncio.coroutine
+        def die(delivery, loop, connection, queue, refused):
+            raise RuntimeError('worker died')
+        with patch.object(AsyncDeliver, '_work', die):
+            with self.assertRaisesRegex(RuntimeError, 'worker died'):
+                self._deliver(dict(recipients=self._recipients))
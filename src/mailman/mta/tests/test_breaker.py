@@ -0,0 +1,156 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the circuit breaker."""
+
+__all__ = [
+    'TestCircuitBreaker',
+    'TestPausedRunner',
+    ]
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mailman.app.lifecycle import create_list
+from mailman.config import config
+from mailman.mta.breaker import (
+    BreakerState, CircuitBreaker, get_circuit_breaker)
+from mailman.mta.connection import Connection
+from mailman.runners.outgoing import OutgoingRunner
+from mailman.testing.helpers import (
+    configuration, get_closed_port, get_queue_messages, make_testable_runner,
+    specialized_message_from_string as mfs)
+from mailman.testing.layers import ConfigLayer
+
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        self._breaker = CircuitBreaker(
+            os.path.join(tempdir, 'breaker.json'), 3, 10, 35)
+        self._error = ConnectionRefusedError('Connection refused')
+
+    def _state(self, now):
+        return self._breaker.status(now=now)['state']
+
+    def test_closed(self):
+        self.assertEqual(self._breaker.status(), dict(
+            state=BreakerState.closed, failures=0, error=None,
+            probe_at=None))
+        self.assertTrue(self._breaker.allow())
+        self._breaker.succeeded()
+
+    def test_trip(self):
+        for i in range(2):
+            self._breaker.failed(self._error, now=100)
+        self.assertEqual(self._state(100), BreakerState.closed)
+        self.assertTrue(self._breaker.allow(now=100))
+        self._breaker.failed(self._error, now=101)
+        self.assertEqual(self._breaker.status(now=101), dict(
+            state=BreakerState.open, failures=3, error='Connection refused',
+            probe_at=111))
+        self.assertFalse(self._breaker.allow(now=110))
+        # More failures from connections made before the breaker opened
+        # don't change when to probe.
+        self._breaker.failed(self._error, now=105)
+        self.assertEqual(self._breaker.status(now=105)['probe_at'], 111)
+
+    def test_success_resets(self):
+        for i in range(2):
+            self._breaker.failed(self._error, now=100)
+        self._breaker.succeeded()
+        self._breaker.failed(self._error, now=100)
+        self.assertEqual(self._state(100), BreakerState.closed)
+        self.assertEqual(self._breaker.status()['failures'], 1)
+
+    def test_probes(self):
+        for i in range(3):
+            self._breaker.failed(self._error, now=100)
+        self.assertEqual(self._state(110), BreakerState.half_open)
+        # Only one caller gets to probe.
+        self.assertTrue(self._breaker.allow(now=110))
+        self.assertFalse(self._breaker.allow(now=110))
+        # The probe failed, so the time until the next one doubles.
+        self._breaker.failed(self._error, now=112)
+        self.assertEqual(self._breaker.status()['probe_at'], 132)
+        self.assertTrue(self._breaker.allow(now=132))
+        self._breaker.failed(self._error, now=132)
+        self.assertEqual(self._breaker.status()['probe_at'], 167)
+        # The probe succeeded.
+        self.assertTrue(self._breaker.allow(now=167))
+        self._breaker.succeeded()
+        self.assertEqual(self._state(167), BreakerState.closed)
+        self.assertTrue(self._breaker.allow(now=167))
+
+    @configuration('mta', breaker_threshold=0)
+    def test_disabled(self):
+        self.assertIsNone(get_circuit_breaker())
+
+    def test_connection(self):
+        # Connections tell the breaker whether they could connect.
+        breaker = get_circuit_breaker()
+        connection = Connection('127.0.0.1', get_closed_port(), 0,
+                                breaker=breaker)
+        for i in range(5):
+            with self.assertRaises(ConnectionRefusedError):
+                connection.sendmail(
+                    'anne@example.com', ['bart@example.com'], 'Subject: x')
+        self.assertEqual(breaker.status()['state'], BreakerState.open)
+
+
+
+class TestPausedRunner(unittest.TestCase):
+    """Test the out runner with the circuit breaker open."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._mlist = create_list('test@example.com')
+        self._outq = config.switchboards['out']
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-Id: <ant>
+
+""")
+        self._breaker = get_circuit_breaker()
+        error = ConnectionRefusedError('Connection refused')
+        for i in range(5):
+            self._breaker.failed(error)
+
+    def test_queue_untouched(self):
+        self._outq.enqueue(self._msg, {}, listid='test.example.com')
+        files = self._outq.files
+        runner = make_testable_runner(
+            OutgoingRunner, 'out', predicate=lambda runner: True)
+        runner.run()
+        # The message is still there, in the same file.
+        self.assertEqual(self._outq.files, files)
+
+    def test_resume(self):
+        self._breaker.succeeded()
+        self._outq.enqueue(self._msg, {}, listid='test.example.com',
+                           recipients=[])
+        make_testable_runner(OutgoingRunner, 'out').run()
+        self.assertEqual(len(get_queue_messages('out')), 0)
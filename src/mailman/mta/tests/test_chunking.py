@@ -0,0 +1,141 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the recipient chunking strategies."""
+
+__all__ = [
+    'TestDomainChunker',
+    'TestMailExchangerChunker',
+    ]
+
+
+import unittest
+
+from mailman.interfaces.mta import IMailExchangerResolver, IRecipientChunker
+from mailman.mta.bulk import BulkDelivery
+from mailman.mta.chunking import (
+    DNSResolver, DomainChunker, MailExchangerChunker, StaticResolver,
+    TopLevelDomainChunker)
+from mailman.testing.helpers import configuration, make_recipients
+from mailman.testing.layers import ConfigLayer
+from zope.interface.verify import verifyObject
+
+
+def _domains(chunks):
+    # The sorted domains in each chunk, with their recipient counts.
+    results = []
+    for chunk in chunks:
+        counts = {}
+        for address in chunk:
+            domain = address.rpartition('@')[2]
+            counts[domain] = counts.get(domain, 0) + 1
+        results.append(sorted(counts.items()))
+    return results
+
+
+
+class TestDomainChunker(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._recipients = (make_recipients(7, 'example.com') +
+                            make_recipients(2, 'example.org') +
+                            make_recipients(1, 'example.net') +
+                            make_recipients(1, 'example.edu'))
+
+    def test_interfaces(self):
+        for chunker in (TopLevelDomainChunker(4), DomainChunker(4),
+                        MailExchangerChunker(4)):
+            verifyObject(IRecipientChunker, chunker)
+        for resolver in (StaticResolver(), DNSResolver()):
+            verifyObject(IMailExchangerResolver, resolver)
+
+    def test_domains(self):
+        # The biggest domain gets its own chunks, and the rest share.
+        chunks = list(DomainChunker(4).chunkify(self._recipients))
+        self.assertEqual(_domains(chunks), [
+            [('example.com', 4)],
+            [('example.com', 3)],
+            [('example.edu', 1), ('example.net', 1), ('example.org', 2)],
+            ])
+
+    def test_domain_limit(self):
+        # No chunk has more than three recipients in the same domain.
+        chunks = list(DomainChunker(4, 3).chunkify(self._recipients))
+        self.assertEqual(_domains(chunks), [
+            [('example.com', 3)],
+            [('example.com', 3)],
+            [('example.com', 1), ('example.edu', 1), ('example.org', 2)],
+            [('example.net', 1)],
+            ])
+
+    def test_no_limit(self):
+        # With no limits, all the recipients are in one chunk.
+        chunks = list(DomainChunker(0, 0).chunkify(self._recipients))
+        self.assertEqual(len(chunks), 1)
+        self.assertEqual(sorted(chunks[0]), sorted(self._recipients))
+
+    def test_domains_are_case_insensitive(self):
+        chunks = list(DomainChunker(4).chunkify(
+            ['anne@example.com', 'bart@EXAMPLE.com']))
+        self.assertEqual(chunks, [{'anne@example.com', 'bart@EXAMPLE.com'}])
+
+    @configuration('mta', chunker='mailman.mta.chunking.DomainChunker',
+                   max_domain_recipients=2)
+    def test_configured_chunker(self):
+        chunks = list(BulkDelivery(4).chunkify(self._recipients))
+        self.assertEqual(_domains(chunks), [
+            [('example.com', 2)],
+            [('example.com', 2)],
+            [('example.com', 2)],
+            [('example.org', 2)],
+            [('example.com', 1), ('example.edu', 1), ('example.net', 1)],
+            ])
+
+
+
+class TestMailExchangerChunker(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._resolver = StaticResolver({
+            'example.com': ['mx1.example.net', 'mx2.example.net'],
+            'example.org': ['mx1.example.net'],
+            'example.edu': ['mx.example.edu'],
+            })
+
+    def test_shared_exchangers(self):
+        # Domains sharing a mail exchanger are grouped together, and domains
+        # without one are grouped by themselves.
+        recipients = (make_recipients(2, 'example.com') +
+                      make_recipients(2, 'example.org') +
+                      make_recipients(3, 'example.edu') +
+                      make_recipients(1, 'example.net'))
+        chunker = MailExchangerChunker(4, resolver=self._resolver)
+        chunks = list(chunker.chunkify(recipients))
+        self.assertEqual(_domains(chunks), [
+            [('example.com', 2), ('example.org', 2)],
+            [('example.edu', 3), ('example.net', 1)],
+            ])
+
+    def test_exchanger_limit(self):
+        # The limit on recipients per domain applies to the mail exchanger.
+        recipients = (make_recipients(3, 'example.com') +
+                      make_recipients(3, 'example.org'))
+        chunker = MailExchangerChunker(10, 4, resolver=self._resolver)
+        chunks = list(chunker.chunkify(recipients))
+        self.assertEqual([len(chunk) for chunk in chunks], [4, 2])
@@ -19,13 +19,14 @@
 
 __all__ = [
     'TestConnection',
+    'TestConnectionPool',
     ]
 
 
 import unittest
 
 from mailman.config import config
-from mailman.mta.connection import Connection
+from mailman.mta.connection import Connection, ConnectionPool
 from mailman.testing.layers import SMTPLayer
 from smtplib import SMTPAuthenticationError
 
@@ -49,3 +50,38 @@ Subject: aardvarks
 """)
         self.assertEqual(cm.exception.smtp_code, 571)
         self.assertEqual(cm.exception.smtp_error, b'Bad authentication')
+
+
+
+class TestConnectionPool(unittest.TestCase):
+    layer = SMTPLayer
+
+    def _send(self, connection, recipient):
+        return connection.sendmail('anne@example.com', [recipient], """\
+From: anne@example.com
+To: {0}
+Subject: aardvarks
+
+""".format(recipient))
+
+    def test_parallel_delivery(self):
+        pool = ConnectionPool(
+            3, config.mta.smtp_host, int(config.mta.smtp_port), 0)
+        recipients = ['person{0}@example.com'.format(i) for i in range(9)]
+        self.assertEqual(pool.map(self._send, recipients), [{}] * 9)
+        pool.quit()
+        # Every message got through, over no more than three connections.
+        messages = list(SMTPLayer.smtpd.messages)
+        self.assertEqual(sorted(message['to'] for message in messages),
+                         recipients)
+        self.assertLessEqual(SMTPLayer.smtpd.get_connection_count(), 3)
+
+    def test_sessions_per_connection(self):
+        # Each connection in the pool is limited to its own number of
+        # sessions.
+        pool = ConnectionPool(
+            1, config.mta.smtp_host, int(config.mta.smtp_port), 2)
+        recipients = ['person{0}@example.com'.format(i) for i in range(4)]
+        pool.map(self._send, recipients)
+        pool.quit()
+        self.assertEqual(SMTPLayer.smtpd.get_connection_count(), 2)
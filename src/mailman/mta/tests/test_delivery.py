@@ -19,6 +19,7 @@
 
 __all__ = [
     'TestIndividualDelivery',
+    'TestParallelBulkDelivery',
     ]
 
 
@@ -30,10 +31,13 @@ import unittest
 from mailman.app.lifecycle import create_list
 from mailman.config import config
 from mailman.interfaces.mailinglist import Personalization
+from mailman.mta.bulk import BulkDelivery
 from mailman.mta.deliver import Deliver
+from mailman.mta.splicing import RenderedMessage
 from mailman.testing.helpers import (
-    specialized_message_from_string as mfs, subscribe)
-from mailman.testing.layers import ConfigLayer
+    configuration, specialized_message_from_string as mfs, subscribe)
+from mailman.testing.layers import ConfigLayer, SMTPLayer
+from sqlalchemy import event
 
 
 
@@ -51,6 +55,12 @@ class DeliverTester(Deliver):
         return []
 
 
+class CopyingDeliverTester(DeliverTester):
+    # Always copy the message for each recipient.
+    def _make_template(self, mlist, msg, msgdata):
+        return None
+
+
 
 class TestIndividualDelivery(unittest.TestCase):
     """Test personalized delivery details."""
@@ -132,3 +142,134 @@ name     : Anne Person
 options  : http://example.com/anne@example.org
 
 """)
+        self.assertIsInstance(_msg, RenderedMessage)
+
+    def _deliver(self, agent, msgdata):
+        # Return the messages and metadata each recipient got.
+        del _deliveries[:]
+        agent.deliver(self._mlist, self._msg, msgdata)
+        return {recipients[0]: (msg, msgdata)
+                for mlist, msg, msgdata, recipients in _deliveries}
+
+    def _assert_same_deliveries(self, msgdata):
+        # Splicing produces the same messages as copying them does.
+        spliced = self._deliver(DeliverTester(), msgdata.copy())
+        copied = self._deliver(CopyingDeliverTester(), msgdata.copy())
+        self.assertEqual(sorted(spliced), sorted(msgdata['recipients']))
+        self.assertEqual(sorted(copied), sorted(msgdata['recipients']))
+        for recipient in spliced:
+            spliced_msg, spliced_msgdata = spliced[recipient]
+            copied_msg, copied_msgdata = copied[recipient]
+            self.assertMultiLineEqual(spliced_msg.as_string(),
+                                      copied_msg.as_string())
+            self.assertEqual(spliced_msgdata, copied_msgdata)
+        return spliced
+
+    def test_spliced_deliveries(self):
+        self._mlist.personalize = Personalization.full
+        bart = subscribe(self._mlist, 'Bart')
+        recipients = ['anne@example.org', bart.address.email]
+        deliveries = self._assert_same_deliveries(dict(
+            recipients=recipients,
+            # Bart is flagged as already having a copy.
+            **{'add-dup-header': {bart.address.email}}))
+        for recipient in recipients:
+            msg, msgdata = deliveries[recipient]
+            self.assertIsInstance(msg, RenderedMessage)
+        msg, msgdata = deliveries[bart.address.email]
+        self.assertEqual(msg['to'], 'Bart Person <bperson@example.com>')
+        self.assertEqual(msg['x-mailman-copy'], 'yes')
+        self.assertIn('name     : Bart Person\n', msg.as_string())
+        msg, msgdata = deliveries['anne@example.org']
+        self.assertIsNone(msg['x-mailman-copy'])
+
+    def test_unspliceable_recipients(self):
+        # Non-ASCII names, and the footer variables of nonmembers, can't be
+        # spliced in, so those recipients get their own copy.
+        self._anne.user.display_name = 'Anne Pers\xf8n'
+        recipients = ['anne@example.org', 'cris@example.com']
+        deliveries = self._assert_same_deliveries(
+            dict(recipients=recipients))
+        for recipient in recipients:
+            msg, msgdata = deliveries[recipient]
+            self.assertNotIsInstance(msg, RenderedMessage)
+
+    def _count_queries(self, recipients):
+        # Start from the same database session state each time.
+        config.db.commit()
+        queries = []
+        def count(*args):
+            queries.append(args)
+        event.listen(config.db.engine, 'before_cursor_execute', count)
+        try:
+            DeliverTester().deliver(
+                self._mlist, self._msg, dict(recipients=recipients))
+        finally:
+            event.remove(config.db.engine, 'before_cursor_execute', count)
+        return len(queries)
+
+    def test_members_looked_up_at_once(self):
+        # The recipients' members, users and preferences are looked up
+        # together, so more recipients don't take more queries.
+        self._mlist.personalize = Personalization.full
+        recipients = ['anne@example.org']
+        count = self._count_queries(recipients)
+        for name in ('Bart', 'Cris', 'Dave'):
+            recipients.append(subscribe(self._mlist, name).address.email)
+        self.assertEqual(self._count_queries(recipients), count)
+
+    def test_callback_without_template(self):
+        # Callbacks without a template companion need their own copy.
+        agent = DeliverTester()
+        agent.callbacks.append(lambda mlist, msg, msgdata: None)
+        deliveries = self._deliver(
+            agent, dict(recipients=['anne@example.org']))
+        msg, msgdata = deliveries['anne@example.org']
+        self.assertNotIsInstance(msg, RenderedMessage)
+
+
+
+class TestParallelBulkDelivery(unittest.TestCase):
+    """Test delivering bulk chunks in parallel."""
+
+    layer = SMTPLayer
+
+    def setUp(self):
+        self._mlist = create_list('test@example.com')
+        self._msg = mfs("""\
+From: anne@example.org
+To: test@example.com
+Subject: test
+Message-ID: <first>
+
+""")
+        self._recipients = ['person{0}@example.{1}'.format(i, tld)
+                            for i in range(4)
+                            for tld in ('com', 'org', 'edu', 'xx')]
+
+    @configuration('mta', max_delivery_threads=3)
+    def test_parallel_chunks(self):
+        agent = BulkDelivery(2)
+        refused = agent.deliver(
+            self._mlist, self._msg, dict(recipients=self._recipients))
+        self.assertEqual(refused, {})
+        messages = list(SMTPLayer.smtpd.messages)
+        self.assertEqual(len(messages), 8)
+        delivered = []
+        for message in messages:
+            delivered.extend(message['x-rcptto'].split(', '))
+        self.assertEqual(sorted(delivered), sorted(self._recipients))
+        self.assertLessEqual(SMTPLayer.smtpd.get_connection_count(), 3)
+
+    @configuration('mta', max_delivery_threads=3)
+    def test_refusals_are_merged(self):
+        # The server refuses the first recipient of three of the sessions.
+        for i in range(3):
+            SMTPLayer.smtpd.err_queue.put(('rcpt', 500))
+        agent = BulkDelivery(2)
+        refused = agent.deliver(
+            self._mlist, self._msg, dict(recipients=self._recipients))
+        self.assertEqual(len(refused), 3)
+        for recipient, (code, message) in refused.items():
+            self.assertIn(recipient, self._recipients)
+            self.assertEqual(code, 500)
@@ -0,0 +1,181 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the learned recipient limits."""
+
+__all__ = [
+    'TestAdaptiveChunks',
+    'TestRecipientLimits',
+    ]
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mailman.config import config
+from mailman.mta.bulk import BulkDelivery
+from mailman.mta.limits import RecipientLimits
+from mailman.testing.helpers import (
+    configuration, make_recipients, specialized_message_from_string as mfs)
+from mailman.testing.layers import ConfigLayer
+
+
+
+class TestRecipientLimits(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        self._path = os.path.join(tempdir, 'limits.json')
+        self._limits = RecipientLimits(self._path, 100)
+
+    def test_no_limits(self):
+        self.assertEqual(self._limits.get(['anne@example.com']), {})
+
+    def test_learn(self):
+        self._limits.learn(['anne@example.com', 'bart@EXAMPLE.org'], 5,
+                           now=1000)
+        self.assertEqual(
+            self._limits.get(['cris@example.com', 'dave@example.net'],
+                             now=1000),
+            {'example.com': 5})
+        self.assertEqual(
+            self._limits.get(['elle@example.org'], now=1000),
+            {'example.org': 5})
+
+    def test_limits_only_go_down(self):
+        self._limits.learn(['anne@example.com'], 5, now=1000)
+        self._limits.learn(['anne@example.com'], 10, now=1000)
+        self._limits.learn(['anne@example.com'], 3, now=1000)
+        self.assertEqual(self._limits.get(['anne@example.com'], now=1000),
+                         {'example.com': 3})
+
+    def test_limits_expire(self):
+        self._limits.learn(['anne@example.com'], 5, now=1000)
+        self._limits.learn(['anne@example.org'], 5, now=1050)
+        self.assertEqual(
+            self._limits.get(['anne@example.com', 'anne@example.org'],
+                             now=1100),
+            {'example.org': 5})
+        # Expired limits go away when a new limit is learned.
+        self._limits.learn(['anne@example.com'], 10, now=1100)
+        self.assertEqual(self._limits.get(['anne@example.com'], now=1100),
+                         {'example.com': 10})
+
+    def test_not_remembered(self):
+        limits = RecipientLimits(self._path, 0)
+        limits.learn(['anne@example.com'], 5)
+        self.assertFalse(os.path.exists(self._path))
+        self.assertEqual(limits.get(['anne@example.com']), {})
+
+    def test_split(self):
+        self._limits.learn(['anne@example.com'], 2)
+        chunks = self._limits.split([
+            set(make_recipients(5, 'example.com')),
+            set(make_recipients(1, 'example.com') +
+                make_recipients(2, 'example.org')),
+            set(make_recipients(4, 'example.org')),
+            ])
+        self.assertEqual([sorted(chunk) for chunk in chunks], [
+            ['person0@example.com', 'person1@example.com'],
+            ['person2@example.com', 'person3@example.com'],
+            ['person4@example.com'],
+            ['person0@example.com', 'person0@example.org'],
+            ['person1@example.org'],
+            ['person0@example.org', 'person1@example.org',
+             'person2@example.org', 'person3@example.org'],
+            ])
+
+
+
+class TestAdaptiveChunks(unittest.TestCase):
+    """Test re-sending recipients which were over the server's limit."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._transactions = []
+        self._server_limit = 3
+        self._path = os.path.join(config.DATA_DIR, 'recipient-limits.json')
+        self.addCleanup(self._remove_state)
+        self._agent = BulkDelivery(10)
+        self._agent._connection = self
+
+    def _remove_state(self):
+        try:
+            os.remove(self._path)
+        except FileNotFoundError:
+            pass
+
+    def sendmail(self, sender, recipients, msgtext):
+        # Mimic a server which only accepts a few recipients per transaction.
+        self._transactions.append(sorted(recipients))
+        return dict((recipient, (452, b'4.5.3 Too many recipients'))
+                    for recipient in recipients[self._server_limit:])
+
+    def test_resend(self):
+        # The refused recipients are sent again, in smaller chunks.
+        recipients = make_recipients(10, 'example.com')
+        refused = self._agent._send_chunk(
+            self, 'test-bounces@example.com', recipients, 'Subject: test\n\n',
+            '<first>')
+        self.assertEqual(refused, {})
+        self.assertEqual([len(transaction)
+                          for transaction in self._transactions],
+                         [10, 3, 3, 1])
+
+    def test_learned_limit(self):
+        # Later messages to the same domain are sent in chunks which are no
+        # bigger than the learned limit.
+        recipients = set(make_recipients(10, 'example.com'))
+        msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <first>
+
+""")
+        msgdata = dict(recipients=recipients,
+                       sender='test-bounces@example.com')
+        self.assertEqual(self._agent.deliver(None, msg, msgdata), {})
+        del self._transactions[:]
+        self.assertEqual(self._agent.deliver(None, msg, msgdata), {})
+        self.assertEqual([len(transaction)
+                          for transaction in self._transactions],
+                         [3, 3, 3, 1])
+        self.assertEqual(sum(self._transactions, []), sorted(recipients))
+
+    def test_all_recipients_refused(self):
+        # When the server accepts none of the recipients, it isn't out of
+        # room for them, so they aren't sent again.
+        self._server_limit = 0
+        refused = self._agent._send_chunk(
+            self, 'test-bounces@example.com',
+            make_recipients(4, 'example.com'), 'Subject: test\n\n', '<first>')
+        self.assertEqual(len(refused), 4)
+        self.assertEqual(len(self._transactions), 1)
+        self.assertFalse(os.path.exists(self._path))
+
+    @configuration('mta', recipient_limit_lifetime='0s')
+    def test_limits_not_remembered(self):
+        agent = BulkDelivery(10)
+        agent._send_chunk(
+            self, 'test-bounces@example.com',
+            make_recipients(10, 'example.com'), 'Subject: test\n\n', '<first>')
+        self.assertFalse(os.path.exists(self._path))
@@ -0,0 +1,205 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test spreading deliveries over several smarthosts."""
+
+__all__ = [
+    'TestFailover',
+    'TestSmartHosts',
+    ]
+
+
+import asyncio
+import smtplib
+import unittest
+
+from mailman.mta.asynchronous import AsyncConnection, _prepare
+from mailman.mta.connection import Connection
+from mailman.mta.smarthosts import SmartHost, SmartHosts, get_smart_hosts
+from mailman.mta.tests.test_asynchronous import FakeSMTPServer
+from mailman.testing.helpers import configuration, get_closed_port
+from mailman.testing.layers import ConfigLayer
+from unittest.mock import patch
+
+
+MESSAGE = """\
+From: anne@example.com
+To: bart@example.com
+Subject: aardvarks
+
+"""
+
+
+
+class TestSmartHosts(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._hosts = [SmartHost('a.example.com', 25, 5),
+                       SmartHost('b.example.com', 25),
+                       SmartHost('c.example.com', 25)]
+
+    def _names(self, smart_hosts, count, **kws):
+        return ''.join(smart_hosts.select(**kws).host[0]
+                       for i in range(count))
+
+    def test_round_robin(self):
+        # The heaviest smarthost gets its connections spread out.
+        smart_hosts = SmartHosts(self._hosts)
+        self.assertEqual(self._names(smart_hosts, 14), 'aabacaaaabacaa')
+
+    def test_least_connections(self):
+        smart_hosts = SmartHosts(self._hosts, 'least-connections')
+        a, b, c = self._hosts
+        smart_hosts.connected(a)
+        smart_hosts.connected(b)
+        self.assertEqual(smart_hosts.select(), c)
+        smart_hosts.connected(c)
+        # Five connections to a count as one connection to the others.
+        for i in range(4):
+            self.assertEqual(smart_hosts.select(), a)
+            smart_hosts.connected(a)
+        self.assertEqual(smart_hosts.select(), a)
+        smart_hosts.connected(a)
+        self.assertEqual(smart_hosts.select(), b)
+        smart_hosts.disconnected(a)
+        self.assertEqual(smart_hosts.select(), a)
+
+    def test_exclude(self):
+        smart_hosts = SmartHosts(self._hosts)
+        a, b, c = self._hosts
+        self.assertEqual(smart_hosts.select(exclude={a, c}), b)
+        self.assertIsNone(smart_hosts.select(exclude={a, b, c}))
+
+    def test_ejection(self):
+        smart_hosts = SmartHosts(self._hosts, max_failures=2,
+                                 reprobe_interval=10)
+        a, b, c = self._hosts
+        smart_hosts.failed(a, now=100)
+        self.assertEqual(a.ejected_until, None)
+        smart_hosts.failed(a, now=100)
+        self.assertEqual(a.ejected_until, 110)
+        self.assertEqual(self._names(smart_hosts, 4, now=105), 'bcbc')
+        # Once it's time, the ejected smarthost gets a single probe.
+        self.assertEqual(self._names(smart_hosts, 4, now=110), 'abcb')
+        self.assertEqual(a.ejected_until, 120)
+        # The probe succeeded.
+        smart_hosts.connected(a)
+        self.assertEqual(a.ejected_until, None)
+        self.assertEqual(a.failures, 0)
+
+    def test_all_ejected(self):
+        # When every smarthost is ejected, they are tried anyway.
+        smart_hosts = SmartHosts(self._hosts[1:], max_failures=1)
+        b, c = self._hosts[1:]
+        smart_hosts.failed(b, now=100)
+        smart_hosts.failed(c, now=100)
+        self.assertEqual(self._names(smart_hosts, 4, now=105), 'bcbc')
+
+    def test_not_configured(self):
+        self.assertIsNone(get_smart_hosts())
+
+    @configuration('mta', smtp_port=2525,
+                   smtp_host_selection='least-connections',
+                   smtp_hosts="""
+    relay1.example.com 2
+    relay2.example.com:25
+    relay3.example.com bogus
+    relay4.example.com 0
+    """)
+    def test_configuration(self):
+        smart_hosts = get_smart_hosts()
+        self.assertEqual(
+            [(host.host, host.port, host.weight)
+             for host in smart_hosts.hosts],
+            [('relay1.example.com', 2525, 2), ('relay2.example.com', 25, 1)])
+        # The smarthosts' health is shared.
+        self.assertIs(get_smart_hosts(), smart_hosts)
+
+
+
+class TestFailover(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._servers = []
+        for i in range(2):
+            server = FakeSMTPServer(pipelining=True)
+            server.start()
+            self.addCleanup(server.stop)
+            self._servers.append(server)
+        self._smart_hosts = SmartHosts(
+            [SmartHost('127.0.0.1', get_closed_port())] +
+            [SmartHost('127.0.0.1', server.port)
+             for server in self._servers],
+            max_failures=1)
+
+    def test_unreachable_smarthost(self):
+        down, up, other = self._smart_hosts.hosts
+        connection = Connection(None, None, 0, smart_hosts=self._smart_hosts)
+        self.addCleanup(connection.quit)
+        self.assertEqual(connection.sendmail(
+            'anne@example.com', ['bart@example.com'], MESSAGE), {})
+        self.assertEqual(len(self._servers[0].messages), 1)
+        self.assertIsNotNone(down.ejected_until)
+        self.assertEqual(up.connections, 1)
+        connection.quit()
+        self.assertEqual(up.connections, 0)
+
+    def test_lost_smarthost(self):
+        # When a smarthost goes away during a delivery, the message is sent
+        # to another one.
+        down, first, second = self._smart_hosts.hosts
+        self._smart_hosts.hosts.remove(down)
+        real_sendmail = smtplib.SMTP.sendmail
+        calls = []
+        def sendmail(smtp, *args):
+            calls.append(smtp.sock.getpeername()[1])
+            if len(calls) == 1:
+                raise smtplib.SMTPServerDisconnected('Gone away')
+            return real_sendmail(smtp, *args)
+        connection = Connection(None, None, 0, smart_hosts=self._smart_hosts)
+        self.addCleanup(connection.quit)
+        with patch.object(smtplib.SMTP, 'sendmail', sendmail):
+            self.assertEqual(connection.sendmail(
+                'anne@example.com', ['bart@example.com'], MESSAGE), {})
+        self.assertEqual(calls, [first.port, second.port])
+        self.assertEqual(len(self._servers[0].messages), 0)
+        self.assertEqual(len(self._servers[1].messages), 1)
+        self.assertIsNotNone(first.ejected_until)
+
+    def test_every_smarthost_unreachable(self):
+        smart_hosts = SmartHosts([SmartHost('127.0.0.1', get_closed_port()),
+                                  SmartHost('127.0.0.1', get_closed_port())])
+        connection = Connection(None, None, 0, smart_hosts=smart_hosts)
+        with self.assertRaises(ConnectionRefusedError):
+            connection.sendmail(
+                'anne@example.com', ['bart@example.com'], MESSAGE)
+        self.assertEqual([host.failures for host in smart_hosts.hosts],
+                         [1, 1])
+
+    def test_asynchronous(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        connection = AsyncConnection(
+            None, None, 0, loop=loop, smart_hosts=self._smart_hosts)
+        refused = loop.run_until_complete(connection.sendmail(
+            'anne@example.com', ['bart@example.com'], _prepare(MESSAGE)))
+        loop.run_until_complete(connection.quit())
+        self.assertEqual(refused, {})
+        self.assertEqual(len(self._servers[0].messages), 1)
+        self.assertIsNotNone(self._smart_hosts.hosts[0].ejected_until)
@@ -0,0 +1,118 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test rendering messages from templates."""
+
+__all__ = [
+    'TestMessageTemplate',
+    'TestRenderedMessage',
+    ]
+
+
+import unittest
+
+from email.mime.text import MIMEText
+from mailman.mta.splicing import MessageTemplate, RenderedMessage, header_line
+from mailman.testing.helpers import specialized_message_from_string as mfs
+from mailman.testing.layers import ConfigLayer
+
+
+
+class TestMessageTemplate(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Subject: test
+
+Hello
+""")
+        self._template = MessageTemplate()
+
+    def _render(self, **msgdata):
+        return self._template.render(None, msgdata)
+
+    def test_splice(self):
+        to = self._template.add(
+            lambda mlist, msgdata: (header_line('To', msgdata['to'])
+                                    if msgdata['to'] else ''),
+            line=True)
+        name = self._template.add(lambda mlist, msgdata: msgdata['name'])
+        self._msg.replace_header('To', to)
+        self._msg.set_payload('Hello {0}\n'.format(name))
+        self.assertTrue(self._template.compile(self._msg))
+        # Header lines can be removed.
+        self.assertMultiLineEqual(self._render(to='', name='Bart'), """\
+From: anne@example.com
+Subject: test
+
+Hello Bart
+""")
+        # Header lines come out as they would in the flattened message.
+        to = ', '.join(['a-rather-long-address@example.com'] * 3)
+        msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Subject: test
+
+Hello Bart
+""")
+        msg.replace_header('To', to)
+        self.assertMultiLineEqual(self._render(to=to, name='Bart'),
+                                  msg.as_string())
+
+    def test_unspliceable_text(self):
+        name = self._template.add(lambda mlist, msgdata: msgdata['name'])
+        self._msg.set_payload('Hello {0}\n'.format(name))
+        self.assertTrue(self._template.compile(self._msg))
+        for value in (None, '', 'Bart ', 'Bart\nPerson', 'B\xe4rt'):
+            self.assertIsNone(self._render(name=value))
+
+    def test_unused_markers(self):
+        # Markers which aren't in the message are never rendered.
+        self._template.add(lambda mlist, msgdata: None)
+        self.assertTrue(self._template.compile(self._msg))
+        self.assertEqual(self._render(), self._msg.as_string())
+
+    def test_encoded_markers(self):
+        # Markers in encoded parts can't be spliced.
+        name = self._template.add(lambda mlist, msgdata: msgdata['name'])
+        msg = MIMEText('Hello {0}\n'.format(name), 'plain', 'utf-8')
+        self.assertFalse(self._template.compile(msg))
+
+
+
+class TestRenderedMessage(unittest.TestCase):
+    layer = ConfigLayer
+
+    def test_parsed_lazily(self):
+        text = """\
+From: anne@example.com
+Message-ID: <ant>
+
+Hello
+"""
+        msg = RenderedMessage(text, '<ant>')
+        self.assertEqual(msg['message-id'], '<ant>')
+        self.assertEqual(msg.as_string(), text)
+        self.assertNotIn('_headers', msg.__dict__)
+        # Looking inside it does parse it.
+        self.assertEqual(msg['from'], 'anne@example.com')
+        self.assertEqual(msg.get_payload(), 'Hello\n')
+        self.assertEqual(msg.as_string(), text)
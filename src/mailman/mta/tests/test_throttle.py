@@ -0,0 +1,148 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test delivery throttling."""
+
+__all__ = [
+    'TestThrottle',
+    'TestThrottledDelivery',
+    ]
+
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from mailman.config import config
+from mailman.mta.bulk import BulkDelivery
+from mailman.mta.throttle import Throttle, get_throttle
+from mailman.testing.helpers import configuration, make_recipients
+from mailman.testing.layers import ConfigLayer
+from unittest.mock import patch
+
+
+
+class TestThrottle(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        self._path = os.path.join(tempdir, 'throttle.json')
+        self._throttle = Throttle(self._path, 10, 20, {
+            'example.org': (1, 2),
+            'example.net': (0, 0),
+            })
+
+    def test_burst(self):
+        # A burst of recipients can be sent at once, but then they have to
+        # wait for the bucket to be refilled.
+        recipients = make_recipients(20, 'example.com')
+        self.assertEqual(self._throttle.reserve(recipients, now=100), 0)
+        self.assertEqual(self._throttle.reserve(recipients[:5], now=100), 0.5)
+        self.assertEqual(self._throttle.reserve(recipients[:5], now=100), 1.0)
+        # Two seconds later, there are 10 tokens left.
+        self.assertEqual(self._throttle.reserve(recipients[:10], now=102), 0)
+        self.assertEqual(self._throttle.reserve(recipients[:1], now=102), 0.1)
+
+    def test_domain_limits(self):
+        # Each domain has its own bucket, and the longest wait wins.
+        recipients = (make_recipients(4, 'example.org') +
+                      make_recipients(30, 'example.com') +
+                      make_recipients(100, 'example.net'))
+        self.assertEqual(self._throttle.reserve(recipients, now=100), 2)
+        self.assertEqual(self._throttle.reserve(
+            make_recipients(1, 'EXAMPLE.ORG'), now=100), 3)
+
+    def test_unthrottled_domains(self):
+        # Recipients in unthrottled domains don't need the state file.
+        recipients = make_recipients(100, 'example.net')
+        self.assertEqual(self._throttle.reserve(recipients, now=100), 0)
+        self.assertFalse(os.path.exists(self._path))
+
+    def test_shared_buckets(self):
+        # Throttles using the same state file share their buckets.
+        other = Throttle(self._path, 10, 20)
+        recipients = make_recipients(20, 'example.com')
+        self.assertEqual(self._throttle.reserve(recipients, now=100), 0)
+        self.assertEqual(other.reserve(recipients[:5], now=100), 0.5)
+
+    def test_full_buckets_are_forgotten(self):
+        self._throttle.reserve(make_recipients(5, 'example.com'), now=100)
+        self._throttle.reserve(make_recipients(1, 'example.org'), now=100)
+        with open(self._path) as fp:
+            self.assertEqual(sorted(json.load(fp)),
+                             ['example.com', 'example.org'])
+        # The example.com bucket is full again.
+        self._throttle.reserve(make_recipients(1, 'example.org'), now=101)
+        with open(self._path) as fp:
+            self.assertEqual(sorted(json.load(fp)), ['example.org'])
+
+    def test_not_configured(self):
+        self.assertIsNone(get_throttle())
+
+    @configuration('mta', throttle_burst=5, throttle_domains="""
+    example.com 2
+    example.org 1 3
+    example.net bogus
+    """)
+    def test_configured_domains(self):
+        throttle = get_throttle()
+        self.addCleanup(os.remove, os.path.join(config.DATA_DIR,
+                                                'throttle.json'))
+        recipients = (make_recipients(7, 'example.com') +
+                      make_recipients(5, 'example.org') +
+                      make_recipients(100, 'example.net'))
+        self.assertEqual(throttle.reserve(recipients, now=100), 2)
+
+
+
+class TestThrottledDelivery(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._sent = []
+        self.addCleanup(self._remove_state)
+
+    def _remove_state(self):
+        try:
+            os.remove(os.path.join(config.DATA_DIR, 'throttle.json'))
+        except FileNotFoundError:
+            pass
+
+    def sendmail(self, sender, recipients, msgtext):
+        self._sent.append(recipients)
+        return {}
+
+    @configuration('mta', throttle_rate=1, throttle_burst=2)
+    def test_delivery_waits(self):
+        agent = BulkDelivery()
+        with patch('mailman.mta.base.time.sleep') as sleep:
+            for i in range(2):
+                refused = agent._send(
+                    self, 'test-bounces@example.com',
+                    make_recipients(2, 'example.com'), 'Subject: test\n\n',
+                    '<first>')
+                self.assertEqual(refused, {})
+        self.assertEqual(len(self._sent), 2)
+        # The first chunk was sent right away, but the second had to wait
+        # for the bucket to be refilled.
+        self.assertEqual(sleep.call_count, 1)
+        delay = sleep.call_args[0][0]
+        self.assertTrue(1 < delay <= 2, delay)
@@ -0,0 +1,139 @@
+# Copyright (C) 2015 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Throttling deliveries to each destination domain.
+
+Big mail providers start refusing mail with temporary failures when it
+arrives too fast, and retrying those failures only adds to the load.  Instead,
+the recipients in each domain are counted against a token bucket, which is
+refilled at the domain's rate up to its burst size, and deliveries which would
+overdraw the bucket wait until the tokens they need have been refilled.
+
+All the runners share the buckets through a small state file, which is locked
+while a delivery takes its tokens.  Only the buckets which aren't full are
+kept in the file.
+"""
+
+__all__ = [
+    'Throttle',
+    'get_throttle',
+    ]
+
+
+import os
+import time
+import logging
+
+from mailman.config import config
+from mailman.utilities.filesystem import shared_state
+
+
+log = logging.getLogger('mailman.smtp')
+
+
+
+class Throttle:
+    """Token buckets for the destination domains."""
+
+    def __init__(self, path, rate, burst, domains=None):
+        """Create a throttle.
+
+        :param path: The state file shared by all the runners.
+        :type path: string
+        :param rate: The default rate, in recipients per second.  Domains
+            with a rate of zero or less aren't throttled.
+        :type rate: float
+        :param burst: The default burst size, in recipients.
+        :type burst: float
+        :param domains: The rates and burst sizes of specific domains.
+        :type domains: dictionary mapping domains to 2-tuples
+        """
+        self._path = path
+        self._default = (rate, burst)
+        self._domains = ({} if domains is None else domains)
+
+    def _limits(self, domain):
+        return self._domains.get(domain, self._default)
+
+    def reserve(self, recipients, now=None):
+        """Take the tokens for delivering a message to some recipients.
+
+        The tokens are taken even if the buckets don't have enough, in which
+        case the caller must wait until they would have been refilled before
+        sending the message.
+
+        :param recipients: The recipients of the message.
+        :type recipients: sequence of strings
+        :param now: The current time, for testing.
+        :type now: float
+        :return: The number of seconds to wait before sending.
+        :rtype: float
+        """
+        counts = {}
+        for recipient in recipients:
+            domain = recipient.rpartition('@')[2].lower()
+            if self._limits(domain)[0] > 0:
+                counts[domain] = counts.get(domain, 0) + 1
+        if len(counts) == 0:
+            return 0
+        if now is None:
+            now = time.time()
+        delay = 0
+        with shared_state(self._path) as buckets:
+            for domain, count in counts.items():
+                rate, burst = self._limits(domain)
+                tokens, updated = buckets.get(domain, (burst, now))
+                tokens = min(
+                    burst, tokens + max(0, now - updated) * rate) - count
+                if tokens < 0:
+                    delay = max(delay, -tokens / rate)
+                buckets[domain] = (tokens, now)
+            # Forget the buckets which have been refilled.
+            for domain, (tokens, updated) in list(buckets.items()):
+                rate, burst = self._limits(domain)
+                if rate <= 0 or (
+                        tokens + max(0, now - updated) * rate >= burst):
+                    del buckets[domain]
+        return delay
+
+
+
+def get_throttle():
+    """Return the configured throttle.
+
+    :return: The throttle, or None if deliveries aren't throttled.
+    :rtype: `Throttle`
+    """
+    domains = {}
+    for line in config.mta.throttle_domains.splitlines():
+        parts = line.split()
+        if len(parts) == 0:
+            continue
+        try:
+            rate = float(parts[1])
+            burst = (float(parts[2]) if len(parts) > 2
+                     else float(config.mta.throttle_burst))
+        except (IndexError, ValueError):
+            log.error('Configuration error: [mta]throttle_domains '
+                      'contains bogus line: {0}'.format(line))
+            continue
+        domains[parts[0].lower()] = (rate, burst)
+    rate = float(config.mta.throttle_rate)
+    if rate <= 0 and all(limits[0] <= 0 for limits in domains.values()):
+        return None
+    return Throttle(os.path.join(config.DATA_DIR, 'throttle.json'),
+                    rate, float(config.mta.throttle_burst), domains)
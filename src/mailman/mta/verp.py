@@ -27,6 +27,7 @@ import logging
 
 from mailman.config import config
 from mailman.mta.base import IndividualDelivery
+from mailman.mta.splicing import header_line
 from mailman.utilities.email import split_email
 from mailman.utilities.string import expand
 
@@ -89,6 +90,17 @@ class VERPMixin:
         if recipient in msgdata.get('add-dup-header', {}):
             msg['X-Mailman-Copy'] = 'yes'
 
+    def avoid_duplicates_template(self, mlist, msg, msgdata, template):
+        """Mark where `avoid_duplicates()` flags the message."""
+        del msg['x-mailman-copy']
+        msg['X-Mailman-Copy'] = template.add(_copy_header, line=True)
+
+
+def _copy_header(mlist, msgdata):
+    if msgdata['recipient'] in msgdata.get('add-dup-header', {}):
+        return header_line('X-Mailman-Copy', 'yes')
+    return ''
+
 
 
 class VERPDelivery(VERPMixin, IndividualDelivery):
@@ -153,6 +153,19 @@ class CollectionMixin:
         """
         raise NotImplementedError
 
+    def _resources_as_dicts(self, collection):
+        """Return the dictionary representations of many resources.
+
+        Subclasses may override this to look up what the representations
+        need for all of the resources at once.
+
+        :param collection: The resource objects.
+        :type collection: list
+        :return: The representations of the resources.
+        :rtype: list
+        """
+        return [self._resource_as_dict(resource) for resource in collection]
+
     def _resource_as_json(self, resource):
         """Return the JSON formatted representation of the resource."""
         return etag(self._resource_as_dict(resource))
@@ -174,8 +187,7 @@ class CollectionMixin:
         if len(collection) == 0:
             return dict(start=0, total_size=0)
         else:
-            entries = [self._resource_as_dict(resource)
-                       for resource in collection]
+            entries = self._resources_as_dicts(collection)
             # Tag the resources but use the dictionaries.
             [etag(resource) for resource in entries]
             # Create the collection resource
@@ -35,6 +35,7 @@ from mailman.interfaces.listmanager import (
     IListManager, ListAlreadyExistsError)
 from mailman.interfaces.mailinglist import IListArchiverSet
 from mailman.interfaces.member import MemberRole
+from mailman.interfaces.roster import IRosterStatistics
 from mailman.interfaces.styles import IStyleManager
 from mailman.interfaces.subscriptions import ISubscriptionService
 from mailman.rest.listconf import ListConfiguration
@@ -99,19 +100,30 @@ def config_matcher(request, segments):
 class _ListBase(CollectionMixin):
     """Shared base class for mailing list representations."""
 
-    def _resource_as_dict(self, mlist):
+    def _resource_as_dict(self, mlist, counts=None):
         """See `CollectionMixin`."""
+        member_count = (mlist.members.member_count
+                        if counts is None
+                        else counts.get(MemberRole.member, 0))
         return dict(
             display_name=mlist.display_name,
             fqdn_listname=mlist.fqdn_listname,
             list_id=mlist.list_id,
             list_name=mlist.list_name,
             mail_host=mlist.mail_host,
-            member_count=mlist.members.member_count,
+            member_count=member_count,
             volume=mlist.volume,
             self_link=path_to('lists/{0}'.format(mlist.list_id)),
             )
 
+    def _resources_as_dicts(self, mlists):
+        """See `CollectionMixin`."""
+        # Count the members of all the mailing lists with a single query.
+        counts = getUtility(IRosterStatistics).get_counts(
+            mlist.list_id for mlist in mlists)
+        return [self._resource_as_dict(mlist, counts.get(mlist.list_id, {}))
+                for mlist in mlists]
+
     @paginate
     def _get_collection(self, request):
         """See `CollectionMixin`."""
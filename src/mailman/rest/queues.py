@@ -24,9 +24,11 @@ __all__ = [
     ]
 
 
+from datetime import datetime
 from mailman.config import config
 from mailman.app.inject import inject_text
 from mailman.interfaces.listmanager import IListManager
+from mailman.mta.breaker import get_circuit_breaker
 from mailman.rest.helpers import (
     CollectionMixin, bad_request, created, etag, no_content, not_found, okay,
     paginate, path_to)
@@ -42,13 +44,23 @@ class _QueuesBase(CollectionMixin):
         """See `CollectionMixin`."""
         switchboard = config.switchboards[name]
         files = switchboard.files
-        return dict(
+        resource = dict(
             name=switchboard.name,
             directory=switchboard.queue_directory,
             count=len(files),
             files=files,
             self_link=path_to('queues/{}'.format(name)),
             )
+        breaker = get_circuit_breaker()
+        if name == 'out' and breaker is not None:
+            # The out runners stop dequeuing while the MTA is unreachable.
+            status = breaker.status()
+            resource['circuit_breaker'] = status['state'].value
+            resource['connection_failures'] = status['failures']
+            if status['probe_at'] is not None:
+                resource['probe_at'] = datetime.utcfromtimestamp(
+                    int(status['probe_at']))
+        return resource
 
     @paginate
     def _get_collection(self, request):
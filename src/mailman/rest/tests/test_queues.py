@@ -27,6 +27,7 @@ import unittest
 from mailman.app.lifecycle import create_list
 from mailman.config import config
 from mailman.database.transaction import transaction
+from mailman.mta.breaker import get_circuit_breaker
 from mailman.testing.helpers import call_api, get_queue_messages
 from mailman.testing.layers import RESTLayer
 from urllib.error import HTTPError
@@ -105,3 +106,17 @@ class TestQueues(unittest.TestCase):
         content, response = call_api(location, method='DELETE')
         self.assertEqual(response.status, 204)
         self.assertEqual(len(config.switchboards['bad'].files), 0)
+
+    def test_probe_at(self):
+        # The time of the next probe of an unreachable MTA is given in UTC,
+        # like the other times in the REST API.
+        breaker = get_circuit_breaker()
+        self.addCleanup(breaker.succeeded)
+        # The breaker opens after the fifth failure, and waits for 30
+        # seconds before probing the MTA.
+        for i in range(5):
+            breaker.failed(ConnectionRefusedError('Connection refused'),
+                           now=4102444770)
+        content, response = call_api('http://localhost:9001/3.0/queues/out')
+        self.assertEqual(content['circuit_breaker'], 'open')
+        self.assertEqual(content['probe_at'], '2100-01-01T00:00:00')
@@ -52,6 +52,7 @@ class TestSystemConfiguration(unittest.TestCase):
             pending_request_life='3d',
             post_hook='',
             pre_hook='',
+            recipient_snapshots='no',
             sender_headers='from from_ reply-to sender',
             site_owner='noreply@example.com',
             ))
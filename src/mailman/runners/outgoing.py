@@ -22,21 +22,29 @@ __all__ = [
     ]
 
 
+import os
+import json
+import shutil
 import socket
+import hashlib
 import logging
 
 from datetime import datetime
-from lazr.config import as_boolean, as_timedelta
+from lazr.config import as_boolean
 from mailman.config import config
+from mailman.core.delayqueue import get_delay_queue
 from mailman.core.runner import Runner
+from mailman.core.switchboard import get_slice_count
 from mailman.interfaces.bounce import BounceContext, IBounceProcessor
 from mailman.interfaces.mailinglist import Personalization
 from mailman.interfaces.mta import SomeRecipientsFailed
 from mailman.interfaces.pending import IPendings
+from mailman.interfaces.retry import IRetryStore
 from mailman.interfaces.subscriptions import ISubscriptionService
+from mailman.mta.breaker import BreakerState, get_circuit_breaker
 from mailman.utilities.datetime import now
 from mailman.utilities.modules import find_name
-from uuid import UUID
+from uuid import UUID, uuid4
 from zope.component import getUtility
 
 
@@ -45,29 +53,113 @@ from zope.component import getUtility
 DEAL_WITH_PERMFAILURES_EVERY = 10
 
 log = logging.getLogger('mailman.error')
-smtp_log = logging.getLogger('mailman.smtp')
 debug_log = logging.getLogger('mailman.debug')
 
 
+
+class _Fanouts:
+    """Track the shards of fanned out deliveries.
+
+    Each fanned out delivery gets a directory, in which every shard records
+    its temporary failures once it has been delivered.  Whichever shard finds
+    that all the others are done too collects the results, by renaming the
+    directory out of the way, which only one of them can do.
+    """
+
+    def __init__(self, directory):
+        self._directory = directory
+
+    def start(self):
+        """Start tracking a fanned out delivery.
+
+        :return: The id of the fanned out delivery.
+        """
+        fanout_id = uuid4().hex
+        os.makedirs(os.path.join(self._directory, fanout_id))
+        return fanout_id
+
+    def finish(self, fanout, temporary_failures):
+        """Record that a shard has been delivered.
+
+        :param fanout: The shard's 'fanout' metadata.
+        :type fanout: dict
+        :param temporary_failures: The shard's temporarily failed recipients,
+            mapped to their SMTP responses.
+        :type temporary_failures: dict
+        :return: The temporary failures of all the shards if this was the
+            last one to finish, otherwise None.
+        """
+        path = os.path.join(self._directory, fanout['id'])
+        filename = os.path.join(path, '{0}.json'.format(fanout['shard']))
+        try:
+            with open(filename + '.tmp', 'w') as fp:
+                json.dump(temporary_failures, fp)
+            os.rename(filename + '.tmp', filename)
+            done = [name for name in os.listdir(path)
+                    if name.endswith('.json')]
+        except FileNotFoundError:
+            # The results were already collected, so this shard is being
+            # delivered again after a crash.
+            return None
+        if len(done) < fanout['shards']:
+            return None
+        collected = path + '.collected'
+        try:
+            os.rename(path, collected)
+        except FileNotFoundError:
+            # Another shard got there first.
+            return None
+        failures = {}
+        for shard in range(fanout['shards']):
+            with open(os.path.join(collected, '{0}.json'.format(shard))) as fp:
+                failures.update(json.load(fp))
+        shutil.rmtree(collected)
+        return failures
+
+
 
 class OutgoingRunner(Runner):
     """The outgoing runner."""
 
-    def __init__(self, slice=None, numslices=1):
-        super(OutgoingRunner, self).__init__(slice, numslices)
+    def __init__(self, name, slice=None):
+        super(OutgoingRunner, self).__init__(name, slice)
         # We look this function up only at startup time.
         self._func = find_name(config.mta.outgoing)
         # This prevents smtp server connection problems from filling up the
         # error log.  It gets reset if the message was successfully sent, and
         # set if there was a socket.error.
         self._logged = False
-        self._retryq = config.switchboards['retry']
+        self._retry_store = getUtility(IRetryStore)
+        self._fanout_recipients = int(config.mta.fanout_recipients)
+        self._fanouts = _Fanouts(os.path.join(self.queue_directory, '.fanout'))
+        self._breaker = get_circuit_breaker()
+        self._delay_queue = get_delay_queue()
+
+    def _one_iteration(self):
+        """See `IRunner`.
+
+        While the circuit breaker is open, the queue is left alone.
+        """
+        if self._breaker is not None and not self._breaker.allow():
+            debug_log.debug('[outgoing] paused by the circuit breaker')
+            return 0
+        return super(OutgoingRunner, self)._one_iteration()
+
+    def _short_circuit(self):
+        """See `IRunner`."""
+        if super(OutgoingRunner, self)._short_circuit():
+            return True
+        # Stop dequeuing as soon as the circuit breaker opens.
+        return (self._breaker is not None and
+                self._breaker.status()['state'] is BreakerState.open)
 
     def _dispose(self, mlist, msg, msgdata):
         # See if we should retry delivery of this message again.
         deliver_after = msgdata.get('deliver_after', datetime.fromtimestamp(0))
         if now() < deliver_after:
-            return True
+            # Park the message until then, instead of going round the queue.
+            self._delay_queue.park(msg, msgdata, deliver_after)
+            return False
         # Calculate whether we should VERP this message or not.  The results of
         # this set the 'verp' key in the message metadata.
         interval = int(config.mta.verp_delivery_interval)
@@ -91,6 +183,9 @@ class OutgoingRunner(Runner):
         else:
             # VERP every 'interval' number of times.
             msgdata['verp'] = (mlist.post_id % interval == 0)
+        if self._fan_out(msg, msgdata):
+            return False
+        temporary_failures = {}
         try:
             debug_log.debug('[outgoing] {0}: {1}'.format(
                 self._func, msg.get('message-id', 'n/a')))
@@ -139,31 +234,56 @@ class OutgoingRunner(Runner):
                 # but temporary failures are retried for later.
                 for email in error.permanent_failures:
                     processor.register(mlist, email, msg, BounceContext.normal)
-                # Move temporary failures to the qfiles/retry queue which will
-                # occasionally move them back here for another shot at
-                # delivery.
-                if error.temporary_failures:
-                    current_time = now()
-                    recipients = error.temporary_failures
-                    last_recip_count = msgdata.get('last_recip_count', 0)
-                    deliver_until = msgdata.get('deliver_until', current_time)
-                    if len(recipients) == last_recip_count:
-                        # We didn't make any progress.  If we've exceeded the
-                        # configured retry period, log this failure and
-                        # discard the message.
-                        if current_time > deliver_until:
-                            smtp_log.error('Discarding message with '
-                                           'persistent temporary failures: '
-                                           '{0}'.format(msg['message-id']))
-                            return False
-                    else:
-                        # We made some progress, so keep trying to delivery
-                        # this message for a while longer.
-                        deliver_until = current_time + as_timedelta(
-                            config.mta.delivery_retry_period)
-                    msgdata['last_recip_count'] = len(recipients)
-                    msgdata['deliver_until'] = deliver_until
-                    msgdata['recipients'] = recipients
-                    self._retryq.enqueue(msg, msgdata)
+                temporary_failures = dict(
+                    (email, error.responses.get(email))
+                    for email in error.temporary_failures)
+        if 'fanout' in msgdata:
+            # This is one shard of a fanned out delivery.  The temporary
+            # failures of all the shards are retried together, once the last
+            # of them is done, so that retries make progress as a whole.
+            temporary_failures = self._fanouts.finish(
+                msgdata['fanout'], temporary_failures)
+            if temporary_failures is None:
+                return False
+            msgdata = msgdata.copy()
+            del msgdata['fanout']
+        # Remember the temporary failures in the retry store, which tracks
+        # each recipient until it is time for another shot at delivery.  The
+        # retry store also has to know how its own delivery jobs went.
+        if temporary_failures or 'retry_id' in msgdata:
+            self._retry_store.record(msg, msgdata, temporary_failures)
         # We've successfully completed handling of this message.
         return False
+
+    def _fan_out(self, msg, msgdata):
+        """Split a very large delivery into shards for all our slices.
+
+        The recipients are hashed into one shard per slice of the out queue,
+        and each shard is enqueued to a slice of its own, so that the shards
+        are delivered in parallel.
+
+        :return: True if the delivery was fanned out.
+        """
+        recipients = msgdata.get('recipients') or ()
+        if (self._fanout_recipients == 0 or
+                len(recipients) < self._fanout_recipients or
+                'fanout' in msgdata or 'probe_token' in msgdata or
+                'retry_id' in msgdata):
+            return False
+        section = getattr(config, 'runner.' + self.name)
+        count = get_slice_count(self.queue_directory, int(section.instances))
+        shards = [[] for i in range(count)]
+        for recipient in recipients:
+            digest = hashlib.sha1(recipient.encode('utf-8')).hexdigest()
+            shards[int(digest, 16) % count].append(recipient)
+        shards = [shard for shard in shards if len(shard) > 0]
+        if len(shards) < 2:
+            return False
+        fanout_id = self._fanouts.start()
+        for index, shard in enumerate(shards):
+            self.switchboard.enqueue(
+                msg, msgdata, recipients=shard, _slice=index,
+                fanout=dict(id=fanout_id, shard=index, shards=len(shards)))
+        debug_log.debug('[outgoing] {0}: fanned out to {1} shards'.format(
+            msg.get('message-id', 'n/a'), len(shards)))
+        return True
@@ -15,28 +15,71 @@
 # You should have received a copy of the GNU General Public License along with
 # GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
 
-"""Retry delivery."""
+"""Retry delivery.
+
+The recipients whose delivery failed temporarily are kept in the retry store,
+and when they are due, the retry runner sends them to the out queue in new
+delivery jobs, one for each domain.  Messages enqueued to the retry queue are
+parked in the delay queue for the retry interval.  The retry runner is also
+what releases the messages parked by the outgoing runner until their
+`deliver_after` time.
+"""
 
 __all__ = [
     'RetryRunner',
     ]
 
 
-import time
-
+from lazr.config import as_timedelta
 from mailman.config import config
+from mailman.core.delayqueue import get_delay_queue
 from mailman.core.runner import Runner
+from mailman.interfaces.retry import IRetryStore
+from mailman.utilities.datetime import now
+from zope.component import getUtility
+
 
 
-
 class RetryRunner(Runner):
     """Retry delivery."""
 
+    def __init__(self, name, slice=None):
+        super(RetryRunner, self).__init__(name, slice)
+        self._delay_queue = get_delay_queue()
+        self._delay_queue.recover_backup_files()
+        self._outq = config.switchboards['out']
+        self._retry_store = getUtility(IRetryStore)
+        self._next_attempt = None
+
+    def _one_iteration(self):
+        """See `IRunner`."""
+        released = self._delay_queue.release(self._outq)
+        # Commit before enqueuing the jobs.  If we crash in between, the
+        # recipients just come up again after the retry interval.
+        jobs = self._retry_store.schedule()
+        self._next_attempt = self._retry_store.next_attempt
+        config.db.commit()
+        for msg, msgdata in jobs:
+            self._outq.enqueue(msg, msgdata)
+        return (super(RetryRunner, self)._one_iteration() +
+                released + len(jobs))
+
     def _dispose(self, mlist, msg, msgdata):
-        # Move the message to the out queue for another try.
-        config.switchboards['out'].enqueue(msg, msgdata)
+        # Park the message until it is time for another try.
+        due = now() + as_timedelta(config.mta.delivery_retry_interval)
+        self._delay_queue.park(msg, msgdata, due)
         return False
 
-    def _snooze(self, filecnt):
-        # We always want to snooze.
-        time.sleep(self.sleep_float)
+    def _snooze_time(self):
+        """See `Runner`.
+
+        Wake up in time to release the next parked message, or to retry
+        the next recipient.
+        """
+        sleep_float = super(RetryRunner, self)._snooze_time()
+        # Don't look in the database here, since that would keep a
+        # transaction open while we sleep.
+        for due in (self._delay_queue.next_due(), self._next_attempt):
+            if due is not None:
+                sleep_float = min(sleep_float, (due - now()).total_seconds())
+        return max(0, sleep_float)
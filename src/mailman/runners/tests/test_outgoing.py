@@ -18,6 +18,7 @@
 """Test the outgoing runner."""
 
 __all__ = [
+    'TestFanout',
     'TestOnce',
     'TestSocketError',
     'TestSomeRecipientsFailed',
@@ -36,11 +37,14 @@ from lazr.config import as_timedelta
 from mailman.app.bounces import send_probe
 from mailman.app.lifecycle import create_list
 from mailman.config import config
+from mailman.core.delayqueue import get_delay_queue
+from mailman.core.switchboard import _owner, _parse, set_slice_count
 from mailman.interfaces.bounce import BounceContext, IBounceProcessor
 from mailman.interfaces.mailinglist import Personalization
 from mailman.interfaces.member import MemberRole
 from mailman.interfaces.mta import SomeRecipientsFailed
 from mailman.interfaces.pending import IPendings
+from mailman.interfaces.retry import IRetryStore
 from mailman.interfaces.usermanager import IUserManager
 from mailman.runners.outgoing import OutgoingRunner
 from mailman.testing.helpers import (
@@ -48,6 +52,7 @@ from mailman.testing.helpers import (
     specialized_message_from_string as message_from_string)
 from mailman.testing.layers import ConfigLayer, SMTPLayer
 from mailman.utilities.datetime import factory, now
+from unittest.mock import patch
 from zope.component import getUtility
 
 
@@ -90,16 +95,20 @@ Message-Id: <first>
 
     def test_deliver_after(self):
         # When the metadata has a deliver_after key in the future, the runner
-        # will re-enqueue the message rather than delivering it.
+        # parks the message in the delay queue rather than delivering it.
         deliver_after = now() + timedelta(days=10)
         self._msgdata['deliver_after'] = deliver_after
         self._outq.enqueue(self._msg, self._msgdata,
                            tolist=True, listid='test.example.com')
         self._runner.run()
-        items = get_queue_messages('out')
-        self.assertEqual(len(items), 1)
-        self.assertEqual(items[0].msgdata['deliver_after'], deliver_after)
-        self.assertEqual(items[0].msg['message-id'], '<first>')
+        self.assertEqual(len(get_queue_messages('out')), 0)
+        delay_queue = get_delay_queue()
+        filebases = delay_queue.files
+        self.assertEqual(len(filebases), 1)
+        due, msg, msgdata = delay_queue.get(filebases[0])
+        self.assertEqual(due, deliver_after)
+        self.assertEqual(msgdata['deliver_after'], deliver_after)
+        self.assertEqual(msg['message-id'], '<first>')
 
 
 
@@ -323,10 +332,14 @@ Message-Id: <first>
 
 temporary_failures = []
 permanent_failures = []
+responses = {}
 
 
 def raise_SomeRecipientsFailed(mlist, msg, msgdata):
-    raise SomeRecipientsFailed(temporary_failures, permanent_failures)
+    failures = [email for email in temporary_failures
+                if email in msgdata.get('recipients', [email])]
+    if len(failures) > 0 or len(permanent_failures) > 0:
+        raise SomeRecipientsFailed(failures, permanent_failures, responses)
 
 
 class TestSomeRecipientsFailed(unittest.TestCase):
@@ -338,6 +351,7 @@ class TestSomeRecipientsFailed(unittest.TestCase):
         global temporary_failures, permanent_failures
         del temporary_failures[:]
         del permanent_failures[:]
+        responses.clear()
         self._processor = getUtility(IBounceProcessor)
         # Push a config where actual delivery is handled by a dummy function.
         # We generally don't care what this does, since we're just testing the
@@ -430,43 +444,49 @@ Message-Id: <first>
         self.assertEqual(events[1].email, 'bart@example.com')
         self.assertEqual(events[1].context, BounceContext.normal)
 
+    def _retried(self):
+        return [(recipient.email, recipient.message_id)
+                for recipient in getUtility(IRetryStore).recipients]
+
     def test_one_temporary_failure(self):
-        # The first time there are temporary failures, the message just gets
-        # put in the retry queue, but with some metadata to prevent infinite
-        # retries.
+        # The first time there are temporary failures, the recipients are put
+        # in the retry store, along with the message, until their next
+        # attempt is due.
         temporary_failures.append('cris@example.com')
+        responses['cris@example.com'] = '450 4.2.1 Try again later'
         self._outq.enqueue(self._msg, {}, listid='test.example.com')
         self._runner.run()
         events = list(self._processor.unprocessed)
         self.assertEqual(len(events), 0)
-        items = get_queue_messages('retry')
-        self.assertEqual(len(items), 1)
-        self.assertEqual(self._msg.as_string(), items[0].msg.as_string())
-        # The metadata has three keys which are used two decide whether the
-        # next temporary failure should be retried.
-        self.assertEqual(items[0].msgdata['last_recip_count'], 1)
+        self.assertEqual(len(get_queue_messages('retry')), 0)
+        recipients = list(getUtility(IRetryStore).recipients)
+        self.assertEqual(len(recipients), 1)
+        recipient = recipients[0]
+        self.assertEqual(recipient.email, 'cris@example.com')
+        self.assertEqual(recipient.list_id, 'test.example.com')
+        self.assertEqual(recipient.message_id, '<first>')
+        self.assertEqual(recipient.attempts, 1)
+        self.assertEqual(recipient.last_response, '450 4.2.1 Try again later')
+        self.assertEqual(recipient.next_attempt,
+                         datetime(2005, 8, 1, 7, 49, 23) +
+                         as_timedelta(config.mta.delivery_retry_interval))
+        # The message is given up on after the retry period.
         deliver_until = (datetime(2005, 8, 1, 7, 49, 23) +
                          as_timedelta(config.mta.delivery_retry_period))
-        self.assertEqual(items[0].msgdata['deliver_until'], deliver_until)
-        self.assertEqual(items[0].msgdata['recipients'], ['cris@example.com'])
+        self.assertEqual(recipient.message.deliver_until, deliver_until)
 
     def test_two_temporary_failures(self):
-        # The first time there are temporary failures, the message just gets
-        # put in the retry queue, but with some metadata to prevent infinite
-        # retries.
+        # Both recipients are retried, but the message is only stored once.
         temporary_failures.append('cris@example.com')
         temporary_failures.append('dave@example.com')
         self._outq.enqueue(self._msg, {}, listid='test.example.com')
         self._runner.run()
         events = list(self._processor.unprocessed)
         self.assertEqual(len(events), 0)
-        items = get_queue_messages('retry')
-        # There's still only one item in the retry queue, but the metadata
-        # contains both temporary failures.
-        self.assertEqual(len(items), 1)
-        self.assertEqual(items[0].msgdata['last_recip_count'], 2)
-        self.assertEqual(items[0].msgdata['recipients'],
+        recipients = list(getUtility(IRetryStore).recipients)
+        self.assertEqual(sorted(recipient.email for recipient in recipients),
                          ['cris@example.com', 'dave@example.com'])
+        self.assertIs(recipients[0].message, recipients[1].message)
 
     def test_mixed_failures(self):
         # Some temporary and some permanent failures.
@@ -484,17 +504,13 @@ Message-Id: <first>
         self.assertEqual(events[1].email, 'fred@example.com')
         self.assertEqual(events[1].context, BounceContext.normal)
         # Let's look at the temporary failures.
-        items = get_queue_messages('retry')
-        self.assertEqual(len(items), 1)
-        self.assertEqual(items[0].msgdata['recipients'],
-                         ['gwen@example.com', 'herb@example.com'])
+        self.assertEqual(sorted(self._retried()),
+                         [('gwen@example.com', '<first>'),
+                          ('herb@example.com', '<first>')])
 
     def test_no_progress_on_retries_within_retry_period(self):
-        # Temporary failures cause queuing for a retry later on, unless no
-        # progress is being made on the retries and we've tried for the
-        # specified delivery retry period.  This test ensures that even if no
-        # progress is made, if the retry period hasn't expired, the message
-        # will be requeued.
+        # Messages from the retry queue of old bring their own retry period.
+        # Until it is over, the recipients are retried.
         temporary_failures.append('iona@example.com')
         temporary_failures.append('jeff@example.com')
         deliver_until = (datetime(2005, 8, 1, 7, 49, 23) +
@@ -503,12 +519,11 @@ Message-Id: <first>
                        deliver_until=deliver_until)
         self._outq.enqueue(self._msg, msgdata, listid='test.example.com')
         self._runner.run()
-        # The retry queue should have our message waiting to be retried.
-        items = get_queue_messages('retry')
-        self.assertEqual(len(items), 1)
-        self.assertEqual(items[0].msgdata['deliver_until'], deliver_until)
-        self.assertEqual(items[0].msgdata['recipients'],
+        # The retry store should have our recipients waiting to be retried.
+        recipients = list(getUtility(IRetryStore).recipients)
+        self.assertEqual(sorted(recipient.email for recipient in recipients),
                          ['iona@example.com', 'jeff@example.com'])
+        self.assertEqual(recipients[0].message.deliver_until, deliver_until)
 
     def test_no_progress_on_retries_with_expired_retry_period(self):
         # We've had temporary failures with no progress, and the retry period
@@ -525,7 +540,9 @@ Message-Id: <first>
         factory.fast_forward(retry_period.days + 1)
         mark = LogFileMark('mailman.smtp')
         self._runner.run()
-        # There should be no message in the retry or outgoing queues.
+        # There should be no message in the retry store, or the retry or
+        # outgoing queues.
+        self.assertEqual(self._retried(), [])
         self.assertEqual(len(get_queue_messages('retry')), 0)
         self.assertEqual(len(get_queue_messages('out')), 0)
         # There should be a log message in the smtp log indicating that the
@@ -534,3 +551,129 @@ Message-Id: <first>
         self.assertEqual(
             line[-63:-1],
             'Discarding message with persistent temporary failures: <first>')
+
+    def test_retry_job(self):
+        # The retry store makes delivery jobs for the due recipients.  The
+        # ones delivered to are forgotten, and the others are tried again
+        # later.
+        temporary_failures.extend(['anne@example.com', 'bart@example.com',
+                                   'cris@example.com'])
+        self._outq.enqueue(self._msg, {}, listid='test.example.com')
+        self._runner.run()
+        factory.fast_forward()
+        retry_store = getUtility(IRetryStore)
+        jobs = retry_store.schedule()
+        self.assertEqual(len(jobs), 1)
+        msg, msgdata = jobs[0]
+        self.assertEqual(msg['message-id'], '<first>')
+        self.assertEqual(msgdata['listid'], 'test.example.com')
+        del temporary_failures[:]
+        temporary_failures.append('bart@example.com')
+        responses['bart@example.com'] = '451 4.3.0 Mailbox busy'
+        self._outq.enqueue(msg, msgdata)
+        self._runner.run()
+        recipients = list(retry_store.recipients)
+        self.assertEqual(len(recipients), 1)
+        self.assertEqual(recipients[0].email, 'bart@example.com')
+        self.assertEqual(recipients[0].attempts, 2)
+        self.assertEqual(recipients[0].last_response,
+                         '451 4.3.0 Mailbox busy')
+        self.assertEqual(recipients[0].next_attempt,
+                         now() +
+                         as_timedelta(config.mta.delivery_retry_interval))
+        # Once everyone has got the message, it is forgotten.
+        msg, msgdata = retry_store.schedule(recipients[0].next_attempt)[0]
+        del temporary_failures[:]
+        self._outq.enqueue(msg, msgdata)
+        self._runner.run()
+        self.assertEqual(self._retried(), [])
+
+
+
+deliveries = []
+
+def record_deliveries(mlist, msg, msgdata):
+    deliveries.append(msgdata)
+    failures = [recipient for recipient in msgdata['recipients']
+                if recipient.startswith('temp')]
+    if len(failures) > 0:
+        raise SomeRecipientsFailed(failures, [])
+
+
+class TestFanout(unittest.TestCase):
+    """Test fanning out very large deliveries."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        del deliveries[:]
+        config.push('fanout', """
+        [mta]
+        outgoing: mailman.runners.tests.test_outgoing.record_deliveries
+        fanout_recipients: 10
+        """)
+        self.addCleanup(config.pop, 'fanout')
+        self._mlist = create_list('test@example.com')
+        self._outq = config.switchboards['out']
+        set_slice_count(self._outq.queue_directory, 4)
+        self._runner = make_testable_runner(OutgoingRunner, 'out')
+        self._msg = message_from_string("""\
+From: anne@example.com
+To: test@example.com
+Message-Id: <first>
+
+""")
+
+    def _fanouts(self):
+        return os.listdir(os.path.join(self._outq.queue_directory, '.fanout'))
+
+    def test_fan_out(self):
+        recipients = ['person{0:02}@example.com'.format(i) for i in range(20)]
+        self._outq.enqueue(self._msg, dict(recipients=recipients),
+                           listid='test.example.com')
+        switchboard = self._runner.switchboard
+        enqueue = switchboard.enqueue
+        filebases = []
+        def record_enqueue(*args, **kws):
+            filebase = enqueue(*args, **kws)
+            filebases.append(filebase)
+            return filebase
+        with patch.object(switchboard, 'enqueue', record_enqueue):
+            self._runner.run()
+        self.assertGreater(len(deliveries), 1)
+        self.assertLessEqual(len(deliveries), 4)
+        delivered = []
+        for msgdata in deliveries:
+            self.assertEqual(msgdata['fanout']['shards'], len(deliveries))
+            delivered.extend(msgdata['recipients'])
+        self.assertEqual(sorted(delivered), recipients)
+        # Each shard went to a slice of its own.
+        self.assertEqual(len(filebases), len(deliveries))
+        owners = [_owner(4, _parse(filebase)[1]) for filebase in filebases]
+        self.assertEqual(sorted(owners), list(range(len(deliveries))))
+        self.assertEqual(len(get_queue_messages('retry')), 0)
+        self.assertEqual(self._fanouts(), [])
+
+    def test_small_delivery(self):
+        recipients = ['person{0:02}@example.com'.format(i) for i in range(9)]
+        self._outq.enqueue(self._msg, dict(recipients=recipients),
+                           listid='test.example.com')
+        self._runner.run()
+        self.assertEqual(len(deliveries), 1)
+        self.assertNotIn('fanout', deliveries[0])
+        self.assertEqual(deliveries[0]['recipients'], recipients)
+
+    def test_temporary_failures_are_retried_together(self):
+        recipients = ['{0}{1:02}@example.com'.format(prefix, i)
+                      for prefix in ('perm', 'temp') for i in range(10)]
+        self._outq.enqueue(self._msg, dict(recipients=recipients),
+                           listid='test.example.com')
+        self._runner.run()
+        self.assertGreater(len(deliveries), 1)
+        # All the temporary failures end up with a single stored message.
+        retried = list(getUtility(IRetryStore).recipients)
+        self.assertEqual(sorted(recipient.email for recipient in retried),
+                         recipients[10:])
+        self.assertEqual(
+            len(set(recipient.message for recipient in retried)), 1)
+        self.assertEqual(self._fanouts(), [])
@@ -24,13 +24,18 @@ __all__ = [
 
 import unittest
 
+from datetime import timedelta
 from mailman.app.lifecycle import create_list
 from mailman.config import config
+from mailman.core.delayqueue import get_delay_queue
+from mailman.interfaces.retry import IRetryStore
 from mailman.runners.retry import RetryRunner
 from mailman.testing.helpers import (
     get_queue_messages, make_testable_runner,
     specialized_message_from_string as message_from_string)
 from mailman.testing.layers import ConfigLayer
+from mailman.utilities.datetime import factory, now
+from zope.component import getUtility
 
 
 
@@ -52,7 +57,52 @@ Message-Id: <first>
 """)
         self._msgdata = dict(listid='test.example.com')
 
+    def test_message_parked(self):
+        # The message waits in the delay queue for the retry interval.
+        self._retryq.enqueue(self._msg, self._msgdata)
+        self._runner.run()
+        self.assertEqual(len(get_queue_messages('out')), 0)
+        delay_queue = get_delay_queue()
+        filebases = delay_queue.files
+        self.assertEqual(len(filebases), 1)
+        due, msg, msgdata = delay_queue.get(filebases[0])
+        self.assertEqual(due, now() + timedelta(minutes=15))
+        self.assertEqual(msg['message-id'], '<first>')
+
     def test_message_put_in_outgoing_queue(self):
         self._retryq.enqueue(self._msg, self._msgdata)
         self._runner.run()
-        self.assertEqual(len(get_queue_messages('out')), 1)
+        # Once it is time, the message is moved to the out queue.
+        factory.fast_forward(days=1)
+        self._runner.run()
+        items = get_queue_messages('out')
+        self.assertEqual(len(items), 1)
+        self.assertEqual(items[0].msg['message-id'], '<first>')
+        self.assertEqual(get_delay_queue().files, [])
+
+    def test_snooze_until_due(self):
+        # The runner wakes up in time to release the next parked message.
+        get_delay_queue().park(self._msg, self._msgdata,
+                               now() + timedelta(seconds=2))
+        self.assertEqual(self._runner._snooze_time(), 2)
+
+    def test_retry_jobs(self):
+        # Recipients in the retry store are sent to the out queue when they
+        # are due, in a delivery job for each domain.
+        getUtility(IRetryStore).record(self._msg, self._msgdata, {
+            'anne@example.com': None,
+            'bart@example.org': None,
+            'cris@example.com': None,
+            })
+        self._runner.run()
+        self.assertEqual(len(get_queue_messages('out')), 0)
+        factory.fast_forward()
+        self._runner.run()
+        items = get_queue_messages('out')
+        self.assertEqual(
+            sorted(sorted(item.msgdata['recipients']) for item in items),
+            [['anne@example.com', 'cris@example.com'], ['bart@example.org']])
+        for item in items:
+            self.assertEqual(item.msg['message-id'], '<first>')
+            self.assertEqual(item.msgdata['listid'], 'test.example.com')
+            self.assertIn('retry_id', item.msgdata)
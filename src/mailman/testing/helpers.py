@@ -25,10 +25,12 @@ __all__ = [
     'configuration',
     'digest_mbox',
     'event_subscribers',
+    'get_closed_port',
     'get_lmtp_client',
     'get_nntp_server',
     'get_queue_messages',
     'make_digest_messages',
+    'make_recipients',
     'make_testable_runner',
     'reset_the_world',
     'specialized_message_from_string',
@@ -275,6 +277,14 @@ def get_nntp_server(cleanups):
     return NNTPProxy()
 
 
+
+def get_closed_port():
+    """Return a local port which nothing listens on."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
 
 def wait_for_webservice():
     """Wait for the REST server to start serving requests."""
@@ -494,6 +504,13 @@ def reset_the_world():
         for filename in filenames:
             os.remove(os.path.join(dirpath, filename))
         shutil.rmtree(dirpath)
+    # Forget the state of the outgoing MTA shared by the runners.
+    for filename in ('circuit-breaker.json', 'recipient-limits.json',
+                     'throttle.json'):
+        try:
+            os.remove(os.path.join(config.DATA_DIR, filename))
+        except FileNotFoundError:
+            pass
     # Reset the global style manager.
     getUtility(IStyleManager).populate()
     # Remove all dynamic header-match rules.
@@ -556,3 +573,10 @@ message triggering a digest
         volume=1, digest_number=1)
     runner = make_testable_runner(DigestRunner, 'digest')
     runner.run()
+
+
+
+
+def make_recipients(count, domain):
+    """Return `count` recipient addresses in `domain`."""
+    return ['person{0}@{1}'.format(i, domain) for i in range(count)]
@@ -19,12 +19,15 @@
 
 __all__ = [
     'makedirs',
+    'shared_state',
     'umask',
     ]
 
 
 import os
+import json
 import errno
+import fcntl
 
 
 
@@ -73,3 +76,45 @@ def makedirs(path, mode=0o2775):
             os.chmod(dirpath, mode)
         except OSError:
             pass
+
+
+
+class shared_state:
+    """Manage a JSON state file shared by processes, for the with statement.
+
+    The file is locked while the state is being used, and the dictionary
+    returned by the with statement is written back to it afterward, unless
+    an exception occurred.  A missing or unreadable file gives an empty
+    state.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._fp = None
+        self._state = None
+
+    def __enter__(self):
+        assert self._fp is None, 'Unexpected existing state file'
+        self._fp = open(self._path, 'a+')
+        fcntl.flock(self._fp.fileno(), fcntl.LOCK_EX)
+        self._fp.seek(0)
+        try:
+            self._state = json.loads(self._fp.read())
+        except ValueError:
+            # The file is new, or it was only partly written.
+            self._state = {}
+        return self._state
+
+    def __exit__(self, *exc_info):
+        assert self._fp is not None, 'No state file'
+        try:
+            if exc_info[0] is None:
+                self._fp.seek(0)
+                self._fp.truncate()
+                json.dump(self._state, self._fp)
+        finally:
+            fcntl.flock(self._fp.fileno(), fcntl.LOCK_UN)
+            self._fp.close()
+            self._fp = self._state = None
+        # Do not suppress exceptions.
+        return False